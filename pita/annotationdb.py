@@ -1,53 +1,170 @@
 import os
 import sys
 import logging
+import sqlite3
+import itertools
 from gimmemotifs.genome_index import GenomeIndex
-from sqlalchemy import or_,and_,func
-from sqlalchemy import create_engine
+from sqlalchemy import or_,and_,func,bindparam,case
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session,sessionmaker,subqueryload
 from pita.db_backend import Base,get_or_create,ReadSource,Feature,\
-        FeatureReadCount,Evidence,FeatureEvidence 
-from pita.util import read_statistics, get_splice_score
+        FeatureReadCount,Evidence,FeatureEvidence,create_schema,\
+        upgrade_schema,create_indexes,drop_indexes,analyze,SchemaVersion,\
+        SCHEMA_VERSION,LoadedSource,ModelRun,CalledModel
+from pita.util import read_statistics, get_splice_scores, orf_length
+from pita.genome import GenomeStore
 import yaml
-from pita.io import exons_to_tabix_bed, tabix_overlap
-from fluff.track import BamTrack
-from tempfile import NamedTemporaryFile
+import pysam
+from pita.io import exons_to_tabix_bed, tabix_overlap, count_reads
+
+# Connection settings for loading a new SQLite database. Nothing is 
+# written to disk before the load is finished, so a crash means a reload.
+BULK_LOAD_PRAGMAS = [
+        "PRAGMA journal_mode = OFF",
+        "PRAGMA synchronous = OFF",
+        "PRAGMA cache_size = -262144",
+        "PRAGMA mmap_size = 1073741824",
+        "PRAGMA temp_store = MEMORY",
+        ]
+
+# Number of transcripts that are checked and stored at once
+TRANSCRIPT_BATCH_SIZE = 10000
+
+def _set_bulk_load_pragmas(dbapi_conn, conn_record):
+    cursor = dbapi_conn.cursor()
+    for pragma in BULK_LOAD_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def feature_orf_length(ftype, seq):
+    """ Longest ORF stored with a new feature, only for exons """
+    if ftype == "exon":
+        return orf_length(seq or "")
+    return None
 
 class AnnotationDb(object):
-    def __init__(self, session=None, conn='mysql://pita:@localhost/pita', new=False, index=None):
+    def __init__(self, session=None, conn='mysql://pita:@localhost/pita', new=False, index=None, bulk_load=False, in_memory=False):
+        """
+        With bulk_load a new SQLite database is loaded with fast settings, 
+        and indexes are created by finish_load(). With in_memory as well, 
+        the database is built in memory and written to conn at the end.
+        """
         self.logger = logging.getLogger("pita")
         
         # initialize db session
+        self.bulk_load = False
+        self.target = None
         if session:
             self.session = session
         else:
-            self._init_session(conn, new) 
+            self._init_session(conn, new, bulk_load, in_memory) 
         
-        # index to retrieve sequence
-        self.index = None
-        if index:
-            self.index = GenomeIndex(index)
-   
+        self._init_index(index)
         self.cache_splice_stats = {}
         self.cache_feature_stats = {}
 
-    def _init_session(self, conn, new=False):
+    def _init_index(self, index):
+        """ index to retrieve sequence """
+        self.index = None
+        if index:
+            if GenomeStore.exists(index):
+                self.index = GenomeStore(index)
+            else:
+                self.index = GenomeIndex(index)
+
+    def _init_session(self, conn, new=False, bulk_load=False, in_memory=False):
+        if bulk_load:
+            if not conn.startswith("sqlite") or not new:
+                self.logger.debug("Bulk load only applies to new sqlite databases")
+                bulk_load = False
+            elif in_memory:
+                self.target = conn
+                conn = "sqlite://"
+        self.bulk_load = bulk_load
+        
         self.engine = create_engine(conn)
+        if self.bulk_load:
+            event.listen(self.engine, "connect", _set_bulk_load_pragmas)
         self.engine.raw_connection().connection.text_factory = str
         
-        # recreate database
+        # recreate database, or migrate an existing one
         if new:
-            Base.metadata.drop_all(self.engine)
-            Base.metadata.create_all(self.engine)
+            create_schema(self.engine)
+            if self.bulk_load:
+                # created by finish_load()
+                drop_indexes(self.engine)
+        elif upgrade_schema(self.engine):
+            self.logger.info("Upgraded database to schema version %s", 
+                    SCHEMA_VERSION)
         
         Base.metadata.bind =self.engine
         Session = scoped_session(sessionmaker(bind=self.engine))
         self.session = Session()
 
+    def finish_load(self):
+        """
+        End the bulk load. Creates the indexes, updates the query planner 
+        statistics and restores the default connection settings. An in
+        memory database is written to disk, the session is connected to
+        the database on disk afterwards.
+        """
+        if not self.bulk_load:
+            return
+        
+        self.session.commit()
+        self.logger.debug("Creating indexes")
+        create_indexes(self.engine)
+        analyze(self.engine)
+        event.remove(self.engine, "connect", _set_bulk_load_pragmas)
+        self.bulk_load = False
+        
+        if self.target:
+            target = self.target
+            self.target = None
+            self._write_database(target)
+            self.session.close()
+            self.engine.dispose()
+            self._init_session(target)
+
+    def _write_database(self, conn):
+        """ Write the (in-memory) SQLite database to conn """
+        fname = make_url(conn).database
+        self.logger.debug("Writing database to %s", fname)
+        if os.path.exists(fname):
+            os.unlink(fname)
+        
+        raw = self.engine.raw_connection()
+        source = raw.connection
+        if hasattr(source, "backup"):
+            # Online backup API, Python >= 3.7
+            target = sqlite3.connect(fname)
+            source.backup(target)
+            target.close()
+        else:
+            # Copy the tables to an attached database
+            engine = create_engine(conn)
+            create_schema(engine)
+            engine.dispose()
+            source.execute("ATTACH DATABASE ? AS target", (fname,))
+            for table in Base.metadata.sorted_tables:
+                if table.name == SchemaVersion.__tablename__:
+                    continue
+                source.execute(
+                        "INSERT INTO target.{0} SELECT * FROM main.{0}".\
+                        format(table.name))
+            source.commit()
+            source.execute("ANALYZE target")
+            source.execute("DETACH DATABASE target")
+        raw.close()
+
     def __enter__(self):
         return self
 
     def __exit__(self, _type, value, traceback):
+        self.close()
+
+    def close(self):
         self.session.close()
     
     def dump_yaml(self):
@@ -102,10 +219,11 @@ class AnnotationDb(object):
             source_map[old_id] = r.id
     
     
-        t = ["chrom","start","end","strand","ftype","seq"]
+        t = ["chrom","start","end","strand","ftype","seq","orf_length"]
         self.engine.execute(
             Feature.__table__.insert(),
-            [dict(zip(t, row[1:])) for row in data['feature']]
+            [dict(zip(t, row[1:7] + [feature_orf_length(row[5], row[6])])) 
+                for row in data['feature']]
             )
          
         self.session.commit()
@@ -151,8 +269,165 @@ class AnnotationDb(object):
         """
         Add a transcript to the database
         """
+        self.add_transcripts([[name, source, exons]])
 
-        # Sanity checks
+    def add_transcripts(self, transcripts, batch_size=TRANSCRIPT_BATCH_SIZE):
+        """
+        Add transcripts to the database in bulk
+
+        transcripts is an iterable of [name, source, exons] lists, as
+        returned by read_bed_transcripts() and read_gff_transcripts().
+        Transcripts are read in batches of batch_size. The features of a
+        batch are deduplicated in memory on (chrom, start, end, strand,
+        ftype) and written using a few executemany batches, only the ids
+        of features and evidence are kept between batches. Transcripts 
+        with bad splicing are skipped as a whole. A malformed transcript
+        raises a ValueError, the transcripts before it are stored.
+        """
+        ids = {}
+        transcripts = iter(transcripts)
+        while True:
+            batch = list(itertools.islice(transcripts, batch_size))
+            if not batch:
+                break
+            for i, (name, source, exons) in enumerate(batch):
+                try:
+                    self._check_exons(exons)
+                except ValueError:
+                    self._add_batch(batch[:i], ids)
+                    raise
+            self._add_batch(batch, ids)
+
+    def _add_batch(self, transcripts, ids):
+        features, evidences, links = self._collect_transcripts(transcripts)
+        if features:
+            self._store_transcripts(features, evidences, links, ids)
+
+    def _collect_transcripts(self, transcripts):
+        """
+        Check the splice sites of transcripts. Returns the features 
+        as dict of (chrom, start, end, strand, ftype) to sequence, the
+        evidence as dict of (name, source) and the links between them
+        as set of (feature key, evidence key).
+        """
+        features = {}
+        evidences = {}
+        links = set()
+        
+        # Retrieve the sequences of all exons at once
+        exon_seqs = {}
+        if self.index:
+            exon_seqs = self._get_exon_sequences(
+                    [exon for name, source, exons in transcripts for exon in exons])
+
+        # Score the splice sites of all transcripts at once
+        sites = []
+        for name, source, exons in transcripts:
+            seqs = []
+            if self.index:
+                seqs = [exon_seqs[tuple(exon)][0] for exon in exons]
+            sites.append(self._get_splice_sites(name, exons[0][-1], seqs, 
+                len(exons) - 1))
+        donor_scores = get_splice_scores([d for d, a in sites], 5)
+        acceptor_scores = get_splice_scores([a for d, a in sites], 3)
+
+        for (name, source, exons), (splice_donors, splice_acceptors), \
+                donor_score, acceptor_score in zip(transcripts, sites, 
+                        donor_scores, acceptor_scores):
+            chrom = exons[0][0]
+            strand = exons[0][-1]
+            
+            real_seqs = [""] * len(exons)
+            if self.index:
+                real_seqs = [exon_seqs[tuple(exon)][1] for exon in exons]
+            
+            introns = [(e1[2], e2[1]) for e1, e2 in zip(exons[0:-1], exons[1:])]
+            for start, end in introns:
+                self.logger.debug("%s %s %s %s", chrom, start, end, strand)
+            
+            if splice_donors or splice_acceptors:
+                if donor_score + acceptor_score < 0:
+                    self.logger.warning("Skipping %s, splicing not OK!", name)
+                    continue
+            
+            ev = (name, source)
+            evidences[ev] = 1
+            for exon, seq in zip(exons, real_seqs):
+                key = (chrom, exon[1], exon[2], strand, "exon")
+                if not features.get(key):
+                    features[key] = seq
+                links.add((key, ev))
+            for start, end in introns:
+                key = (chrom, start, end, strand, "splice_junction")
+                features.setdefault(key, "")
+                links.add((key, ev))
+        
+        return features, evidences, links
+
+    def _store_transcripts(self, features, evidences, links, ids=None):
+        """
+        Store the result of _collect_transcripts(). The ids of features 
+        and evidence are fetched once per chromosome and source, and kept
+        in the dict ids for the next call.
+        """
+        if ids is None:
+            ids = {}
+        feature_ids = ids.setdefault("features", {})
+        evidence_ids = ids.setdefault("evidence", {})
+        
+        # Features
+        chroms = set([key[0] for key in features])
+        new_chroms = chroms - ids.setdefault("chroms", set())
+        if new_chroms:
+            feature_ids.update(self._fetch_feature_ids(new_chroms))
+            ids["chroms"] |= new_chroms
+        t = ["chrom", "start", "end", "strand", "ftype", "seq", "orf_length"]
+        new_features = [dict(zip(t, key + (seq, 
+            feature_orf_length(key[4], seq)))) for key, seq in 
+                sorted(features.items()) if key not in feature_ids]
+        if new_features:
+            self.logger.debug("Inserting %s features", len(new_features))
+            max_id = self.max_feature_id()
+            self.session.execute(Feature.__table__.insert(), new_features)
+            feature_ids.update(self._fetch_feature_ids(chroms, max_id))
+        
+        # Evidence
+        sources = set([ev[1] for ev in evidences])
+        new_sources = sources - ids.setdefault("sources", set())
+        if new_sources:
+            evidence_ids.update(self._fetch_evidence_ids(new_sources))
+            ids["sources"] |= new_sources
+        old_evidences = [evidence_ids[ev] for ev in evidences 
+                if ev in evidence_ids]
+        new_evidences = [{"name":name, "source":source} for name, source in 
+                evidences if (name, source) not in evidence_ids]
+        if new_evidences:
+            self.logger.debug("Inserting %s evidence", len(new_evidences))
+            max_id = self.session.query(func.max(Evidence.id)).scalar() or 0
+            self.session.execute(Evidence.__table__.insert(), new_evidences)
+            evidence_ids.update(self._fetch_evidence_ids(sources, max_id))
+        
+        # Link features and evidence, only evidence that was already 
+        # stored can have links
+        existing = set()
+        for i in range(0, len(old_evidences), 500):
+            q = self.session.query(FeatureEvidence.feature_id, 
+                    FeatureEvidence.evidence_id).\
+                    filter(FeatureEvidence.evidence_id.in_(
+                        old_evidences[i:i + 500]))
+            existing.update([tuple(row) for row in q])
+        new_links = set([(feature_ids[key], evidence_ids[ev]) for key, ev in links])
+        new_links = [{"feature_id":f_id, "evidence_id":ev_id} for 
+                f_id, ev_id in new_links if (f_id, ev_id) not in existing]
+        if new_links:
+            self.session.execute(FeatureEvidence.__table__.insert(), new_links)
+        
+        self.session.commit()
+    
+    def _check_exons(self, exons):
+        """
+        Sanity checks on the exons of a transcript
+        """
         for e1, e2 in zip(exons[:-1], exons[1:]):
             if e1[0] != e2[0]:
                 sys.stderr.write("{0} - {1}\n".format(e1, e2))
@@ -163,50 +438,44 @@ class AnnotationDb(object):
             if e1[3] != e2[3]:
                 sys.stderr.write("{0} - {1}\n".format(e1, e2))
                 raise ValueError("strands don't match")
-       
-        chrom = exons[0][0]
-        strand = exons[0][-1]
-        
-        evidence = get_or_create(self.session, Evidence,
-                name = name,
-                source=source)
-
-        seqs = []
-        for exon in exons:
-            seq = ""
-            real_seq = ""
-            if self.index:
+    
+    def _get_exon_sequences(self, exons):
+        """
+        Return a dictionary with the exon sequences including 20 bp 
+        flanks, and the exon sequences themselves. If the flanks extend
+        beyond the chromosome, the flanked sequence is empty.
+        """
+        exons = sorted(set([tuple(exon) for exon in exons]))
+        seqs = {}
+        if isinstance(self.index, GenomeStore):
+            # Retrieve all exons of a chromosome in one go
+            for chrom in set([exon[0] for exon in exons]):
+                chrom_exons = [exon for exon in exons if exon[0] == chrom]
+                result = self.index.get_flanked_sequences(chrom, 
+                        [exon[1:3] for exon in chrom_exons],
+                        [exon[3] for exon in chrom_exons], 20)
+                seqs.update(zip(chrom_exons, result))
+        else:
+            for exon in exons:
+                chrom, start, end, strand = exon
                 seq = ""
+                real_seq = ""
                 try:                    
-                    seq = self.index.get_sequence(chrom, exon[1] - 20, exon[2] + 20, strand)
+                    seq = self.index.get_sequence(chrom, start - 20, end + 20, strand)
                     real_seq = seq[20:-20]
                 except Exception:
-                    real_seq = self.index.get_sequence(chrom, exon[1], exon[2], strand)
-                seqs.append(seq)
-            
-            exon = get_or_create(self.session, Feature,
-                             chrom = chrom,
-                             start = exon[1],
-                             end = exon[2],
-                             strand = strand,
-                             ftype = "exon",
-                             seq = real_seq
-                             ) 
-            exon.evidences.append(evidence)
+                    real_seq = self.index.get_sequence(chrom, start, end, strand)
+                seqs[exon] = (seq, real_seq)
+        return seqs
 
+    def _get_splice_sites(self, name, strand, seqs, n_introns):
+        """
+        Return the splice donor and acceptor sequences of a transcript 
+        based on the flanked exon sequences.
+        """
         splice_donors = []
         splice_acceptors = []
-        for i,(start,end) in enumerate([(e1[2], e2[1]) for e1, e2 in zip(exons[0:-1], exons[1:])]):
-            self.logger.debug("%s %s %s %s", chrom, start, end, strand)
-            sj = get_or_create(self.session, Feature,
-                             chrom = chrom,
-                             start = start,
-                             end = end,
-                             strand = strand,
-                             ftype = "splice_junction"
-                             )
-            sj.evidences.append(evidence)
-            
+        for i in range(n_introns):
             if strand == "+":
                 if len(seqs) > (i + 1) and len(seqs[i]) > 46:
                     splice_donors.append(["{}_{}".format(name, i + 1), seqs[i][-23:-14]])
@@ -221,41 +490,75 @@ class AnnotationDb(object):
                 if len(seqs) > (i + 1) and len(seqs[i]) > 46:
                     f = ["{}_{}".format(name, i + 1), seqs[i][:23]]
                     splice_acceptors.append(f)
-        
-        donor_score = get_splice_score(splice_donors, 5)
-        acceptor_score = get_splice_score(splice_acceptors, 3)
-        if donor_score + acceptor_score < 0:
-            self.logger.warning("Skipping %s, splicing not OK!", name)
-            self.session.rollback()
-        else:
-            self.session.commit()
+        return splice_donors, splice_acceptors
+
+    def _fetch_feature_ids(self, chroms, min_id=0):
+        q = self.session.query(Feature.id, Feature.chrom, Feature.start, 
+                Feature.end, Feature.strand, Feature.ftype).\
+                filter(Feature.chrom.in_(chroms)).\
+                filter(Feature.id > min_id)
+        return dict([(tuple(row[1:]), row[0]) for row in q])
     
-    def get_features(self, ftype=None, chrom=None, eager=False, 
-            min_length=None, max_length=None, evidence=0):
+    def _fetch_evidence_ids(self, sources, min_id=0):
+        q = self.session.query(Evidence.id, Evidence.name, Evidence.source).\
+                filter(Evidence.source.in_(sources)).\
+                filter(Evidence.id > min_id).\
+                order_by(Evidence.id.desc())
+        # like get_or_create, use the first matching evidence
+        return dict([((row[1], row[2]), row[0]) for row in q])
+    
+    def _feature_query(self, ftype=None, chrom=None, eager=False):
+        """ 
+        Query for unflagged features, with the number of evidence sources
+        and the summed read count of each feature as extra columns.
+        """
+        evidence = self.session.query(
+                FeatureEvidence.feature_id.label("feature_id"), 
+                func.count(FeatureEvidence.evidence_id).label("n")).\
+                group_by(FeatureEvidence.feature_id).subquery()
         
-        query = self.session.query(Feature)
-        query = query.filter(Feature.flag.op("IS NOT")(True))
-            
-        # pre-fetch associated read counts
+        reads = self.session.query(
+                FeatureReadCount.feature_id.label("feature_id"),
+                func.sum(FeatureReadCount.count).label("n")).\
+                group_by(FeatureReadCount.feature_id).subquery()
+        
+        n_evidence = func.coalesce(evidence.c.n, 0)
+        n_reads = reads.c.n
+        
+        query = self.session.query(Feature).\
+                outerjoin(evidence, evidence.c.feature_id == Feature.id).\
+                outerjoin(reads, reads.c.feature_id == Feature.id).\
+                filter(Feature.flag.op("IS NOT")(True))
+        
+        # pre-fetch associated read counts and evidence links
         if eager:
-            query = query.options(subqueryload('read_counts'))
+            query = query.options(subqueryload('read_counts'), 
+                    subqueryload('_evidences'))
         
         if chrom:
             query = query.filter(Feature.chrom == chrom)
         if ftype:
             query = query.filter(Feature.ftype == ftype)
-        features = [f for f in query]
         
-        # length filters
-        if max_length:
-            features = [f for f in features if
-                    f.length <= max_length or len(f.evidences) >= evidence]
+        return query, n_evidence, n_reads
 
-        if min_length:
-            features = [f for f in features if
-                    f.length >= min_length or len(f.evidences) >= evidence]
+    def get_features(self, ftype=None, chrom=None, eager=False, 
+            min_length=None, max_length=None, evidence=0):
         
-        return features
+        query, n_evidence, _ = self._feature_query(ftype, chrom, eager)
+        
+        # length filters, features with enough evidence are always kept;
+        # evidence=None keeps all features
+        if evidence is not None:
+            if max_length:
+                query = query.filter(or_(
+                    Feature.length <= max_length, n_evidence >= evidence))
+            if min_length:
+                query = query.filter(or_(
+                    Feature.length >= min_length, n_evidence >= evidence))
+        
+        return query.order_by(Feature.chrom, Feature.start, Feature.end, 
+                Feature.strand).all()
 
     def get_exons(self, chrom=None, eager=False, min_length=None, 
             max_length=None, evidence=0):
@@ -263,80 +566,40 @@ class AnnotationDb(object):
         return self.get_features(ftype="exon", chrom=chrom, eager=eager, 
                 min_length=min_length, max_length=max_length, evidence=evidence)
 
+    def get_features_by_id(self, ids):
+        """ Features with the given ids, in chunks of 500 ids per query """
+        ids = sorted(set(ids))
+        features = []
+        for i in range(0, len(ids), 500):
+            features += self.session.query(Feature).\
+                    filter(Feature.id.in_(ids[i:i + 500])).all()
+        return features
+
 
     def get_splice_junctions(self, chrom=None, ev_count=None, read_count=None, max_reads=None, eager=False):
+        
+        if not (ev_count and read_count) and not max_reads:
+            return self.get_features(ftype="splice_junction", chrom=chrom, eager=eager)
                 
-        features = []
+        query, n_evidence, n_reads = self._feature_query(
+                "splice_junction", chrom, eager)
+        
         if ev_count and read_count:
-            # All splices with no read, but more than one evidence source
-            fs = self.session.query(Feature).\
-                    filter(Feature.flag.op("IS NOT")(True)).\
-                    filter(Feature.ftype == "splice_junction").\
-                    filter(Feature.chrom == chrom).\
-                    outerjoin(FeatureReadCount).\
-                    group_by(Feature).\
-                    having(func.sum(FeatureReadCount.count) < read_count)
-
-            for splice in fs:
-                self.logger.debug("Considering %s", splice)        
-                for evidence in splice.evidences:
-                    self.logger.debug(str(evidence))
-                if len(splice.evidences) >= ev_count:
-                    features.append(splice)
-                else:
-                    self.logger.debug("not enough evidence for {}".format(splice))
-            
-            fs = self.session.query(Feature).\
-                    filter(Feature.flag.op("IS NOT")(True)).\
-                    filter(Feature.ftype == "splice_junction").\
-                    filter(Feature.chrom == chrom).\
-                    outerjoin(FeatureReadCount).\
-                    group_by(Feature).\
-                    having(func.sum(FeatureReadCount.count) == None)
-
-            for splice in fs:
-                self.logger.debug("Considering %s (no reads)", splice)        
-                for evidence in splice.evidences:
-                    self.logger.debug(str(evidence))
-                if len(splice.evidences) >= ev_count:
-                    features.append(splice)
-                else:
-                    self.logger.debug("not enough evidence for {}".format(splice))
-
-            # All splices with more than x reads
-            fs = self.session.query(Feature).\
-                    filter(Feature.flag.op("IS NOT")(True)).\
-                    filter(Feature.ftype == "splice_junction").\
-                    filter(Feature.chrom == chrom).\
-                    outerjoin(FeatureReadCount).\
-                    group_by(Feature).\
-                    having(func.sum(FeatureReadCount.count) >= read_count)
-            for f in fs:
-                self.logger.debug("Considering %s (reads)", f)        
-                features.append(f)
-            #features += [f for f in fs]
-        
-        elif max_reads:
-            fs = self.session.query(Feature).\
-                    filter(Feature.flag.op("IS NOT")(True)).\
-                    filter(Feature.ftype == "splice_junction").\
-                    filter(Feature.chrom == chrom).\
-                    outerjoin(FeatureReadCount).\
-                    group_by(Feature).\
-                    having(func.sum(FeatureReadCount.count) == None)
-
-            features += [f for f in fs if len(f.evidences) > 0]
-            fs = self.session.query(Feature).\
-                    filter(Feature.flag.op("IS NOT")(True)).\
-                    filter(Feature.ftype == "splice_junction").\
-                    filter(Feature.chrom == chrom).\
-                    outerjoin(FeatureReadCount).\
-                    group_by(Feature).\
-                    having(func.sum(FeatureReadCount.count) < max_reads)
-            features += [f for f in fs if len(f.evidences) > 0]  
+            # Splices with enough reads, or with less (or no) reads
+            # but enough evidence sources
+            query = query.filter(or_(
+                n_reads >= read_count, n_evidence >= ev_count))
+            order = case([
+                (n_reads < read_count, 0), 
+                (n_reads == None, 1)
+                ], else_=2)
         else:
-            features = self.get_features(ftype="splice_junction", chrom=chrom, eager=eager)
-        return features 
+            # Splices with less than max_reads, that have evidence
+            query = query.filter(n_evidence > 0).\
+                    filter(or_(n_reads == None, n_reads < max_reads))
+            order = case([(n_reads == None, 0)], else_=1)
+        
+        return query.order_by(order, Feature.id).all()
 
     def get_longest_3prime_exon(self, chrom, start5, strand):
         if strand == "+":
@@ -436,18 +699,67 @@ class AnnotationDb(object):
                 update({Feature.flag:True}, synchronize_session=False)
         self.session.commit()
         
-    def get_read_statistics(self, chrom, fnames, name, span="all", extend=(0,0), nreads=None):
+    def get_read_statistics(self, chrom, fnames, name, span="all", extend=(0,0), nreads=None, min_id=None):
+        """
+        Count reads of BAM files fnames in all exons of chrom, or only in
+        exons with an id larger than min_id.
+        """
 
         if span not in ["all", "start", "end"]:
             raise Exception("Incorrect span: {}".format(span))
         
-        tmp = NamedTemporaryFile(delete=False, suffix=".bed")
-        estore = {}
-        self.logger.debug("Writing exons to file %s", tmp.name)
         exons =  self.get_exons(chrom)
+        if min_id:
+            exons = [exon for exon in exons if exon.id > min_id]
         if len(exons) == 0:
             return
         
+        estore = self._read_windows(exons, span, extend)
+        
+        # Empty windows are skipped
+        windows = sorted([w for w in estore.keys() if w[1] > w[0]])
+        starts = [w[0] for w in windows]
+        ends = [w[1] for w in windows]
+
+        if type("") == type(fnames):
+            fnames = [fnames]
+
+        for i, fname in enumerate(fnames):
+            self.logger.debug("Creating read_source for %s %s", name, fname)
+            read_source = get_or_create(self.session, ReadSource, name=name, source=fname)
+            self.session.commit() 
+            if fname.endswith("bam") and (not nreads or not nreads[i]) \
+                    and not read_source.nreads:
+                self.logger.debug("Counting reads in %s", fname)
+                read_source.nreads = read_statistics(fname)
+
+            self.logger.debug("Counting reads in %s windows from %s", 
+                    len(windows), fname)
+            counts = count_reads(fname, chrom, starts, ends)
+            
+            insert_vals = []
+            for window, count in zip(windows, counts):
+                for exon_id in estore[window]:
+                    insert_vals.append({
+                        "read_source_id": read_source.id,
+                        "feature_id": exon_id,
+                        "count": float(count),
+                        "span": span,
+                        "extend_up": extend[0],
+                        "extend_down": extend[1],
+                        })
+            
+            if len(insert_vals) > 0:
+                self.session.execute(
+                        FeatureReadCount.__table__.insert(), insert_vals)
+            self.session.commit()
+
+    def _read_windows(self, exons, span, extend):
+        """
+        Windows to count reads in, as dict of (start, end) to a list of 
+        exon ids. Exons with the same window are counted once.
+        """
+        estore = {}
         for exon in exons:
             start = exon.start
             end = exon.end
@@ -471,93 +783,103 @@ class AnnotationDb(object):
             if start < 0:
                 start = 0
 
-            estr = "{}:{}-{}".format(exon.chrom, start, end)
-
-            if estr in estore:
-                estore[estr].append(exon)
-            else:
-                estore[estr] = [exon]
-                tmp.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                    exon.chrom,
-                    start,
-                    end,
-                    str(exon),
-                    0,
-                    exon.strand
-                ))
-        tmp.flush()
-
-        if type("") == type(fnames):
-            fnames = [fnames]
-
-        for i, fname in enumerate(fnames):
-            self.logger.debug("Creating read_source for %s %s", name, fname)
-            read_source = get_or_create(self.session, ReadSource, name=name, source=fname)
-            self.session.commit() 
-            #rmrepeats = False
-            if fname.endswith("bam") and (not nreads or not nreads[i]):
-                #rmrepeats = True
-                self.logger.debug("Counting reads in %s", fname)
-                read_source.nreads = read_statistics(fname)
-
-            self.logger.debug("Getting overlap from %s", fname)
-            t = BamTrack(fname)
-            result = t.binned_stats(tmp.name, 1, rpkm=False, rmdup=False, rmrepeats=False)
-
-            self.logger.debug("Reading results, save to exon stats")
-
-            insert_vals = []
-            for row in result:
-                try:
-                    vals = row.strip().split("\t")
-                    e = "%s:%s-%s" % (vals[0], vals[1], vals[2])
-                    c = float(vals[3])
-                    for exon in estore[e]:
-                        insert_vals.append([read_source.id, exon.id, c, span, extend[0], extend[1]])
-                except:
-                    self.logger.info("binned_stat line skipped: {}".format(row))
-            t =  ["read_source_id", "feature_id", "count", "span", "extend_up", "extend_down"]
-            result = self.engine.execute(
-                    FeatureReadCount.__table__.insert(),
-                    [dict(zip(t,row)) for row in insert_vals]
-                    )
-                
-        tmp.close()
+            estore.setdefault((start, end), []).append(exon.id)
+        return estore
 
-    def get_splice_statistics(self, chrom, fnames, name):
+    def get_splice_statistics(self, chrom, fnames, name, tabix_files=None):
+        """
+        Load splice junction read counts for chrom. Files are either
+        tabix-indexed, or tab-separated with chrom, start, end, count
+        and strand in column 1, 2, 3, 4 and 6. If dict tabix_files has
+        an indexed version of a file, that one is read.
+        """
         if type("") == type(fnames):
             fnames = [fnames]
+        if tabix_files is None:
+            tabix_files = {}
 
         for fname in fnames:
             self.logger.debug("Getting splicing data from %s", fname)
             read_source = get_or_create(self.session, 
                     ReadSource, name=name, source=fname)
             self.session.commit()
+            
+            counts = self._splice_counts(tabix_files.get(fname, fname), chrom)
+            if not counts:
+                continue
+            
+            # Add missing splice junctions
+            feature_ids = self._fetch_feature_ids([chrom])
+            t = ["chrom", "start", "end", "strand", "ftype"]
+            new_features = [dict(zip(t, key)) for key in sorted(counts.keys())
+                    if key not in feature_ids]
+            if new_features:
+                self.session.execute(Feature.__table__.insert(), new_features)
+                feature_ids = self._fetch_feature_ids([chrom])
+
+            # Update existing counts and insert new ones
+            q = self.session.query(FeatureReadCount.feature_id, FeatureReadCount.count).\
+                    join(Feature).\
+                    filter(Feature.chrom == chrom).\
+                    filter(FeatureReadCount.read_source_id == read_source.id)
+            existing = dict([(row[0], row[1]) for row in q])
+            
+            update_vals = []
+            insert_vals = []
+            for key, c in counts.items():
+                feature_id = feature_ids[key]
+                if feature_id in existing:
+                    update_vals.append({
+                        "f_id":feature_id, 
+                        "new_count":(existing[feature_id] or 0) + c,
+                        })
+                else:
+                    insert_vals.append({
+                        "read_source_id":read_source.id,
+                        "feature_id":feature_id, 
+                        "count":c,
+                        })
+            
+            self.logger.debug("Inserting %s and updating %s splice counts", 
+                    len(insert_vals), len(update_vals))
+            if insert_vals:
+                self.session.execute(FeatureReadCount.__table__.insert(), insert_vals)
+            if update_vals:
+                table = FeatureReadCount.__table__
+                self.session.execute(
+                        table.update().\
+                            where(table.c.feature_id == bindparam("f_id")).\
+                            where(table.c.read_source_id == read_source.id).\
+                            values(count=bindparam("new_count")),
+                        update_vals)
+            self.session.commit()    
+    
+    def _splice_counts(self, fname, chrom):
+        """ Sum the counts per splice junction """
+        counts = {}
+        for vals in self._read_splice_file(fname, chrom):
+            start, end, c = [int(x) for x in vals[1:4]]
+            strand = vals[5]
+            key = (chrom, start, end, strand, "splice_junction")
+            counts[key] = counts.get(key, 0) + c
+        return counts
+
+    def _read_splice_file(self, fname, chrom):
+        """
+        Yield the splice junction lines (as lists) of chrom. Tabix-indexed 
+        files are queried, other files are read completely.
+        """
+        if fname.endswith(".gz") and os.path.exists(fname + ".tbi"):
+            tabixfile = pysam.Tabixfile(fname)
+            if chrom in tabixfile.contigs:
+                for line in tabixfile.fetch(chrom):
+                    yield line.strip().split("\t")
+            tabixfile.close()
+        else:
             for line in open(fname):
                 vals = line.strip().split("\t")
                 if vals[0] == chrom:
-                    start, end, c = [int(x) for x in vals[1:4]]
-                    strand = vals[5]
-                    
-                    splice = get_or_create(self.session, Feature,
-                             chrom = chrom,
-                             start = start,
-                             end = end,
-                             strand = strand,
-                             ftype = "splice_junction"
-                             ) 
-                    self.session.commit()
-
-                    count = get_or_create(self.session, FeatureReadCount,
-                            feature_id = splice.id,
-                            read_source_id = read_source.id)
-                
-                    if not count.count:
-                        count.count = c
-                    else:
-                        count.count += c
-            
-                    self.session.commit()    
+                    yield vals
     
     def get_junction_exons(self, junction):
         
@@ -584,6 +906,39 @@ class AnnotationDb(object):
                 exon_pairs.append((e1, e2))
         return exon_pairs
 
+    def get_junction_exon_triples(self, chrom, junctions=None):
+        """
+        Return (junction, left exon, right exon) for all splice junctions
+        on chrom (all chromosomes if chrom is None), or for the junctions 
+        given. Exons are retrieved in one query and matched to the 
+        junctions by start and end.
+        """
+        if junctions is None:
+            junctions = self.get_splice_junctions(chrom)
+        
+        exons = self.session.query(Feature).\
+            filter(Feature.ftype == "exon").\
+            filter(Feature.flag.op("IS NOT")(True))
+        if chrom:
+            exons = exons.filter(Feature.chrom == chrom)
+        
+        by_end = {}
+        by_start = {}
+        for exon in exons:
+            by_end.setdefault(
+                    (exon.chrom, exon.strand, exon.end), []).append(exon)
+            by_start.setdefault(
+                    (exon.chrom, exon.strand, exon.start), []).append(exon)
+        
+        triples = []
+        for junction in junctions:
+            left = (junction.chrom, junction.strand, junction.start)
+            right = (junction.chrom, junction.strand, junction.end)
+            for e1 in by_end.get(left, []):
+                for e2 in by_start.get(right, []):
+                    triples.append((junction, e1, e2))
+        return triples
+
     def clear_stats_cache(self):
         self.cache_feature_stats = {}
         self.cache_splice_stats = {}
@@ -685,3 +1040,117 @@ class AnnotationDb(object):
         return stats
 
                    
+
+    def _source_key(self, chrom, kind, name, source, span=None, 
+            extend=(0, 0)):
+        if not isinstance(source, basestring):
+            source = ",".join(source)
+        return {"chrom":chrom, "kind":kind, "name":name, "source":source, 
+                "span":span, "extend_up":extend[0], "extend_down":extend[1]}
+
+    def is_loaded(self, chrom, kind, name, source, span=None, extend=(0, 0)):
+        """ 
+        Has the annotation (kind "annotation") or data (kind "data") been
+        loaded for chrom?
+        """
+        key = self._source_key(chrom, kind, name, source, span, extend)
+        return self.session.query(LoadedSource).filter_by(**key).\
+                first() is not None
+
+    def mark_loaded(self, chrom, kind, name, source, span=None, 
+            extend=(0, 0)):
+        """ Record that annotation or data was loaded, see is_loaded() """
+        key = self._source_key(chrom, kind, name, source, span, extend)
+        self.session.add(LoadedSource(**key))
+        self.session.commit()
+
+    def loaded_sources(self, chrom):
+        """ Annotation and data loaded for chrom, see mark_loaded() """
+        keys = ["chrom", "kind", "name", "source", "span", "extend_up", 
+                "extend_down"]
+        return [dict([(k, getattr(row, k)) for k in keys]) for row in 
+                self.session.query(LoadedSource).\
+                        filter(LoadedSource.chrom == chrom).\
+                        order_by(LoadedSource.id)]
+
+    def max_feature_id(self):
+        return self.session.query(func.max(Feature.id)).scalar() or 0
+
+    def max_ids(self):
+        """ Highest feature, evidence and read source id """
+        return [
+                self.max_feature_id(),
+                self.session.query(func.max(Evidence.id)).scalar() or 0,
+                self.session.query(func.max(ReadSource.id)).scalar() or 0,
+                ]
+
+    def get_model_run(self, chrom):
+        """
+        The last transcript calling of chrom (see store_model_run()) as 
+        dict, None if there is none.
+        """
+        run = self.session.query(ModelRun).filter(ModelRun.chrom == chrom).\
+                first()
+        if run is None:
+            return None
+        models = [[int(x) for x in row[0].split(",")] for row in 
+                self.session.query(CalledModel.exons).\
+                        filter(CalledModel.chrom == chrom).\
+                        order_by(CalledModel.id)]
+        return {
+                "config":run.config,
+                "max_values":yaml.safe_load(run.max_values),
+                "max_feature_id":run.max_feature_id,
+                "max_evidence_id":run.max_evidence_id,
+                "max_read_source_id":run.max_read_source_id,
+                "models":models,
+                }
+
+    def store_model_run(self, chrom, config, max_values, models):
+        """
+        Store the models of chrom, as lists of exon ids, together with the
+        settings and the maximum values they were called with.
+        """
+        self.session.query(CalledModel).\
+                filter(CalledModel.chrom == chrom).\
+                delete(synchronize_session=False)
+        self.session.query(ModelRun).filter(ModelRun.chrom == chrom).\
+                delete(synchronize_session=False)
+        max_feature_id, max_evidence_id, max_read_source_id = self.max_ids()
+        self.session.add(ModelRun(
+            chrom=chrom,
+            config=config,
+            max_values=yaml.safe_dump(dict([(k, float(v)) for k, v in 
+                max_values.items()])),
+            max_feature_id=max_feature_id,
+            max_evidence_id=max_evidence_id,
+            max_read_source_id=max_read_source_id,
+            ))
+        if models:
+            self.session.execute(CalledModel.__table__.insert(), 
+                    [{"chrom":chrom, "exons":",".join([str(x) for x in m])} 
+                        for m in models])
+        self.session.commit()
+
+    def get_changed_features(self, chrom, run):
+        """
+        Ids of the features of chrom that were added, or that got new 
+        evidence or read counts after the run (see get_model_run()).
+        """
+        changed = set()
+        q = self.session.query(Feature.id).\
+                filter(Feature.chrom == chrom).\
+                filter(Feature.id > run["max_feature_id"])
+        changed.update([row[0] for row in q])
+        q = self.session.query(FeatureEvidence.feature_id).\
+                join(Feature).\
+                filter(Feature.chrom == chrom).\
+                filter(FeatureEvidence.evidence_id > run["max_evidence_id"])
+        changed.update([row[0] for row in q])
+        q = self.session.query(FeatureReadCount.feature_id).\
+                join(Feature).\
+                filter(Feature.chrom == chrom).\
+                filter(FeatureReadCount.read_source_id > 
+                        run["max_read_source_id"])
+        changed.update([row[0] for row in q])
+        return changed
@@ -0,0 +1,59 @@
+"""
+Growable NumPy columns and string codes, used to store features and
+graphs in arrays.
+"""
+import numpy as np
+
+class Column(object):
+    """ NumPy array that grows when values are appended """
+    def __init__(self, dtype):
+        self.data = np.zeros(1024, dtype=dtype)
+        self.n = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        size = self.data.shape[0]
+        while self.n + len(values) > size:
+            size *= 2
+        if size > self.data.shape[0]:
+            data = np.zeros(size, dtype=self.data.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+        self.data[self.n:self.n + len(values)] = values
+        self.n += len(values)
+
+    def append(self, value):
+        if self.n == self.data.shape[0]:
+            data = np.zeros(2 * self.n, dtype=self.data.dtype)
+            data[:self.n] = self.data
+            self.data = data
+        self.data[self.n] = value
+        self.n += 1
+
+    @property
+    def values(self):
+        return self.data[:self.n]
+
+    def __len__(self):
+        return self.n
+
+class Codes(object):
+    """ Strings stored as integer codes """
+    def __init__(self):
+        self.names = []
+        self.codes = {}
+
+    def encode(self, name):
+        if name not in self.codes:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+        return self.codes[name]
+
+    def get(self, name):
+        return self.codes.get(name, -1)
+
+    def ranks(self):
+        """ Sort rank of every code """
+        ranks = np.zeros(len(self.names), dtype=np.int64)
+        ranks[np.argsort(self.names)] = np.arange(len(self.names))
+        return ranks
@@ -50,7 +50,7 @@ def compare_annotation_files(fname1, fname2):
     file2 = open(fname2)
 
     data1 = read_bed_transcripts(file1)
-    data2 = read_bed_transcripts(file2)
+    data2 = list(read_bed_transcripts(file2))
        
     result = compare_annotation(data1, data2)
     for t2, x, exons in data2:
@@ -3,7 +3,7 @@ import yaml
 import os
 import sys
 import pysam
-from pita.io import _create_tabix
+from pita.io import _create_tabix, TabixCache
 
 SAMTOOLS = "samtools"
 TSS_FOUND = "v"
@@ -13,6 +13,7 @@ TSS_NOTFOUND = "x"
 SEP = ":::"
 VALID_TYPES = ["bed", "gff", "gff3", "gtf"]
 DEBUG_LEVELS = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
+MAXENT_CACHE_SIZE = 1000000
 
 class PitaConfig(object):
     def __init__(self):
@@ -21,8 +22,18 @@ class PitaConfig(object):
         self.logger = logging.getLogger("pita")
         
         self.maxentpath = ""
+        self.maxent_cache = None
+        self.maxent_cache_size = MAXENT_CACHE_SIZE
+        self.bulk_load = False
+        self.incremental = False
+        self.snapshot_dir = None
+        self.sweep = []
+        self.alternatives = 0
+        self.tabix_cache = None
+        self.genome_store = None
+        self.threads = 1
 
-    def load(self, fname,  reannotate=False):
+    def load(self, fname,  reannotate=False, threads=1):
         # Parse YAML config file
         f = open(fname, "r")
         self.config = yaml.load(f)
@@ -32,6 +43,34 @@ class PitaConfig(object):
         if "database" in self.config:
             self.db_conn = self.config["database"]
         
+        # Load sqlite databases with fast settings (True), and build 
+        # them in memory ("memory")
+        self.bulk_load = self.config.get("bulk_load", False)
+        
+        # Keep an existing database, load only new annotation and data 
+        # and reuse the models of unchanged components
+        self.incremental = self.config.get("incremental", False)
+        
+        # Directory with a snapshot of the graph of every chromosome, 
+        # used to reannotate with other scoring settings
+        self.snapshot_dir = self.config.get("graph_snapshots", None)
+        if self.snapshot_dir and not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        
+        # Processes used to sort input files
+        self.threads = threads
+
+        # Reuse the tabix files of unchanged input files
+        self.tabix_cache = None
+        if self.config.get("tabix_cache", None):
+            self.tabix_cache = TabixCache(
+                    os.path.expanduser(self.config["tabix_cache"]))
+        
+        # Directory of the packed genome, see pita.genome.get_genome_store()
+        self.genome_store = None
+        if self.config.get("genome_store", None):
+            self.genome_store = os.path.expanduser(self.config["genome_store"])
+        
         # Data directory
         self.base = "."
         if "data_path" in self.config:
@@ -50,6 +89,13 @@ class PitaConfig(object):
         self.maxentpath = "" 
         if "maxent" in self.config:
             self.maxentpath = self.config["maxent"]
+        
+        # On-disk cache of splice site scores, shared by all workers
+        self.maxent_cache = None 
+        if "maxent_cache" in self.config:
+            self.maxent_cache = self.config["maxent_cache"]
+        self.maxent_cache_size = self.config.get("maxent_cache_size", 
+                MAXENT_CACHE_SIZE)
             
         # Pita UTR
         self.pitaUTR = False
@@ -60,6 +106,14 @@ class PitaConfig(object):
         self.weight = {}
         if "scoring" in self.config:
             self.weight = self.config["scoring"]
+        
+        # Scoring configurations of a weight sweep, as (name, scoring)
+        self.sweep = []
+        for i, d in enumerate(self.config.get("sweep", None) or []):
+            self.sweep.append((str(d.get("name", i + 1)), d["scoring"]))
+        
+        # Number of alternative models per locus, 0 to call the best models
+        self.alternatives = int(self.config.get("alternatives", 0) or 0)
 
         self._parse_repeats()
        
@@ -75,17 +129,23 @@ class PitaConfig(object):
                 self.chroms = [self.config["chromosomes"]]
 
         # check the data files
-        self._check_data_files()
+        self._check_data_files(reannotate)
         
         # output option
         self.min_protein_size = 20 
     
+    def _tabix(self, fname, ftype):
+        """ Sorted, compressed and indexed version of fname """
+        if self.tabix_cache:
+            return self.tabix_cache.tabix(fname, ftype, self.threads)
+        return _create_tabix(fname, ftype, self.threads)
+
     def _parse_repeats(self):
         self.repeats = []
         if "repeats"in self.config:
             for d in self.config["repeats"]:
                 fname = os.path.join(self.base, d["path"])
-                tabix_fname = _create_tabix(fname, "bed")
+                tabix_fname = self._tabix(fname, "bed")
                 d["path"] = fname
                 d["tabix"] = tabix_fname
  
@@ -125,7 +185,7 @@ class PitaConfig(object):
             else:
                 tabix_file = ""
                 if not reannotate:
-                    tabix_file = _create_tabix(fname, t)
+                    tabix_file = self._tabix(fname, t)
                     
                     # Save chromosome names
                     for chrom in pysam.Tabixfile(tabix_file).contigs:
@@ -134,10 +194,11 @@ class PitaConfig(object):
                 # Add file info
                 self.anno_files.append([d["name"], fname, tabix_file, t, min_exons])
        
-    def _check_data_files(self):
+    def _check_data_files(self, reannotate=False):
         # data  config
         self.logger.info("Checking data files")
         self.data = []
+        self.tabix_files = {}
         if self.config.has_key("data") and self.config["data"]:
             for d in self.config["data"]:
                 self.logger.debug("data: %s", d)
@@ -165,6 +226,14 @@ class PitaConfig(object):
                     #    names_and_stats.append((fname, read_statistics(fname)))
                     #else:
                      #   names_and_stats.append((fname, None))
+                
+                # Index splice files once, so that every chromosome
+                # only reads its own splice junctions. The data is still
+                # identified by the original file name.
+                if d["feature"] == "splice" and not reannotate:
+                    for fname in fnames:
+                        self.tabix_files[fname] = self._tabix(fname, "bed")
+
                 row = [d["name"], fnames, d["feature"], (int(d["up"]), int(d["down"]))]
                 self.data.append(row)
 
@@ -1,8 +1,8 @@
 from warnings import warn
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, UniqueConstraint, Boolean
+from sqlalchemy import Column, ForeignKey, Integer, String, Text, UniqueConstraint, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship,sessionmaker,scoped_session
-from sqlalchemy import and_, event
+from sqlalchemy import and_, event, inspect
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
@@ -11,6 +11,9 @@ from pita.exon import Exon
 
 Base = declarative_base()
 
+# Increase when the schema changes, and add a migration to MIGRATIONS
+SCHEMA_VERSION = 3
+
 class FeatureEvidence(Base):
     __tablename__ = 'feature_evidence'
     feature_id = Column(Integer, ForeignKey('feature.id'), primary_key=True)
@@ -18,35 +21,11 @@ class FeatureEvidence(Base):
     evidence = relationship("Evidence")
     feature = relationship("Feature")
 
-class Feature(Base):
-    __tablename__ = 'feature'
-    __table_args__ = (
-             UniqueConstraint(
-                'chrom', 
-                'start', 
-                'end', 
-                'strand', 
-                'ftype',
-                name='uix_1'),
-            )
-    id = Column(Integer, primary_key=True)
-    chrom = Column(String(250), nullable=False) 
-    start = Column(Integer, nullable=False) 
-    end = Column(Integer, nullable=False)
-    strand = Column(String(1), nullable=False)
-    ftype = Column(String(250), nullable=False) 
-    seq = Column(Text(), default="") 
-    flag = Column(Boolean(), default=False)
-    _evidences = relationship('FeatureEvidence')
-    evidences = association_proxy('_evidences', 'evidence',
-                    creator=lambda _i: FeatureEvidence(evidence=_i),
-                )
-    read_counts = relationship('FeatureReadCount')
-   
-    @hybrid_property
-    def length(self):
-        return self.end - self.start
-
+class FeatureMixin(object):
+    """ 
+    Methods shared by all feature classes, which have chrom, start, end,
+    strand, ftype and seq attributes.
+    """
     def __str__(self):
         return self.to_loc()
     
@@ -95,6 +74,42 @@ class Feature(Base):
             return exon.end - self.start
         return 0
 
+class Feature(FeatureMixin, Base):
+    __tablename__ = 'feature'
+    __table_args__ = (
+             UniqueConstraint(
+                'chrom', 
+                'start', 
+                'end', 
+                'strand', 
+                'ftype',
+                name='uix_1'),
+            # Lookups of splice junctions and flanking exons
+            Index('ix_feature_start', 
+                'chrom', 'ftype', 'strand', 'start', 'end', 'flag'),
+            Index('ix_feature_end', 
+                'chrom', 'ftype', 'strand', 'end', 'start', 'flag'),
+            )
+    id = Column(Integer, primary_key=True)
+    chrom = Column(String(250), nullable=False) 
+    start = Column(Integer, nullable=False) 
+    end = Column(Integer, nullable=False)
+    strand = Column(String(1), nullable=False)
+    ftype = Column(String(250), nullable=False) 
+    seq = Column(Text(), default="") 
+    flag = Column(Boolean(), default=False)
+    # Longest ORF of exons, calculated when they're added
+    orf_length = Column(Integer)
+    _evidences = relationship('FeatureEvidence')
+    evidences = association_proxy('_evidences', 'evidence',
+                    creator=lambda _i: FeatureEvidence(evidence=_i),
+                )
+    read_counts = relationship('FeatureReadCount')
+   
+    @hybrid_property
+    def length(self):
+        return self.end - self.start
+
 class Evidence(Base):
     __tablename__ = "evidence"
     id = Column(Integer, primary_key=True)
@@ -110,6 +125,10 @@ class ReadSource(Base):
 
 class FeatureReadCount(Base):
     __tablename__ = "read_count"
+    __table_args__ = (
+            Index('ix_read_count_feature', 
+                'feature_id', 'read_source_id', 'count'),
+            )
     read_source_id = Column(Integer, ForeignKey('read_source.id'), primary_key=True)
     feature_id = Column(Integer, ForeignKey('feature.id'), primary_key=True)
     read_source = relationship("ReadSource")
@@ -119,6 +138,124 @@ class FeatureReadCount(Base):
     extend_up = Column(Integer, default=0, primary_key=True)
     extend_down = Column(Integer, default=0, primary_key=True)
 
+class LoadedSource(Base):
+    """ Annotation or data file that was loaded for a chromosome """
+    __tablename__ = "loaded_source"
+    id = Column(Integer, primary_key=True)
+    chrom = Column(String(250), nullable=False)
+    kind = Column(String(50), nullable=False)
+    name = Column(String(250))
+    source = Column(Text())
+    span = Column(String(50))
+    extend_up = Column(Integer, default=0)
+    extend_down = Column(Integer, default=0)
+
+class ModelRun(Base):
+    """
+    Last transcript calling of a chromosome: a hash of the settings, the
+    maximum values used for normalization (as YAML) and the last ids at
+    the time, to find the features that changed since.
+    """
+    __tablename__ = "model_run"
+    chrom = Column(String(250), primary_key=True)
+    config = Column(String(64))
+    max_values = Column(Text())
+    max_feature_id = Column(Integer, default=0)
+    max_evidence_id = Column(Integer, default=0)
+    max_read_source_id = Column(Integer, default=0)
+
+class CalledModel(Base):
+    """ Model of the last run, as comma-separated exon ids """
+    __tablename__ = "called_model"
+    id = Column(Integer, primary_key=True)
+    chrom = Column(String(250), nullable=False, index=True)
+    exons = Column(Text())
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+
+def create_indexes(engine):
+    """ Create indexes that are missing from existing tables """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = [ix["name"] for ix in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+def drop_indexes(engine):
+    """ Drop indexes, for instance to create them after a bulk load """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = [ix["name"] for ix in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(engine)
+
+def create_tables(engine):
+    """ Create the tables that don't exist yet """
+    Base.metadata.create_all(engine)
+
+def add_orf_length(engine):
+    """ Add the orf_length column, NULL for existing features """
+    columns = [c["name"] for c in inspect(engine).get_columns("feature")]
+    if "orf_length" not in columns:
+        engine.execute("ALTER TABLE feature ADD COLUMN orf_length INTEGER")
+
+# (version, migration) in order, migrations should be idempotent
+MIGRATIONS = [
+        (1, create_indexes),
+        (2, add_orf_length),
+        (3, create_tables),
+        ]
+
+def get_schema_version(engine):
+    """ Schema version of the database, 0 if it is not versioned """
+    if not engine.has_table(SchemaVersion.__tablename__):
+        return 0
+    version = engine.execute(
+            "SELECT MAX(version) FROM {}".format(SchemaVersion.__tablename__)
+            ).scalar()
+    return version or 0
+
+def _set_schema_version(engine, version):
+    table = SchemaVersion.__table__
+    engine.execute(table.delete())
+    engine.execute(table.insert(), version=version)
+
+def analyze(engine):
+    """ Update the statistics used by the query planner """
+    if engine.dialect.name == "sqlite":
+        engine.execute("ANALYZE")
+    elif engine.dialect.name == "mysql":
+        engine.execute("ANALYZE TABLE {}".format(
+            ", ".join([t.name for t in Base.metadata.sorted_tables])))
+
+def create_schema(engine):
+    """ (Re)create all tables at the current schema version """
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    _set_schema_version(engine, SCHEMA_VERSION)
+
+def upgrade_schema(engine):
+    """ 
+    Migrate an existing database in place to the current schema version.
+    Returns True if the database was changed.
+    """
+    version = get_schema_version(engine)
+    if version >= SCHEMA_VERSION:
+        return False
+
+    # Creates missing tables, existing tables are not changed
+    Base.metadata.create_all(engine)
+    for v, migrate in MIGRATIONS:
+        if v > version:
+            migrate(engine)
+    _set_schema_version(engine, SCHEMA_VERSION)
+    analyze(engine)
+    return True
+
 def get_or_create(session, model, **kwargs):
     instance = session.query(model).filter_by(**kwargs).first()
     if instance:
@@ -1,4 +1,7 @@
 from itertools import izip
+from collections import deque, OrderedDict
+import heapq
+import multiprocessing as mp
 import logging
 import random
 import re
@@ -8,18 +11,159 @@ import networkx as nx
 from networkx.algorithms.connectivity import minimum_st_node_cut
 from networkx.algorithms.flow import edmonds_karp
 
-from pita.util import longest_orf,exons_to_seq
+from pita.util import orf_length,exons_to_seq
+from pita.graph import FeatureGraph, NODE_TYPES, EDGE_TYPES, SOURCE, SINK
+
+# Prefix of the raw read counts of a read source
+READS = "reads:"
+
+def _topological_order(edges):
+    """
+    Successors of every node and the topological order (Kahn) of a graph
+    given as a list of (u, v, weight) edges. The order is None if the 
+    graph contains a cycle.
+    """
+    succ = OrderedDict()
+    in_degree = {}
+    for u, v, w in edges:
+        succ.setdefault(u, []).append((v, w))
+        succ.setdefault(v, [])
+        in_degree[v] = in_degree.get(v, 0) + 1
+    
+    queue = deque([node for node in succ if not in_degree.get(node)])
+    order = []
+    while queue:
+        u = queue.popleft()
+        order.append(u)
+        for v, w in succ[u]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                queue.append(v)
+    
+    if len(order) < len(succ):
+        return succ, None
+    return succ, order
+
+def shortest_path_dag(source, edges):
+    """
+    Shortest paths from source in an acyclic graph, given as a list of
+    (u, v, weight) edges. Returns the predecessor of each reachable node,
+    as nx.bellman_ford. The nodes are relaxed in topological order, so 
+    every edge is visited once. Falls back to Bellman-Ford on a cycle.
+    """
+    succ, order = _topological_order(edges)
+    if order is None:
+        logging.getLogger("pita").warning(
+                "Cycle in graph of %s, using Bellman-Ford", source)
+        graph = nx.DiGraph()
+        for u, v, w in edges:
+            graph.add_edge(u, v, weight=w)
+        pred, dist = nx.bellman_ford(graph, source)
+        return pred
+    
+    inf = float('inf')
+    dist = {source: 0}
+    pred = {source: None}
+    for u in order:
+        if u not in dist:
+            continue
+        dist_u = dist[u]
+        for v, w in succ[u]:
+            dist_v = dist_u + w
+            if dist_v < dist.get(v, inf):
+                dist[v] = dist_v
+                pred[v] = u
+    return pred
+
+def k_shortest_paths_dag(source, sink, edges, k):
+    """
+    The k shortest paths from source to sink in an acyclic graph, given 
+    as a list of (u, v, weight) edges. Every node keeps its k shortest
+    paths from the source as (distance, predecessor, index of the path 
+    of the predecessor), so every edge is visited once. Returns a list 
+    of (distance, nodes) with the nodes from the sink to the source,
+    excluding the sink, shortest first. With k = 1 this is the path of
+    shortest_path_dag().
+    """
+    succ, order = _topological_order(edges)
+    if order is None:
+        # Only the best path, using Bellman-Ford
+        pred = shortest_path_dag(source, edges)
+        if sink not in pred:
+            return []
+        weight = dict([((u, v), w) for u, v, w in edges])
+        nodes = _pred_to_path(pred, sink)
+        dist = sum([weight[(u, v)] for u, v in zip(nodes, 
+            [sink] + nodes[:-1])])
+        return [(dist, nodes)]
+
+    paths = {source: [(0, None, 0)]}
+    candidates = {}
+    for u in order:
+        if u != source:
+            if u not in candidates:
+                continue
+            # Stable, so ties are resolved as in shortest_path_dag()
+            paths[u] = heapq.nsmallest(k, candidates.pop(u), 
+                    key=lambda c: c[0])
+        for v, w in succ[u]:
+            candidates.setdefault(v, []).extend(
+                    [(dist + w, u, i) for i, (dist, p, j) in 
+                        enumerate(paths[u])])
+    
+    result = []
+    for dist, p, i in paths.get(sink, []):
+        nodes = []
+        while p is not None:
+            nodes.append(p)
+            dist_p, p, i = paths[p][i]
+        result.append((dist, nodes))
+    return result
+
+def _pred_to_path(pred, sink):
+    """ Nodes from the sink to the source, excluding the sink """
+    t = sink
+    path = []
+    while pred[t] is not None:
+        path.append(pred[t])
+        t = pred[t]
+    return path
+
+def solve_component(problem):
+    """
+    Best path of one component, as created by 
+    DbCollection._component_problems. Returns the nodes from the sink to
+    the source, excluding the sink, or None if the sink can't be reached.
+    Module-level, so it can be used in a multiprocessing pool.
+    """
+    source, sink, edges = problem
+    pred = shortest_path_dag(source, edges)
+    if not pred.has_key(sink):
+        return None
+    return _pred_to_path(pred, sink)
+
+def solve_component_k(problem):
+    """
+    The k best paths of a component, as (source, sink, edges, k), see
+    k_shortest_paths_dag().
+    """
+    source, sink, edges, k = problem
+    return k_shortest_paths_dag(source, sink, edges, k)
 
 class DbCollection(object):
-    def __init__(self, db, weights, prune=None, chrom=None):
-        # dict with chrom as key
+    def __init__(self, db, weights, prune=None, chrom=None, graph=None):
+        """
+        Graph of the features of chrom in db, or of an existing graph, 
+        such as a graph loaded with load(). The features are scored 
+        according to weights.
+        """
         self.logger = logging.getLogger("pita")
 
         self.db = db
         self.chrom = chrom
 
         # All transcript models will be stored as a directed (acyclic) graph
-        self.graph = nx.DiGraph()
+        self.graph = FeatureGraph()
 
         # Store read counts of BAM files
         self.nreads = {}
@@ -27,17 +171,50 @@ class DbCollection(object):
         # Store extension used in BAM statistics
         self.extend = {}
 
+        # Source and sink of every component, added when scoring
+        self.terminals = None
+
+        # Features in the graph by id 
+        self.features = {}
+
         # store maximum weight per type
         self.max_id_value = {}
-        for iw in weights:
-            identifier = iw["name"]
-            self.max_id_value[identifier] = 0
+        self.weights = None
         
-        # Load the exons
-        self._load_exons(weights, chrom=chrom, prune=prune)
+        if graph is None:
+            # Load the exons
+            self._load_exons(weights, chrom=chrom, prune=prune)
+            
+            # Load the introns
+            self._load_splice_junctions(weights, chrom=chrom, prune=prune)
+        else:
+            self.graph = graph
+            ids = graph.edge_feature.values
+            for feature in self.db.get_features_by_id(ids[ids >= 0]):
+                self.features[feature.id] = feature
         
-        # Load the introns
-        self._load_splice_junctions(weights, chrom=chrom, prune=prune)
+        self._set_weights(weights)
+
+    def save(self, fname, **extra):
+        """
+        Save the graph with the raw evidence values of all features to 
+        file fname, see FeatureGraph.save(). 
+        """
+        if self.terminals is not None:
+            extra["terminals"] = np.array(self.terminals, dtype=np.int64)
+        self.graph.save(fname, **extra)
+    
+    @classmethod
+    def load(cls, fname, db, weights, chrom=None):
+        """ 
+        Collection of a graph saved with save(), with the features of db. 
+        Returns the collection and the extra arrays saved with it.
+        """
+        graph, extra = FeatureGraph.load(fname)
+        c = cls(db, weights, chrom=chrom, graph=graph)
+        if "terminals" in extra:
+            c.terminals = [tuple(t) for t in extra.pop("terminals").tolist()]
+        return c, extra
 
     def _load_exons(self, weights, chrom=None, prune=None):
         """
@@ -84,129 +261,287 @@ class DbCollection(object):
                     ev)
         
         # Load splice junctions    
-        n = 0
-        for junction in self.db.get_splice_junctions(chrom, 
-                ev_count=ev, read_count=min_reads, eager=True):
-            n += 1
-            self.add_feature(junction, weights)
-        self.logger.debug("%s introns were loaded", n)
-
-    def add_feature(self, feature, weights):
+        junctions = self.db.get_splice_junctions(chrom, 
+                ev_count=ev, read_count=min_reads, eager=True)
+        
+        # Flanking exons of all junctions at once
+        exon_pairs = dict([(junction.id, []) for junction in junctions])
+        for junction, e1, e2 in self.db.get_junction_exon_triples(
+                chrom, junctions):
+            exon_pairs[junction.id].append((e1, e2))
+        
+        for junction in junctions:
+            self.add_feature(junction, weights, exon_pairs[junction.id])
+        self.logger.debug("%s introns were loaded", len(junctions))
+
+    def add_feature(self, feature, weights, exon_pairs=None):
         """ 
-        Add feature to the graph
+        Add feature to the graph. The exons flanking a splice junction
+        are retrieved from the database, unless exon_pairs is specified.
         """
+        self.features[feature.id] = feature
 
         # Exon
         if feature.ftype == "exon":
-            nodes = [
-                    (feature.in_node(), "exon_in"), 
-                    (feature.out_node(), "exon_out"),
-                    ]
-            for node,ftype in nodes:
-                f = self.graph.add_node(node, ftype=ftype)
-            self.graph.add_path([n[0] for n in nodes], 
-                    weight=-1, ftype='exon')
-            self._set_edge_weight(feature, nodes[0][0], nodes[1][0], weights)
+            n1, n2 = self.graph.feature_nodes(feature, 
+                    ntypes=("exon_in", "exon_out"))
+            edge = self.graph.add_edge(n1, n2, "exon", feature.id)
+            self._set_edge_values(feature, edge, weights)
         # Intron
         elif feature.ftype == "splice_junction":
-            for e1,e2 in self.db.get_junction_exons(feature):
+            if exon_pairs is None:
+                exon_pairs = self.db.get_junction_exons(feature)
+            for e1,e2 in exon_pairs:
                 if e1.strand == "-":
                     e1,e2 = e2,e1
-                self.graph.add_path((e1.out_node(), e2.in_node()), 
-                        ftype="splice_junction", weight=-1)
-                self._set_edge_weight(feature, e1.out_node(), e2.in_node(), weights)
+                n1 = self.graph.feature_nodes(e1)[1]
+                n2 = self.graph.feature_nodes(e2)[0]
+                edge = self.graph.add_edge(n1, n2, "splice_junction", 
+                        feature.id)
+                self._set_edge_values(feature, edge, weights)
 
-    def get_best_variants(self, weights):
+    def get_best_variants(self, weights, threads=1, previous=None):
+        """
+        Yield the best model of every connected component, in genomic 
+        order. With threads > 1 the components are solved in a process
+        pool. Daemonic processes can't have children, so within a pool
+        worker the components are always solved serially.
+
+        previous is a dict with the models of an earlier run as lists of
+        exon ids ("models"), the ids of the features that were changed 
+        since ("changed") and the maximum values of the run 
+        ("max_values"). The previous models of components without changed
+        features are yielded instead of solving them again.
+        """
+        g = self.graph
+        if g.n_nodes == 0:
+            return
+
+        self._score(weights)
+        problems = self._component_problems()
+        reuse = self._previous_models(problems, previous)
+        
+        labels = g.component_labels()
+        solve = [p for p in problems if labels[p[0]] not in reuse]
+        solved = iter(self._solve(solve_component, solve, threads))
+        for problem in problems:
+            label = labels[problem[0]]
+            if label in reuse:
+                for model in reuse[label]:
+                    yield model
+                continue
+            best_variant = next(solved)
+            if not best_variant:
+                continue
+            model = self._path_to_model(best_variant)
+            if len(model) > 0:
+                yield model
+    
+    def _previous_models(self, problems, previous):
+        """
+        Models of previous (see get_best_variants()) per component label, 
+        for all components that don't contain changed features.
+        """
+        if not previous:
+            return {}
+        max_values = previous["max_values"] or {}
+        if sorted(max_values.items()) != \
+                sorted([(k, float(v)) for k, v in self.max_id_value.items()]):
+            self.logger.info("Maximum values changed, calling all models")
+            return {}
+
+        g = self.graph
+        labels = g.component_labels()
+        edges = g.active_edges()
+        changed = np.in1d(g.edge_feature.values[edges], 
+                np.array(sorted(previous["changed"]), dtype=np.int64))
+        dirty = set(labels[g.edge_src.values[edges[changed]]].tolist())
+
+        reuse = {}
+        for problem in problems:
+            label = labels[problem[0]]
+            if label not in dirty:
+                reuse[label] = []
+        for exon_ids in previous["models"]:
+            exons = [self.features.get(exon_id) for exon_id in exon_ids]
+            if None in exons:
+                continue
+            node = g.feature_nodes(exons[0], add=False)[0]
+            if node < 0:
+                continue
+            label = labels[node]
+            if label in reuse:
+                reuse[label].append(exons)
+
+        # Solve components without a previous model
+        reuse = dict([(k, v) for k, v in reuse.items() if len(v) > 0])
+        self.logger.info("Reusing the models of %s of %s components", 
+                len(reuse), len(problems))
+        return reuse
+    
+    def get_k_best_variants(self, weights, k, threads=1):
+        """
+        Yield the k best distinct models of every connected component, as
+        list of (weight, model) with the best model first. The weight is 
+        the total weight of the path, as returned by get_weight(): lower
+        is better. With k = 1 the model is the one of get_best_variants().
+        """
+        g = self.graph
+        if g.n_nodes == 0:
+            return
 
+        self._score(weights)
+        problems = [problem + (k,) for problem in self._component_problems()]
+        for paths in self._solve(solve_component_k, problems, threads):
+            models = []
+            for dist, path in paths:
+                model = self._path_to_model(path)
+                if len(model) > 0:
+                    models.append((self.get_weight(model), model))
+            if len(models) > 0:
+                yield models
+    
+    def _score(self, weights):
+        """
+        Connect every component to a source and a sink, and calculate the
+        weight of all edges.
+        """
+        g = self.graph
+        
         iweight = {}
         for iw in weights:
             identifier = iw["name"]
             weight = iw["weight"]
             iweight[identifier] = weight
 
-        add = {}
-        add_ends = []
-        for i,model in enumerate(nx.weakly_connected_components(self.graph)):
-            source = "source_{}".format(i + 1)
-            sink = "sink_{}".format(i + 1)
-            ends = [k for k,v in self.graph.out_degree(model).items() 
-                    if self.graph.node[k].get('ftype', "") == "exon_out" and v == 0]
-            for end in ends:
-                add_ends.append((end, sink))
+        if weights != self.weights:
+            self._set_weights(weights)
+        if self.terminals is None:
+            self._add_terminals()
+        for source, sink in self.terminals:
+            for target in g.successors(source):
+                self._set_source_weight(g.edge(source, target), weights)
 
-            for node in model:
-                if self.graph.node[node].get('ftype', "") ==  "exon_in":
-                    add.setdefault(source, []).append(node)
+        # Normalize every identifier by its maximum and weigh
+        scale = np.zeros(len(g.attr_names))
+        for i, k in enumerate(g.attr_names):
+            v = self.max_id_value.get(k, 0)
+            if v > 0:
+                scale[i] = iweight[k] / float(v)
+        g.edge_weight.values[:] = -0.01 - g.attr_matrix().dot(scale)
+        self.logger.debug("Scored %s edges using %s", g.n_edges, 
+                ", ".join(g.attr_names))
 
-        for p in add_ends:
-            self.graph.add_path(p, ftype="sink")
-
-        for source, targets in add.items():
+    def _add_terminals(self):
+        """ Connect every component to a source and a sink """
+        g = self.graph
+        labels = g.component_labels()
+        node_type = g.node_type.values
+        out_degree = g.out_degree()
+        order = np.argsort(labels, kind="mergesort")
+        bounds = np.searchsorted(labels[order], np.arange(labels.max() + 2))
+        self.terminals = []
+        for i in range(len(bounds) - 1):
+            nodes = order[bounds[i]:bounds[i + 1]]
+            targets = nodes[node_type[nodes] == NODE_TYPES.index("exon_in")]
+            if len(targets) == 0:
+                continue
+            source = g.add_terminal(SOURCE, i + 1)
+            sink = -1
+            ends = nodes[(node_type[nodes] == NODE_TYPES.index("exon_out")) & 
+                    (out_degree[nodes] == 0)]
+            if len(ends) > 0:
+                sink = g.add_terminal(SINK, i + 1)
+            for end in ends:
+                g.add_edge(end, sink, "sink", weight=1)
             for target in targets:
-                self.graph.add_path((source, target), ftype='source')
-                self._set_source_weight((source, target), weights)
-
-        for n1,n2 in self.graph.edges():
-            self.graph.edge[n1][n2]['weight'] = -0.01
-            d = self.graph.edge[n1][n2]
-            for k,v in self.max_id_value.items():
-                if v > 0:
-                    if k in d:
-                        w = d[k] / float(v) * iweight[k]
-                        self.graph.edge[n1][n2]['weight'] -= w 
-
-            if self.graph.edge[n1][n2]['ftype'] == "exon":
-                self.logger.debug("Edge: %s, %s", n1, n2)
-                for k,v in d.items():
-                    self.logger.debug("Key: %s, value: %s", k, v)
-
-        for n1,n2 in self.graph.edges():
-            d = self.graph.edge[n1][n2]
-
-        for source, targets in add.items():
-            sink = source.replace("source", "sink")
+                g.add_edge(source, target, "source", weight=1)
+            self.terminals.append((source, sink))
+
+    def _solve(self, solve, problems, threads=1):
+        """
+        Results of function solve for all problems, in order. With 
+        threads > 1 the problems are solved in a process pool, unless 
+        this is a daemonic process.
+        """
+        if threads > 1 and len(problems) > 1 and \
+                not mp.current_process().daemon:
+            self.logger.debug("Solving %s components using %s processes", 
+                    len(problems), threads)
+            pool = mp.Pool(threads)
             try:
-                pred,dis = nx.bellman_ford(self.graph, source)
-                if not pred.has_key(sink):
-                    continue
-                t = sink
-                best_variant = []
-                while pred[t]:
-                    best_variant.append(pred[t])
-                    t = pred[t]
-
-                p = re.compile(r'(.+):(\d+)([+-])')
-                model = []
-                strand = "+"
-                for i in range(0, len(best_variant) - 1, 2):
-                    n1,n2 = best_variant[i:i+2]
-                    e = self._nodes_to_exon(n1, n2)
-                    if e:
-                        strand = e.strand
-                        model.append(e)
-                if strand == "+":
-                    model = model[::-1]
-                #print model
-                if len(model) > 0:
-                    yield model
-    
-            except Exception as e:
-                raise
-                self.logger.warning("Failed: %s", self.graph.edge[source].keys())
-                self.logger.warning("%s", e)
-    
-    def _nodes_to_feature(self, n1, n2, feature): 
+                chunksize = max(1, len(problems) / (threads * 4))
+                return pool.map(solve, problems, chunksize)
+            finally:
+                pool.terminate()
+        return (solve(problem) for problem in problems)
+
+    def _path_to_model(self, path):
+        """ Exons of a path from the sink to the source """
+        model = []
+        strand = "+"
+        for i in range(0, len(path) - 1, 2):
+            n1,n2 = path[i:i+2]
+            e = self._nodes_to_exon(n1, n2)
+            if e:
+                strand = e.strand
+                model.append(e)
+        if strand == "+":
+            model = model[::-1]
+        return model
+
+    def _component_problems(self):
+        """
+        Self-contained subproblem of every component with a source and
+        sink, in genomic order: source, sink and all (u, v, weight) 
+        edges, sorted by node. 
+        """
+        g = self.graph
+        labels = g.component_labels()
         
-        p = re.compile(r'(.+):(\d+)([+-])')
-        m = p.search(n1)
-        chrom, start, strand = [m.group(x) for x in (1,2,3)]
-        m = p.search(n2)
-        start = int(start)
-        end = int(m.group(2))
-        if start > end:
-            end,start = start,end
-        e = self.db.fetch_feature((chrom, start, end, strand, feature, None))
-        return e
+        # Location of the first node of each component
+        real = np.nonzero(g.node_side.values < SOURCE)[0]
+        first = np.zeros(labels.max() + 1, dtype=np.int64) + \
+                np.iinfo(np.int64).max
+        np.minimum.at(first, labels[real], g.node_pos.values[real])
+        chrom = np.zeros(labels.max() + 1, dtype=np.int64)
+        chrom[labels[real]] = g.node_chrom.values[real]
+        names = g._chroms.names
+        terminals = sorted([t for t in self.terminals if t[1] >= 0],
+                key=lambda t: (names[chrom[labels[t[0]]]], 
+                    first[labels[t[0]]]))
+
+        # Edges grouped per component
+        edges = g.active_edges()
+        src = g.edge_src.values[edges]
+        edge_labels = labels[src]
+        order = np.lexsort((edges, src, edge_labels))
+        edges = edges[order]
+        bounds = np.searchsorted(edge_labels[order], 
+                np.arange(labels.max() + 2))
+        
+        problems = []
+        for source, sink in terminals:
+            label = labels[source]
+            e = edges[bounds[label]:bounds[label + 1]]
+            problems.append((source, sink, zip(
+                g.edge_src.values[e].tolist(),
+                g.edge_dst.values[e].tolist(),
+                g.edge_weight.values[e].tolist(),
+                )))
+        return problems
+
+    def _nodes_to_feature(self, n1, n2, feature): 
+        """
+        Feature of type feature on the edge between n1 and n2, in either
+        direction. Returns None if there is no such edge.
+        """
+        g = self.graph
+        for u, v in ((n1, n2), (n2, n1)):
+            edge = g.edge(u, v)
+            if edge >= 0 and EDGE_TYPES[g.edge_type.data[edge]] == feature:
+                return self.features[g.edge_feature.data[edge]]
+        return None
     
     def _nodes_to_exon(self, n1, n2): 
         return self._nodes_to_feature(n1, n2, "exon")
@@ -214,78 +549,120 @@ class DbCollection(object):
     def _nodes_to_splice_junction(self, n1, n2): 
         return self._nodes_to_feature(n1, n2, "splice_junction")
     
-    def _set_edge_weight(self, feature, n1, n2, weights):
-        d = self.graph.edge[n1][n2]
-        
-        feature_stats = {}
+    def _set_edge_values(self, feature, edge, weights):
+        """ Store the raw evidence values of feature on edge """
+        g = self.graph
         for f in feature.read_counts: 
-            name = f.read_source.name
-            feature_stats[name] = feature_stats.get(name, 0) + f.count
+            column = g.values.add(READS + f.read_source.name)
+            g.values.data[edge, column] += f.count
        
+        if EDGE_TYPES[g.edge_type.data[edge]] == "exon":
+            g.values.set(edge, "length", feature.end - feature.start)
+            g.values.set(edge, "evidence", len(feature.evidences))
+            # Calculated at load, except in older databases
+            orf = feature.orf_length
+            if orf is None:
+                orf = -1
+                if "orf" in [iw["type"] for iw in weights]:
+                    orf = orf_length(feature.seq)
+            g.values.set(edge, "orf", orf)
+    
+    def _set_weights(self, weights):
+        """
+        Calculate the value of every identifier in weights for all edges
+        from the raw evidence values, and the maximum value per 
+        identifier.
+        """
+        g = self.graph
+        exon = g.edge_type.values == EDGE_TYPES.index("exon")
+        splice = g.edge_type.values == EDGE_TYPES.index("splice_junction")
+        length = g.value("length")
+        
+        self.max_id_value = {}
         for iw in weights:
-            weight = iw["weight"]
             idtype = iw["type"]
             identifier = iw["name"]
-            id_value = 0
-            signal = feature_stats.get(identifier, 0)
-            if d['ftype'] == "exon":
-                length = feature.end - feature.start
-                if idtype == "all":
-                    id_value = signal
-                elif idtype == "rpkm":
-                    if signal > 0:
-                        mreads = self.db.nreads(identifier) / 1e6
-                        id_value = float(signal) / mreads / length * 1000.0
-                elif idtype == "evidence":
-                    id_value = len (feature.evidences)
-                elif idtype == "length":
-                    id_value = length
-                elif idtype == "orf":
-                    start, end = longest_orf(feature.seq)
-                    id_value =  end - start
-            elif d['ftype'] == "splice_junction":
-                if idtype == "splice":
-                    f = self._nodes_to_splice_junction(n1, n2)
-                    id_value = feature_stats.get(identifier, 0)
-            d[identifier] = id_value
-            if id_value > self.max_id_value[identifier]:
-                self.max_id_value[identifier] = id_value
-        
+            signal = g.value(READS + identifier)
+            id_value = np.zeros(g.n_edges)
+            if idtype == "all":
+                id_value[exon] = signal[exon]
+            elif idtype == "rpkm":
+                idx = exon & (signal > 0)
+                if idx.any():
+                    mreads = self._nreads(identifier) / 1e6
+                    id_value[idx] = signal[idx] / mreads / length[idx] * 1000.0
+            elif idtype == "evidence":
+                id_value[exon] = g.value("evidence")[exon]
+            elif idtype == "length":
+                id_value[exon] = length[exon]
+            elif idtype == "orf":
+                id_value[exon] = self._orf_values()[exon]
+            elif idtype == "splice":
+                id_value[splice] = signal[splice]
+            
+            g.attrs.resize(g.n_edges)
+            column = g.add_attr(identifier)
+            g.attrs.data[:g.n_edges, column] = id_value
+            self.max_id_value[identifier] = max(
+                    self.max_id_value.get(identifier, 0), 
+                    id_value.max() if g.n_edges > 0 else 0)
+        self.weights = weights
+    
+    def _orf_values(self):
+        """ ORF length of all exons, calculated if it's not stored """
+        g = self.graph
+        orf = g.value("orf")
+        exon = g.edge_type.values == EDGE_TYPES.index("exon")
+        for edge in np.nonzero(exon & (orf < 0))[0]:
+            feature = self.features[g.edge_feature.data[edge]]
+            g.values.set(edge, "orf", orf_length(feature.seq))
+        return g.value("orf")
+
+    def _nreads(self, identifier):
+        """ Total number of reads of a read source, queried once """
+        if identifier not in self.nreads:
+            self.nreads[identifier] = self.db.nreads(identifier)
+        return self.nreads[identifier]
+
     def _set_source_weight(self, edge, weights):
-        n2 = edge[-1] 
+        g = self.graph
+        n2 = g.edge_dst.data[edge]
         for iw in weights:
             weight = iw["weight"]
             idtype = iw["type"]
             identifier = iw["name"]
             if idtype == "first":
-                for other in self.graph[n2]:
-                    e = self._nodes_to_exon(n2, other)
-                    signal = self.db.feature_stats(e, identifier)
-                    self.graph.edge[edge[0]][n2][identifier] = signal
-                    if signal > self.max_id_value[identifier]:
-                        self.max_id_value[identifier] = signal
+                signal = g.value(READS + identifier)
+                for other in g.successors(n2):
+                    value = signal[g.edge(n2, other)]
+                    g.set_attr(edge, identifier, value)
+                    if value > self.max_id_value[identifier]:
+                        self.max_id_value[identifier] = value
 
     def _model_to_path(self, model):
         """
         takes a list of Exons and returns a list of edges
         """
+        g = self.graph
         
         # path is reversed if on minus strand
         if model[0].strand == "-":
             model = model[::-1]
         
+        nodes = [g.feature_nodes(e, add=False) for e in model]
+        
         # add source node to the path
-        source = [n for n in self.graph.predecessors(model[0].in_node())
-                    if n.startswith("source")][0]
+        source = [n for n in g.predecessors(nodes[0][0])
+                    if g.node_side.data[n] == SOURCE][0]
         path = [
-                self.graph.edge[source][model[0].in_node()],
-                self.graph.edge[model[0].in_node()][model[0].out_node()],
+                g.edge(source, nodes[0][0]),
+                g.edge(nodes[0][0], nodes[0][1]),
                     ]
         # add edge for every exon and intron
-        for e1,e2 in zip(model[:-1], model[1:]):
+        for (in1, out1), (in2, out2) in zip(nodes[:-1], nodes[1:]):
             path += [
-                    self.graph.edge[e1.out_node()][e2.in_node()],
-                    self.graph.edge[e2.in_node()][e2.out_node()]
+                    g.edge(out1, in2),
+                    g.edge(in2, out2),
                     ]
         return path
 
@@ -293,8 +670,8 @@ class DbCollection(object):
         """
         return the total weight for a model
         """
-
-        return sum([edge.get('weight', 0) for edge in self._model_to_path(m)])
+        
+        return self.graph.edge_weight.values[self._model_to_path(m)].sum()
     
     def filter_long(self, l=1000, evidence=2):
         """
@@ -303,14 +680,17 @@ class DbCollection(object):
         """
         
         for exon in self.db.get_long_exons(self.chrom, l, evidence):
-            #print self.graph.out_edges()
-            out_edges = len(self.graph.out_edges([exon.out_node()]))
-            in_edges = len(self.graph.in_edges([exon.in_node()]))
+            n1, n2 = self.graph.feature_nodes(exon, add=False)
+            out_edges = 0
+            if n2 >= 0:
+                out_edges = len(self.graph.out_edges(n2))
+            in_edges = 0
+            if n1 >= 0:
+                in_edges = len(self.graph.in_edges(n1))
             self.logger.debug("Filter long: %s, in %s out %s", 
                     exon, in_edges, out_edges)
 
             if (in_edges >= 0 and out_edges >= 1 and exon.strand == "+" 
                     or in_edges >= 1 and out_edges >= 0 and exon.strand == "-"):
                 self.logger.info("Removing long exon %s", exon)
-                self.graph.remove_edge(exon.in_node(), exon.out_node())
-
+                self.graph.remove_edge(n1, n2)
@@ -0,0 +1,355 @@
+"""
+Compact, memory-mapped genome sequence store.
+
+Sequences are packed with 2 bits per base in a single file that is
+memory-mapped read-only, so all worker processes share the same pages.
+Runs of other characters (such as N) and of soft-masked (lowercase)
+sequence are stored as blocks, so that sequences are returned exactly
+as they are in the FASTA files.
+"""
+import os
+import glob
+import hashlib
+import logging
+
+import numpy as np
+
+SEQUENCE_FILE = "sequence.bin"
+INDEX_FILE = "index.tsv"
+BLOCK_FILE = "blocks.npz"
+
+# Directory with the stores of genome index directories, see 
+# get_genome_store()
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pita", "genome")
+
+# Process FASTA files in chunks of this many bases, should be a
+# multiple of 4
+CHUNK_SIZE = 2 ** 24
+
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# All 4 bases of every possible byte
+_UNPACK = np.array([[_BASES[(b >> shift) & 3] for shift in (6, 4, 2, 0)] 
+    for b in range(256)], dtype=np.uint8)
+
+_CODES = np.zeros(256, dtype=np.uint8) + 4
+for _i, _base in enumerate("ACGT"):
+    _CODES[ord(_base)] = _i
+    _CODES[ord(_base.lower())] = _i
+
+# Complement of all IUPAC nucleotide codes, other characters are kept
+_COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _a, _b in zip("ACGTRYKMSWBVDHNacgtrykmswbvdhn",
+                  "TGCAYRMKSWVBHDNtgcayrmkswvbhdn"):
+    _COMPLEMENT[ord(_a)] = ord(_b)
+
+def _to_str(arr):
+    s = arr.tobytes()
+    if isinstance(s, str):
+        return s
+    return s.decode("ascii")
+
+def _runs(mask):
+    """
+    Return the start and end positions of all runs of True in mask.
+    """
+    diff = np.diff(np.hstack(([0], mask.astype(np.int8), [0])))
+    return np.nonzero(diff == 1)[0], np.nonzero(diff == -1)[0]
+
+def _fasta_files(source):
+    """
+    Return all FASTA files of source, which is a FASTA file, a
+    directory with FASTA files or a gimmemotifs genome index.
+    """
+    if os.path.isdir(source):
+        params = os.path.join(source, "index.params")
+        if os.path.exists(params):
+            fnames = [line.split("\t")[1] for line in open(params)]
+        else:
+            fnames = []
+            for ext in ["fa", "fasta", "fa.gz", "fasta.gz"]:
+                fnames += glob.glob(os.path.join(source, "*.{}".format(ext)))
+        return sorted(set(fnames))
+    return [source]
+
+def _read_fasta(fname):
+    """
+    Yield name and chunks of sequence (as uint8 arrays) for every
+    sequence in a FASTA file.
+    """
+    if fname.endswith(".gz"):
+        import gzip
+        f = gzip.open(fname, "rb")
+    else:
+        f = open(fname, "rb")
+
+    name = None
+    lines = []
+    size = 0
+    for line in f:
+        line = line.strip()
+        if line.startswith(b">"):
+            if name:
+                yield name, np.frombuffer(b"".join(lines), dtype=np.uint8)
+            name = line[1:].split()[0]
+            if not isinstance(name, str):
+                name = name.decode("ascii")
+            lines = []
+            size = 0
+        else:
+            lines.append(line)
+            size += len(line)
+            while size >= CHUNK_SIZE:
+                chunk = b"".join(lines)
+                yield name, np.frombuffer(chunk[:CHUNK_SIZE], dtype=np.uint8)
+                lines = [chunk[CHUNK_SIZE:]]
+                size = len(lines[0])
+    if name:
+        yield name, np.frombuffer(b"".join(lines), dtype=np.uint8)
+    f.close()
+
+class GenomeStore(object):
+    """
+    Read-only, 2-bit packed genome that is memory-mapped and can be
+    shared between processes.
+
+    Typical use:
+
+    # Create store from a gimmemotifs index, FASTA file or directory
+    GenomeStore.create("/usr/share/genome_index/hg38", "hg38_store")
+
+    g = GenomeStore("hg38_store")
+    seq = g.get_sequence("chr17", 7520037, 7531588, "-")
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger("pita")
+        self.path = path
+
+        self.offset = {}
+        self.size = {}
+        for line in open(os.path.join(path, INDEX_FILE)):
+            chrom, offset, size = line.rstrip("\n").split("\t")
+            self.offset[chrom] = int(offset)
+            self.size[chrom] = int(size)
+
+        self.blocks = {}
+        with np.load(os.path.join(path, BLOCK_FILE)) as blocks:
+            for i, chrom in enumerate(sorted(self.size.keys())):
+                self.blocks[chrom] = [blocks["{}_{}".format(k, i)] for k in
+                        ["n_start", "n_end", "n_char", "mask_start",
+                         "mask_end"]]
+
+        fname = os.path.join(path, SEQUENCE_FILE)
+        if os.path.getsize(fname) > 0:
+            self.seq = np.memmap(fname, dtype=np.uint8, mode="r")
+        else:
+            self.seq = np.zeros(0, dtype=np.uint8)
+
+    @classmethod
+    def exists(cls, path):
+        return all([os.path.exists(os.path.join(path, f)) for f in
+            [SEQUENCE_FILE, INDEX_FILE, BLOCK_FILE]])
+
+    @classmethod
+    def create(cls, source, path):
+        """
+        Create a GenomeStore in path from source, which is a FASTA file,
+        a directory with FASTA files or a gimmemotifs genome index
+        directory.
+        """
+        logger = logging.getLogger("pita")
+        logger.info("Creating genome store %s from %s", path, source)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        sizes = {}
+        offsets = {}
+        blocks = {}
+        with open(os.path.join(path, SEQUENCE_FILE) + ".tmp", "wb") as out:
+            for fname in _fasta_files(source):
+                for chrom, chunk in _read_fasta(fname):
+                    if chrom not in sizes:
+                        # Every sequence starts at a new byte
+                        offsets[chrom] = out.tell()
+                        sizes[chrom] = 0
+                        blocks[chrom] = [[] for _ in range(5)]
+
+                    cls._add_chunk(out, chunk, sizes[chrom], blocks[chrom])
+                    sizes[chrom] += len(chunk)
+
+        with open(os.path.join(path, INDEX_FILE), "w") as f:
+            for chrom in sorted(sizes.keys()):
+                f.write("{}\t{}\t{}\n".format(chrom, offsets[chrom], sizes[chrom]))
+
+        arrays = {}
+        for i, chrom in enumerate(sorted(sizes.keys())):
+            for k, block in zip(["n_start", "n_end", "n_char",
+                    "mask_start", "mask_end"], blocks[chrom]):
+                if k == "n_char":
+                    dtype = np.uint8
+                else:
+                    dtype = np.int64
+                arrays["{}_{}".format(k, i)] = np.hstack(
+                        [np.array([], dtype=dtype)] + block).astype(dtype)
+        with open(os.path.join(path, BLOCK_FILE), "wb") as f:
+            np.savez(f, **arrays)
+
+        os.rename(os.path.join(path, SEQUENCE_FILE) + ".tmp",
+                os.path.join(path, SEQUENCE_FILE))
+        return cls(path)
+
+    @classmethod
+    def _add_chunk(cls, out, chunk, pos, blocks):
+        """
+        Pack a chunk of sequence, write it to out and save the blocks
+        of non-ACGT and lowercase sequence. Chunks have a length that
+        is a multiple of 4, except for the last chunk of a sequence.
+        """
+        codes = _CODES[chunk]
+
+        # Non-ACGT characters, store consecutive runs of the same character
+        other = codes == 4
+        if other.any():
+            chars = chunk.copy()
+            lower = (chars >= ord("a")) & (chars <= ord("z"))
+            chars[lower] -= 32
+            change = np.hstack(([True], chars[1:] != chars[:-1]))
+            starts, ends = _runs(other)
+            for start, end in zip(starts, ends):
+                split = np.nonzero(change[start + 1:end])[0] + start + 1
+                run_starts = np.hstack(([start], split))
+                run_ends = np.hstack((split, [end]))
+                blocks[0].append(run_starts + pos)
+                blocks[1].append(run_ends + pos)
+                blocks[2].append(chars[run_starts])
+            codes = codes.copy()
+            codes[other] = 0
+
+        # Soft-masked sequence
+        starts, ends = _runs((chunk >= ord("a")) & (chunk <= ord("z")))
+        if len(starts) > 0:
+            # Merge with the last run of the previous chunk
+            if blocks[3] and starts[0] == 0 and blocks[4][-1][-1] == pos:
+                blocks[4][-1][-1] = ends[0] + pos
+                starts, ends = starts[1:], ends[1:]
+            if len(starts) > 0:
+                blocks[3].append(starts + pos)
+                blocks[4].append(ends + pos)
+
+        # Pack 4 bases per byte, the first base in the highest bits
+        pad = (4 - len(codes) % 4) % 4
+        codes = np.hstack((codes, np.zeros(pad, dtype=np.uint8))).reshape(-1, 4)
+        packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+        out.write(packed.astype(np.uint8).tobytes())
+
+    def chromosomes(self):
+        return sorted(self.size.keys())
+
+    def get_size(self, chrom):
+        return self.size[chrom]
+
+    def _check(self, chrom, start, end):
+        if chrom not in self.size:
+            raise KeyError("chromosome {} not in genome store".format(chrom))
+        if start < 0:
+            raise ValueError("Invalid start, < 0!")
+        if end > self.size[chrom]:
+            raise ValueError("Invalid end {0}, greater than sequence length {1} of {2}!".format(
+                end, self.size[chrom], chrom))
+
+    def get_sequences(self, chrom, intervals, strands=None):
+        """
+        Return the sequences of a list of (start, end) intervals on
+        chrom. Sequences are reverse complemented if the corresponding
+        strand in strands is "-".
+        """
+        if len(intervals) == 0:
+            return []
+
+        starts = np.array([iv[0] for iv in intervals], dtype=np.int64)
+        ends = np.array([iv[1] for iv in intervals], dtype=np.int64)
+        self._check(chrom, starts.min(), ends.max())
+
+        # Gather all bytes that contain the requested bases, and 
+        # unpack them to 4 bases per byte
+        byte_starts = starts // 4
+        nbytes = (ends + 3) // 4 - byte_starts
+        cum = np.hstack(([0], np.cumsum(nbytes)))
+        idx = np.arange(cum[-1], dtype=np.int64) - np.repeat(cum[:-1] - byte_starts, nbytes)
+        chars = _UNPACK[self.seq[self.offset[chrom] + idx]].ravel()
+        
+        # Start of every interval in chars
+        first = 4 * cum[:-1] + starts % 4
+        
+        # Add blocks of non-ACGT and soft-masked sequence
+        n_start, n_end, n_char, mask_start, mask_end = self.blocks[chrom]
+        for block_start, block_end, char in [
+                (n_start, n_end, n_char), (mask_start, mask_end, None)]:
+            if len(block_start) == 0:
+                continue
+            # Blocks j0 to j1 overlap with the interval
+            j0 = np.searchsorted(block_end, starts, side="right")
+            j1 = np.searchsorted(block_start, ends, side="left")
+            for i in np.nonzero(j1 > j0)[0]:
+                for j in range(j0[i], j1[i]):
+                    lo = first[i] + max(block_start[j], starts[i]) - starts[i]
+                    hi = first[i] + min(block_end[j], ends[i]) - starts[i]
+                    if char is None:
+                        chars[lo:hi] |= 0x20  # lowercase
+                    else:
+                        chars[lo:hi] = char[j]
+        
+        seqs = []
+        for i in range(len(intervals)):
+            seq = chars[first[i]:first[i] + ends[i] - starts[i]]
+            if strands is not None and strands[i] == "-":
+                seq = _COMPLEMENT[seq[::-1]]
+            seqs.append(_to_str(seq))
+        return seqs
+
+    def get_sequence(self, chrom, start, end, strand=None):
+        """
+        Return a single sequence, reverse complemented if strand is "-".
+        """
+        return self.get_sequences(chrom, [(start, end)], [strand])[0]
+
+    def get_flanked_sequences(self, chrom, intervals, strands, flank):
+        """
+        Return the sequences of all intervals with flank bp added on
+        both sides, and the sequences of the intervals themselves. If
+        the flanked interval extends beyond the chromosome, the flanked
+        sequence is empty.
+        """
+        size = self.size.get(chrom, 0)
+        flanked = [(start - flank, end + flank) for start, end in intervals]
+        ok = [start >= 0 and end <= size for start, end in flanked]
+
+        seqs = self.get_sequences(chrom,
+                [iv if is_ok else orig for iv, orig, is_ok in
+                    zip(flanked, intervals, ok)],
+                strands)
+
+        result = []
+        for seq, is_ok in zip(seqs, ok):
+            if is_ok:
+                result.append((seq, seq[flank:len(seq) - flank]))
+            else:
+                result.append(("", seq))
+        return result
+
+def get_genome_store(index_dir, path=None):
+    """
+    Return the path of the GenomeStore of a genome index directory,
+    create it if it doesn't exist yet or is older than the index. The 
+    store is kept in path, by default in a directory per index in 
+    CACHE_DIR, the index directory itself is never written to.
+    """
+    if path is None:
+        path = os.path.join(CACHE_DIR, 
+                hashlib.sha1(os.path.abspath(index_dir)).hexdigest())
+    if GenomeStore.exists(path):
+        mtime = os.path.getmtime(os.path.join(path, SEQUENCE_FILE))
+        if all([os.path.getmtime(f) <= mtime for f in _fasta_files(index_dir)]):
+            return path
+    GenomeStore.create(index_dir, path)
+    return path
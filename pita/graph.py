@@ -0,0 +1,372 @@
+import numpy as np
+import networkx as nx
+
+from pita.arrays import Column, Codes
+
+# Node key sides, source and sink nodes are numbered by component
+IN, OUT, SOURCE, SINK = 0, 1, 2, 3
+STRANDS = ["+", "-"]
+
+NODE_TYPES = ["exon_in", "exon_out", "source", "sink"]
+EDGE_TYPES = ["exon", "splice_junction", "source", "sink"]
+
+class EdgeTable(object):
+    """ Named columns of values with one row per edge """
+    def __init__(self):
+        self.names = []
+        self.data = np.zeros((1024, 0))
+
+    def resize(self, n):
+        """ Make room for at least n edges """
+        if n > self.data.shape[0]:
+            data = np.zeros((max(n, 2 * self.data.shape[0]), 
+                len(self.names)))
+            data[:self.data.shape[0]] = self.data
+            self.data = data
+
+    def add(self, name):
+        """ Column of name, which is added if it doesn't exist """
+        if name not in self.names:
+            self.names.append(name)
+            self.data = np.hstack((self.data, 
+                np.zeros((self.data.shape[0], 1))))
+        return self.names.index(name)
+    
+    def set(self, edge, name, value):
+        column = self.add(name)
+        self.data[edge, column] = value
+
+class FeatureGraph(object):
+    """
+    Directed graph of features with integer node ids.
+
+    A node is a position (chromosome, position, strand and side), a
+    feature is an edge between its in and out node. Node and edge
+    attributes are stored in NumPy arrays, adjacency as compressed
+    sparse rows (CSR) of the active edges, which is rebuilt after the
+    graph is changed. Every edge refers back to its feature by id.
+    """
+    def __init__(self):
+        self._chroms = Codes()
+        self._nodes = {}
+        self.node_chrom = Column(np.int32)
+        self.node_pos = Column(np.int64)
+        self.node_strand = Column(np.int8)
+        self.node_side = Column(np.int8)
+        self.node_type = Column(np.int8)
+
+        self._edges = {}
+        self.edge_src = Column(np.int64)
+        self.edge_dst = Column(np.int64)
+        self.edge_type = Column(np.int8)
+        self.edge_feature = Column(np.int64)
+        self.edge_weight = Column(np.float64)
+        self.edge_active = Column(np.bool_)
+
+        # Scoring values, one row per edge and one column per identifier
+        self.attrs = EdgeTable()
+        # Raw evidence values of the features, which don't depend on the
+        # scoring
+        self.values = EdgeTable()
+
+        self._csr = None
+
+    @property
+    def n_nodes(self):
+        return len(self.node_pos)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_src)
+
+    @property
+    def attr_names(self):
+        return self.attrs.names
+
+    def _key(self, chrom, pos, strand, side):
+        return (self._chroms.encode(chrom), pos, STRANDS.index(strand), side)
+
+    def add_node(self, chrom, pos, strand, side, ntype=None):
+        """
+        Id of a node, which is added if it doesn't exist. The type of an
+        existing node is updated if ntype is specified.
+        """
+        key = self._key(chrom, pos, strand, side)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self.n_nodes
+            self._nodes[key] = node
+            self.node_chrom.append(key[0])
+            self.node_pos.append(pos)
+            self.node_strand.append(key[2])
+            self.node_side.append(side)
+            self.node_type.append(-1)
+        if ntype is not None:
+            self.node_type.data[node] = NODE_TYPES.index(ntype)
+        return node
+
+    def find_node(self, chrom, pos, strand, side):
+        """ Id of a node, -1 if it's not in the graph """
+        return self._nodes.get(self._key(chrom, pos, strand, side), -1)
+
+    def add_terminal(self, side, n):
+        """ Source or sink node of component n """
+        return self.add_node(None, n, "+", side, NODE_TYPES[side])
+
+    def feature_nodes(self, feature, add=True, ntypes=None):
+        """
+        In and out node of a feature. If add is False, nodes that are
+        not in the graph are returned as -1.
+        """
+        if feature.strand == "+":
+            pos_in, pos_out = feature.start, feature.end
+        else:
+            pos_in, pos_out = feature.end, feature.start
+        if add:
+            if ntypes is None:
+                ntypes = (None, None)
+            return (
+                self.add_node(feature.chrom, pos_in, feature.strand, IN,
+                    ntypes[0]),
+                self.add_node(feature.chrom, pos_out, feature.strand, OUT,
+                    ntypes[1]),
+                )
+        return (
+                self.find_node(feature.chrom, pos_in, feature.strand, IN),
+                self.find_node(feature.chrom, pos_out, feature.strand, OUT),
+                )
+
+    def node_name(self, node):
+        """ Name of a node, as Feature.in_node() and Feature.out_node() """
+        side = self.node_side.data[node]
+        pos = self.node_pos.data[node]
+        if side in (SOURCE, SINK):
+            return "{}_{}".format(NODE_TYPES[side], pos)
+        return "{}:{}{}_{}".format(
+                self._chroms.names[self.node_chrom.data[node]],
+                pos,
+                STRANDS[self.node_strand.data[node]],
+                NODE_TYPES[side],
+                )
+
+    def node_loc(self, node):
+        """ Chromosome, position and strand of a node """
+        return (
+                self._chroms.names[self.node_chrom.data[node]],
+                int(self.node_pos.data[node]),
+                STRANDS[self.node_strand.data[node]],
+                )
+
+    def add_edge(self, u, v, etype, feature_id=-1, weight=-1):
+        """
+        Id of the edge between u and v. An existing edge is updated, as
+        in networkx.
+        """
+        edge = self._edges.get((u, v))
+        if edge is None:
+            edge = self.n_edges
+            self._edges[(u, v)] = edge
+            self.edge_src.append(u)
+            self.edge_dst.append(v)
+            self.edge_type.append(0)
+            self.edge_feature.append(-1)
+            self.edge_weight.append(0)
+            self.edge_active.append(True)
+            self.attrs.resize(edge + 1)
+            self.values.resize(edge + 1)
+        self.edge_type.data[edge] = EDGE_TYPES.index(etype)
+        self.edge_feature.data[edge] = feature_id
+        self.edge_weight.data[edge] = weight
+        self.edge_active.data[edge] = True
+        self._csr = None
+        return edge
+
+    def edge(self, u, v):
+        """ Id of the edge between u and v, -1 if there is none """
+        edge = self._edges.get((u, v), -1)
+        if edge >= 0 and self.edge_active.data[edge]:
+            return edge
+        return -1
+
+    def remove_edge(self, u, v):
+        edge = self.edge(u, v)
+        if edge < 0:
+            raise ValueError("No edge between {} and {}".format(
+                self.node_name(u), self.node_name(v)))
+        self.edge_active.data[edge] = False
+        self._csr = None
+
+    def add_attr(self, name):
+        """ Column of attribute name, which is added if it doesn't exist """
+        return self.attrs.add(name)
+
+    def set_attr(self, edge, name, value):
+        self.attrs.set(edge, name, value)
+
+    def attr(self, name):
+        """ Values of attribute name for all edges """
+        if name not in self.attr_names:
+            return np.zeros(self.n_edges)
+        return self.attr_matrix()[:, self.attr_names.index(name)]
+
+    def attr_matrix(self):
+        """ Attributes of all edges, with columns in order of attr_names """
+        return self.attrs.data[:self.n_edges]
+
+    def value(self, name):
+        """ Raw values of name for all edges """
+        if name not in self.values.names:
+            return np.zeros(self.n_edges)
+        return self.values.data[:self.n_edges, self.values.names.index(name)]
+
+    def edge_attrs(self, edge):
+        """ Attributes of one edge as dict """
+        d = dict(zip(self.attr_names, self.attrs.data[edge]))
+        d["ftype"] = EDGE_TYPES[self.edge_type.data[edge]]
+        d["weight"] = self.edge_weight.data[edge]
+        return d
+
+    def active_edges(self):
+        return np.nonzero(self.edge_active.values)[0]
+
+    def csr(self):
+        """
+        Active edges in CSR format: the edges of node u are
+        edges[indptr[u]:indptr[u + 1]], for outgoing (out) and incoming
+        (in) edges.
+        """
+        if self._csr is None:
+            edges = self.active_edges()
+            self._csr = {}
+            for name, nodes in (("out", self.edge_src), ("in", self.edge_dst)):
+                nodes = nodes.values[edges]
+                order = np.argsort(nodes, kind="mergesort")
+                indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+                indptr[1:] = np.cumsum(
+                        np.bincount(nodes, minlength=self.n_nodes))
+                self._csr[name] = (indptr, edges[order])
+        return self._csr
+
+    def out_edges(self, node):
+        indptr, edges = self.csr()["out"]
+        return edges[indptr[node]:indptr[node + 1]]
+
+    def in_edges(self, node):
+        indptr, edges = self.csr()["in"]
+        return edges[indptr[node]:indptr[node + 1]]
+
+    def successors(self, node):
+        return self.edge_dst.values[self.out_edges(node)]
+
+    def predecessors(self, node):
+        return self.edge_src.values[self.in_edges(node)]
+
+    def out_degree(self):
+        indptr, edges = self.csr()["out"]
+        return np.diff(indptr)
+
+    def component_labels(self):
+        """
+        Weakly connected component of every node, numbered in order of
+        their first node.
+        """
+        edges = self.active_edges()
+        src = self.edge_src.values[edges]
+        dst = self.edge_dst.values[edges]
+
+        # Hook roots on the smallest root, then compress the paths
+        parent = np.arange(self.n_nodes)
+        while True:
+            p1 = parent[src]
+            p2 = parent[dst]
+            hook = p1 != p2
+            if not hook.any():
+                break
+            np.minimum.at(parent, np.maximum(p1, p2)[hook],
+                    np.minimum(p1, p2)[hook])
+            while True:
+                grandparent = parent[parent]
+                if (grandparent == parent).all():
+                    break
+                parent = grandparent
+
+        roots, labels = np.unique(parent, return_inverse=True)
+        return labels
+
+    def save(self, fname, **extra):
+        """
+        Save the graph and the raw values, without the scoring attributes,
+        to NumPy file fname. Arrays in extra are saved with it.
+        """
+        n = self.n_edges
+        arrays = dict(
+                chroms=np.array(self._chroms.names, dtype=object),
+                node_chrom=self.node_chrom.values,
+                node_pos=self.node_pos.values,
+                node_strand=self.node_strand.values,
+                node_side=self.node_side.values,
+                node_type=self.node_type.values,
+                edge_src=self.edge_src.values,
+                edge_dst=self.edge_dst.values,
+                edge_type=self.edge_type.values,
+                edge_feature=self.edge_feature.values,
+                edge_active=self.edge_active.values,
+                value_names=np.array(self.values.names, dtype=object),
+                values=self.values.data[:n],
+                )
+        arrays.update(extra)
+        with open(fname, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """ 
+        Graph saved with save() and a dict with the other arrays in
+        the file 
+        """
+        g = cls()
+        with np.load(fname, allow_pickle=True) as npz:
+            data = dict(npz.items())
+        for name in data.pop("chroms"):
+            g._chroms.encode(name)
+        for name in ["node_chrom", "node_pos", "node_strand", "node_side",
+                "node_type", "edge_src", "edge_dst", "edge_type", 
+                "edge_feature", "edge_active"]:
+            getattr(g, name).extend(data.pop(name))
+        g.edge_weight.extend(np.zeros(g.n_edges))
+        
+        g._nodes = dict(zip(zip(
+                g.node_chrom.values.tolist(),
+                g.node_pos.values.tolist(),
+                g.node_strand.values.tolist(),
+                g.node_side.values.tolist(),
+                ), range(g.n_nodes)))
+        g._edges = dict(zip(zip(
+                g.edge_src.values.tolist(),
+                g.edge_dst.values.tolist(),
+                ), range(g.n_edges)))
+        
+        g.attrs.resize(g.n_edges)
+        g.values.resize(g.n_edges)
+        for i, name in enumerate(data.pop("value_names")):
+            g.values.add(name)
+            g.values.data[:g.n_edges, i] = data["values"][:, i]
+        data.pop("values")
+        return g, data
+
+    def to_networkx(self):
+        """ Graph as networkx.DiGraph with node names """
+        graph = nx.DiGraph()
+        for node in range(self.n_nodes):
+            ntype = self.node_type.data[node]
+            if ntype >= 0:
+                graph.add_node(self.node_name(node), ftype=NODE_TYPES[ntype])
+            else:
+                graph.add_node(self.node_name(node))
+        for edge in self.active_edges():
+            graph.add_edge(
+                    self.node_name(self.edge_src.data[edge]),
+                    self.node_name(self.edge_dst.data[edge]),
+                    **self.edge_attrs(edge)
+                    )
+        return graph
@@ -1,37 +1,241 @@
 from BCBio import GFF
-import sys
 import os
 import logging 
-from tempfile import NamedTemporaryFile
-import subprocess as sp
+import hashlib
+import heapq
+import itertools
+import shutil
+import multiprocessing as mp
+from array import array
+from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
+import yaml
 import pysam
+from pysam.libcbgzf import BGZFile
 import pybedtools
+import numpy as np
 
-def _create_tabix(fname, ftype):
+# Size of the lines that are sorted in memory at once, per process
+SORT_BUFFER_SIZE = 128 * 1024 * 1024
+
+# Tabix preset and position column (0-based) of every file type
+TABIX_PRESETS = {
+        "bed":("bed", 1),
+        "gff":("gff", 3),
+        "gff3":("gff", 3),
+        "gtf":("gff", 3),
+        }
+
+def _sort_key(line, column):
+    """ Sort key of a line: chromosome, position and the line itself """
+    vals = line.split("\t", column + 1)
+    try:
+        return (vals[0], int(vals[column]), line)
+    except (IndexError, ValueError):
+        raise ValueError("Invalid line: {}".format(line.strip()))
+
+def _read_chunks(fname, buffer_size):
+    """ 
+    Lines of fname in chunks of buffer_size, without comments, empty 
+    lines and track lines 
+    """
+    chunk = []
+    size = 0
+    with open(fname) as f:
+        for line in f:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            chunk.append(line)
+            size += len(line)
+            if size >= buffer_size:
+                yield chunk
+                chunk = []
+                size = 0
+    if chunk:
+        yield chunk
+
+def _sort_chunk(args):
+    """ Sort lines by position and write them to a temporary file """
+    lines, column, tmpdir = args
+    lines.sort(key=lambda line: _sort_key(line, column))
+    fd, name = mkstemp(prefix="pita", dir=tmpdir)
+    with os.fdopen(fd, "w") as f:
+        f.writelines(lines)
+    return name
+
+def _read_sorted(fname, column):
+    with open(fname) as f:
+        for line in f:
+            yield _sort_key(line, column)
+
+def _sorted_lines(fname, column, tmpdir, buffer_size, threads=1):
+    """
+    Sorted lines of fname. Files larger than buffer_size are sorted in
+    chunks, which are merged. With threads > 1, this number of chunks is 
+    sorted in parallel.
+    """
+    logger = logging.getLogger("pita")
+    chunks = _read_chunks(fname, buffer_size)
+    first = next(chunks, [])
+    second = next(chunks, None)
+    if second is None:
+        first.sort(key=lambda line: _sort_key(line, column))
+        for line in first:
+            yield line
+        return
+    
+    pool = None
+    if threads > 1 and not mp.current_process().daemon:
+        pool = mp.Pool(threads)
+    try:
+        # Keep at most one chunk per process in memory
+        names = []
+        batch = []
+        for chunk in itertools.chain([first, second], chunks):
+            batch.append(chunk)
+            if len(batch) >= max(threads, 1):
+                names += _sort_chunks(pool, batch, column, tmpdir)
+                batch = []
+        if batch:
+            names += _sort_chunks(pool, batch, column, tmpdir)
+    finally:
+        if pool:
+            pool.terminate()
+    
+    logger.debug("Merging %s sorted chunks of %s", len(names), fname)
+    for key in heapq.merge(*[_read_sorted(name, column) for name in names]):
+        yield key[2]
+
+def _sort_chunks(pool, chunks, column, tmpdir):
+    args = [(chunk, column, tmpdir) for chunk in chunks]
+    if pool:
+        return pool.map(_sort_chunk, args)
+    return [_sort_chunk(arg) for arg in args]
+
+def _create_tabix(fname, ftype, threads=1, buffer_size=SORT_BUFFER_SIZE):
+    """
+    Sort fname by position, compress it with bgzip and index it with 
+    tabix. Returns the name of the compressed file.
+    """
     logger = logging.getLogger("pita")
-    tabix_file = ""
     logger.info("Creating tabix index for %s", os.path.basename(fname))
-    logger.debug("Preparing %s for tabix", fname)
-    tmp = NamedTemporaryFile(prefix="pita", delete=False)
-    preset = "gff"
-    if ftype == "bed":
-        cmd = "sort -k1,1 -k2g,2 {0} | grep -v track | grep -v \"^#\" > {1}"
-        preset = "bed"
-    elif ftype in ["gff", "gff3", "gtf"]:
-        cmd = "sort -k1,1 -k4g,4 {0} | grep -v \"^#\" > {1}"
-
-    # Sort the input file
-    logger.debug(cmd.format(fname, tmp.name))
-    sp.call(cmd.format(fname, tmp.name), shell=True)
-    # Compress using bgzip
-    logger.debug("compressing %s", tmp.name)
-    tabix_file = tmp.name + ".gz"
-    pysam.tabix_compress(tmp.name, tabix_file)
+    preset, column = TABIX_PRESETS[ftype]
+    
+    tmp = NamedTemporaryFile(prefix="pita", suffix=".gz", delete=False)
     tmp.close()
-    # Index (using tabix command line, as pysam.index results in a Segmentation fault
+    tabix_file = tmp.name
+    tmpdir = mkdtemp(prefix="pita")
+    try:
+        logger.debug("Sorting %s to %s", fname, tabix_file)
+        out = BGZFile(tabix_file, "w")
+        block = []
+        size = 0
+        for line in _sorted_lines(fname, column, tmpdir, buffer_size, 
+                threads):
+            block.append(line)
+            size += len(line)
+            if size >= 1 << 20:
+                out.write("".join(block))
+                block = []
+                size = 0
+        out.write("".join(block))
+        out.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    
     logger.debug("indexing %s", tabix_file)
-    sp.call("tabix {0} -p {1}".format(tabix_file, preset), shell=True)
-    return tabix_file
+    return pysam.tabix_index(tabix_file, preset=preset, force=True)
+
+def file_hash(fname):
+    """ SHA1 hash of the content of file fname """
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class TabixCache(object):
+    """
+    Directory with tabix files of input files, which are reused between
+    runs. The files are named by the hash of the content of the input 
+    file. An index with the path, size and modification time of the 
+    input files avoids hashing unchanged files again.
+    """
+    INDEX = "index.yaml"
+
+    def __init__(self, path):
+        self.logger = logging.getLogger("pita")
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.index = {}
+        try:
+            with open(os.path.join(path, self.INDEX)) as f:
+                self.index = yaml.safe_load(f) or {}
+        except (IOError, yaml.YAMLError):
+            pass
+
+    def _write_index(self):
+        fname = os.path.join(self.path, self.INDEX)
+        with open(fname + ".tmp", "w") as f:
+            yaml.safe_dump(self.index, f, default_flow_style=False)
+        os.rename(fname + ".tmp", fname)
+
+    def _stat(self, fname):
+        st = os.stat(fname)
+        return {"size":st.st_size, "mtime":st.st_mtime}
+
+    def tabix(self, fname, ftype, threads=1):
+        """ Tabix file of fname, which is created if it's not cached """
+        path = os.path.abspath(fname)
+        stat = self._stat(path)
+        entry = self.index.get(path)
+        if entry and entry["ftype"] == ftype and \
+                all([entry[k] == v for k, v in stat.items()]):
+            digest = entry["sha1"]
+        else:
+            digest = file_hash(path)
+        
+        tabix_file = os.path.join(self.path, "{}.{}.gz".format(digest, ftype))
+        if os.path.exists(tabix_file) and os.path.exists(tabix_file + ".tbi"):
+            self.logger.info("Using cached tabix index for %s", 
+                    os.path.basename(fname))
+        else:
+            tmp_file = _create_tabix(fname, ftype, threads)
+            # The index has to be newer than the data
+            shutil.move(tmp_file, tabix_file)
+            shutil.move(tmp_file + ".tbi", tabix_file + ".tbi")
+        
+        entry = {"ftype":ftype, "sha1":digest}
+        entry.update(stat)
+        self.index[path] = entry
+        self.evict()
+        self._write_index()
+        return tabix_file
+
+    def evict(self):
+        """
+        Remove the entries of input files that were removed or changed,
+        and all tabix files that are not used by an entry.
+        """
+        for path, entry in self.index.items():
+            if not os.path.exists(path) or any([entry[k] != v 
+                    for k, v in self._stat(path).items()]):
+                del self.index[path]
+        
+        used = set(["{}.{}.gz".format(e["sha1"], e["ftype"]) 
+            for e in self.index.values()])
+        for name in os.listdir(self.path):
+            if name.endswith(".gz.tbi"):
+                base = name[:-4]
+            elif name.endswith(".gz"):
+                base = name
+            else:
+                continue
+            if base not in used:
+                self.logger.debug("Removing %s from tabix cache", name)
+                os.unlink(os.path.join(self.path, name))
 
 def exons_to_tabix_bed(exons):
     logger = logging.getLogger("pita")
@@ -44,6 +248,7 @@ def exons_to_tabix_bed(exons):
 
     tmp.close()
     tabix_fname = _create_tabix(tmp.name, "bed")
+    os.unlink(tmp.name)
     return tabix_fname
 
 def tabix_overlap(fname1, fname2, chrom, fraction):
@@ -80,34 +285,66 @@ def tabix_overlap(fname1, fname2, chrom, fraction):
     for f in intersect:
         yield f
 
+def read_positions(fname, chrom):
+    """ Return sorted arrays with start and end positions of all
+    reads on chrom in BAM file fname.
+    """
+    bam = pysam.AlignmentFile(fname, "rb")
+    if chrom not in bam.references:
+        bam.close()
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Positions are streamed into C arrays, 8 bytes per position, which
+    # are used by NumPy without a copy
+    starts = array("l")
+    ends = array("l")
+    for read in bam.fetch(chrom):
+        starts.append(read.reference_start)
+        # Placed unmapped reads overlap one position, as in samtools
+        ends.append(read.reference_end or read.reference_start + 1)
+    bam.close()
+
+    starts = np.frombuffer(starts, dtype="l").astype(np.int64, copy=False)
+    ends = np.frombuffer(ends, dtype="l").astype(np.int64, copy=False)
+    starts.sort()
+    ends.sort()
+    return starts, ends
+
+def count_reads(fname, chrom, starts, ends):
+    """ Count reads in BAM file fname overlapping the windows
+    starts[i] - ends[i] on chrom. The reads are fetched once, counts
+    are calculated on the sorted read positions.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    read_starts, read_ends = read_positions(fname, chrom)
+
+    # Reads starting before the window end, minus reads
+    # ending before the window start
+    counts = np.searchsorted(read_starts, ends, "left") - \
+            np.searchsorted(read_ends, starts, "right")
+
+    # Empty windows never overlap a read
+    counts[ends <= starts] = 0
+    return counts
+
 def merge_exons(starts, sizes, l=0):
-    merge = []
-    for i, (start1, start2, size) in enumerate(zip(starts[:-1], starts[1:], sizes[:-1])):
-        if start1 + size + l >= start2:
-            merge.append(i + 1)
-    
-    if len(merge) == 0:
-        return starts, sizes
-   
-    i = len(starts) - 1
-    new_starts = []
-    new_sizes = []
+    """
+    Merge exons that are at most l apart. Exons are given by their 
+    starts and sizes, as in a BED12 file, and the merged starts and 
+    sizes are returned.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = starts + np.asarray(sizes, dtype=np.int64)
     
-    while i >= 0:
-        if i in merge:
-            j = i - 1
-            while j in merge:
-                j -= 1
-            new_starts.append(starts[j])
-            new_sizes.append(starts[i] - starts[j] + sizes[i])
-            
-            i = j - 1
-        else:
-            new_starts.append(starts[i])
-            new_sizes.append(sizes[i])
-            i -= 1
+    # An exon is merged with the previous one if that ends close enough
+    merge = ends[:-1] + l >= starts[1:]
+    if not merge.any():
+        return starts.tolist(), (ends - starts).tolist()
     
-    return new_starts[::-1], new_sizes[::-1]
+    first = np.hstack(([True], ~merge))
+    last = np.hstack((~merge, [True]))
+    return starts[first].tolist(), (ends[last] - starts[first]).tolist()
 
 def _gff_type_iterator(feature, ftypes):
     if feature.type in ftypes:
@@ -150,54 +387,54 @@ def read_gff_transcripts(fobj, fname="", min_exons=1, merge=0):
     return transcripts
 
 def read_bed_transcripts(fobj, fname="", min_exons=1, merge=0):
+    """
+    Yield the transcripts in BED12 file object fobj as [name, fname, 
+    exons]. Names are made unique as chrom|name|i. Exons that are at most
+    merge apart are merged, transcripts with less than min_exons exons 
+    are skipped.
+    """
     
     # Setup logging
     logger = logging.getLogger('pita')
     
+    # Last number used for every name
     names = {}
-    transcripts = []
-    line = fobj.readline()
-    while line:
-        if not line.startswith("track"):
-            #logger.debug(line)
-            try:
-                vals = line.strip().split("\t")
-                
-                i = 1
-                name = "%s|%s|%s" % (vals[0], vals[3], i)
-                while names.has_key(name):
-                    i += 1
-                    name = "%s|%s|%s" % (vals[0], vals[3], i)
-                names[name] = 1
-                
-                chromStart = int(vals[1])
-                
-                sizes = [int(x) for x in vals[10].strip(",").split(",")]
-                starts = [int(x) for x in vals[11].strip(",").split(",")] 
-                    
-                starts, sizes = merge_exons(starts, sizes, l=merge)
+    for line in fobj:
+        if line.startswith("track"):
+            continue
+        #logger.debug(line)
+        try:
+            vals = line.strip().split("\t")
+            
+            i = names.get((vals[0], vals[3]), 0) + 1
+            name = "%s|%s|%s" % (vals[0], vals[3], i)
+            names[(vals[0], vals[3])] = i
+            
+            chromStart = int(vals[1])
+            
+            sizes = np.fromstring(vals[10].strip(","), dtype=np.int64, 
+                    sep=",")
+            starts = np.fromstring(vals[11].strip(","), dtype=np.int64, 
+                    sep=",")
+            if len(starts) != len(sizes) or len(starts) == 0:
+                raise ValueError("Invalid blocks")
                 
-                exons = [[vals[0], 
-                          chromStart + start, 
-                          chromStart + start + size, 
-                          vals[5]]
-                          for start, size in zip(starts, sizes)
-                         ]
-                    
-                if len(exons) >= min_exons:
-                    logger.debug("read_bed: adding %s", vals[3])
-                    transcripts.append([name, fname, exons])
-                else:
-                    logger.debug("read_bed: not adding %s, filter on minimum exons", vals[3])
+            starts, sizes = merge_exons(starts + chromStart, sizes, l=merge)
             
-            except:
-                print "Error parsing BED file"
-                print line
-                raise
-                sys.exit(1)
+            exons = [[vals[0], start, start + size, vals[5]]
+                      for start, size in zip(starts, sizes)
+                     ]
         
-        line = fobj.readline()
-    return transcripts
+        except:
+            print "Error parsing BED file"
+            print line
+            raise
+            
+        if len(exons) >= min_exons:
+            logger.debug("read_bed: adding %s", vals[3])
+            yield [name, fname, exons]
+        else:
+            logger.debug("read_bed: not adding %s, filter on minimum exons", vals[3])
 
 class TabixIteratorAsFile:
     def __init__(self, x):
@@ -218,6 +455,9 @@ class TabixIteratorAsFile:
             yield line
             line = self.readline()
 
+    def __iter__(self):
+        return self.readlines()
+
 
 
 
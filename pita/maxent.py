@@ -0,0 +1,357 @@
+"""
+Native implementation of the MaxEntScan splice site models (Yeo & Burge,
+2004). Scores are identical to those of the score5.pl and score3.pl
+scripts, but the models are loaded only once and sequences are scored
+in batches using numpy lookups.
+"""
+import os
+import glob
+import hashlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from distutils.spawn import find_executable
+
+import numpy as np
+
+# Background and consensus (GT for donors, AG for acceptors)
+# probabilities of A, C, G and T, taken from score5.pl and score3.pl
+BGD = np.array([0.27, 0.23, 0.23, 0.27])
+DONOR_CONS = (
+        np.array([0.004, 0.0032, 0.9896, 0.0032]),
+        np.array([0.0034, 0.0039, 0.0042, 0.9884]),
+        )
+ACCEPTOR_CONS = (
+        np.array([0.9903, 0.0032, 0.0034, 0.0030]),
+        np.array([0.0027, 0.0037, 0.9905, 0.0030]),
+        )
+
+DONOR_LENGTH = 9
+ACCEPTOR_LENGTH = 23
+
+# Sub-sequences (start, length) of the 21 bp non-consensus part of the
+# acceptor that are scored by me2x3acc1 to me2x3acc9. The last four
+# are in the denominator.
+ACCEPTOR_PARTS = [
+        (0, 7), (7, 7), (14, 7), (4, 7), (11, 7),
+        (4, 3), (7, 4), (11, 3), (14, 4),
+        ]
+
+# Lookup table to convert ASCII sequences to 0-3, everything else is 4
+_CODES = np.zeros(256, dtype=np.uint8) + 4
+for _i, _base in enumerate("ACGT"):
+    _CODES[ord(_base)] = _i
+    _CODES[ord(_base.lower())] = _i
+
+MODEL_FILES = ["me2x5", "splicemodels"]
+
+def find_maxent_models(path=None):
+    """
+    Return the directory with the MaxEntScan models (me2x5 and the
+    splicemodels directory). This is the directory specified by path,
+    or otherwise the directory of the score5.pl or maxentscan_score5.pl
+    script in the PATH.
+    """
+    dirs = []
+    if path:
+        dirs.append(path)
+    else:
+        for base in ["maxentscan_score5.pl", "score5.pl"]:
+            exe = find_executable(base)
+            if exe:
+                exe_dir = os.path.dirname(os.path.realpath(exe))
+                dirs.append(exe_dir)
+                # bioconda installs the models in share/
+                dirs += glob.glob(os.path.join(exe_dir, "..", "share", "maxentscan*"))
+
+    for d in dirs:
+        if all([os.path.exists(os.path.join(d, f)) for f in MODEL_FILES]):
+            return d
+
+    raise Exception("Please provide path to the MaxEntScan models (the directory with score5.pl and score3.pl) in config file")
+
+def encode(seqs, length):
+    """
+    Convert a list of sequences to an array of codes (A=0, C=1, G=2, T=3).
+    Returns the array and a boolean array indicating which sequences
+    are valid, i.e. of the correct length and only consist of ACGT.
+    """
+    codes = np.zeros((len(seqs), length), dtype=np.uint8) + 4
+    correct_length = np.array([len(seq) == length for seq in seqs], dtype=bool)
+    if correct_length.any():
+        joined = "".join([seq for seq in seqs if len(seq) == length])
+        raw = np.frombuffer(joined.encode("ascii"), dtype=np.uint8)
+        codes[correct_length] = _CODES[raw.reshape(-1, length)]
+    valid = (codes < 4).all(axis=1)
+    codes[~valid] = 0
+    return codes, valid
+
+def hash_codes(codes):
+    """
+    Base 4 hash of every row of an array of codes, as hashseq() in
+    score3.pl.
+    """
+    powers = 4 ** np.arange(codes.shape[1] - 1, -1, -1)
+    return codes.astype(np.int64).dot(powers)
+
+def _read_values(fname):
+    return [line.strip() for line in open(fname) if line.strip()]
+
+class MaxEntScorer(object):
+    """
+    Score splice donors (9-mers) and acceptors (23-mers) with the
+    MaxEntScan maximum entropy models.
+    """
+    def __init__(self, path=None):
+        self.logger = logging.getLogger("pita")
+        self.path = find_maxent_models(path)
+        self.logger.debug("Loading MaxEntScan models from %s", self.path)
+
+        # score5.pl looks up the 7-mer in splice5sequences, and uses
+        # the line number as index in me2x5
+        me2x5 = [float(x) for x in _read_values(os.path.join(self.path, "me2x5"))]
+        kmers = _read_values(os.path.join(self.path, "splicemodels", "splice5sequences"))
+        codes, valid = encode(kmers, 7)
+        self.me2x5 = np.zeros(4 ** 7)
+        self.me2x5[hash_codes(codes[valid])] = np.array(me2x5)[valid]
+
+        # score3.pl uses the hash of the sequence as line number
+        self.acceptor_tables = []
+        for i in range(len(ACCEPTOR_PARTS)):
+            fname = os.path.join(self.path, "splicemodels", "me2x3acc{}".format(i + 1))
+            self.acceptor_tables.append(
+                    np.array([float(x) for x in _read_values(fname)]))
+
+    def _consensus(self, codes, pos, cons):
+        c1 = codes[:, pos]
+        c2 = codes[:, pos + 1]
+        return cons[0][c1] * cons[1][c2] / (BGD[c1] * BGD[c2])
+
+    def score5(self, seqs):
+        """
+        Score a list of 9 bp splice donor sequences (3 bp exon,
+        6 bp intron). Returns an array of scores, invalid sequences
+        get a score of nan.
+        """
+        codes, valid = encode(seqs, DONOR_LENGTH)
+        scores = self.score5_codes(codes)
+        scores[~valid] = np.nan
+        return scores
+
+    def score5_codes(self, codes):
+        """
+        Score an array of encoded splice donors.
+        """
+        rest = np.hstack((codes[:, :3], codes[:, 5:]))
+        with np.errstate(divide="ignore"):
+            return np.log2(
+                    self._consensus(codes, 3, DONOR_CONS) *
+                    self.me2x5[hash_codes(rest)]
+                    )
+
+    def score3(self, seqs):
+        """
+        Score a list of 23 bp splice acceptor sequences (20 bp intron,
+        3 bp exon). Returns an array of scores, invalid sequences get
+        a score of nan.
+        """
+        codes, valid = encode(seqs, ACCEPTOR_LENGTH)
+        rest = np.hstack((codes[:, :18], codes[:, 20:]))
+
+        parts = []
+        for table, (start, length) in zip(self.acceptor_tables, ACCEPTOR_PARTS):
+            parts.append(table[hash_codes(rest[:, start:start + length])])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            me = (parts[0] * parts[1] * parts[2] * parts[3] * parts[4] /
+                    (parts[5] * parts[6] * parts[7] * parts[8]))
+            scores = np.log2(me) + np.log2(
+                    self._consensus(codes, 18, ACCEPTOR_CONS))
+        scores[~valid] = np.nan
+        return scores
+
+    def checksum(self):
+        """
+        Checksum of the model files, used to validate cached scores.
+        """
+        md5 = hashlib.md5()
+        fnames = [os.path.join(self.path, "me2x5")]
+        fnames += sorted(glob.glob(os.path.join(self.path, "splicemodels", "*")))
+        for fname in fnames:
+            with open(fname, "rb") as f:
+                md5.update(f.read())
+        return md5.hexdigest()
+
+class SpliceScoreCache(object):
+    """
+    On-disk cache of splice site scores, keyed by sequence. The cache
+    is a sqlite database that can be shared by several processes. When
+    it grows beyond max_size sequences, the least recently used 
+    sequences are evicted until it's filled to fraction low of max_size.
+    """
+    chunk = 500
+    low = 0.9
+
+    def __init__(self, fname, checksum, max_size=1000000):
+        self.logger = logging.getLogger("pita")
+        self.fname = fname
+        self.checksum = checksum
+        self.max_size = max_size
+        self.conn = None
+        self.pid = None
+        # Number of sequences at the last count, and added since
+        self.size = None
+        self.added = 0
+
+    def _connect(self):
+        # sqlite connections can't be shared with forked processes
+        if self.conn and self.pid == os.getpid():
+            return self.conn
+        
+        self.conn = sqlite3.connect(self.fname, timeout=60)
+        self.pid = os.getpid()
+        self.size = None
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                    "(key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS splice_score "
+                    "(seq TEXT PRIMARY KEY, score REAL, used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_used "
+                    "ON splice_score (used)")
+            row = self.conn.execute("SELECT value FROM meta "
+                    "WHERE key = 'checksum'").fetchone()
+            if not row or row[0] != self.checksum:
+                if row:
+                    self.logger.info("MaxEntScan models changed, clearing %s", 
+                            self.fname)
+                self.conn.execute("DELETE FROM splice_score")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                        "('checksum', ?)", (self.checksum,))
+        return self.conn
+    
+    def get(self, seqs):
+        """
+        Return a dictionary with the cached scores of seqs.
+        """
+        conn = self._connect()
+        seqs = list(seqs)
+        scores = {}
+        with conn:
+            for i in range(0, len(seqs), self.chunk):
+                chunk = seqs[i:i + self.chunk]
+                marks = ",".join(["?"] * len(chunk))
+                rows = conn.execute("SELECT seq, score FROM splice_score "
+                        "WHERE seq IN ({})".format(marks), chunk).fetchall()
+                if rows:
+                    conn.execute("UPDATE splice_score SET used = ? "
+                            "WHERE seq IN ({})".format(",".join(["?"] * len(rows))),
+                            [time.time()] + [row[0] for row in rows])
+                scores.update(rows)
+        return scores
+
+    def put(self, scores):
+        """
+        Store a dictionary of scores and evict the least recently used 
+        sequences if the cache is full.
+        """
+        if not scores:
+            return
+
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO splice_score VALUES (?,?,?)", 
+                    [(seq, score, now) for seq, score in scores.items()])
+            self.added += len(scores)
+            
+            # Only count the sequences if the cache may be full, or if 
+            # other processes may have filled it since the last count
+            if self.size is not None and \
+                    self.size + self.added <= self.max_size and \
+                    self.added < self.max_size * (1 - self.low):
+                return
+            n = conn.execute("SELECT COUNT(*) FROM splice_score").fetchone()[0]
+            if n > self.max_size:
+                evict = n - int(self.max_size * self.low)
+                self.logger.debug("Evicting %s sequences from %s", 
+                        evict, self.fname)
+                conn.execute("DELETE FROM splice_score WHERE seq IN "
+                        "(SELECT seq FROM splice_score ORDER BY used LIMIT ?)",
+                        (evict,))
+                n -= evict
+            self.size = n
+            self.added = 0
+
+class CachedMaxEntScorer(object):
+    """
+    Memoizing MaxEntScorer. The scores of all 4^9 possible splice donors
+    are precomputed. Acceptor scores are kept in a bounded in-memory LRU 
+    cache, and optionally in an on-disk SpliceScoreCache.
+    """
+    def __init__(self, scorer, cache=None, max_size=1000000):
+        self.scorer = scorer
+        self.max_size = max_size
+        
+        # All possible donors, in order of their hash 
+        powers = 4 ** np.arange(DONOR_LENGTH - 1, -1, -1)
+        codes = (np.arange(4 ** DONOR_LENGTH)[:, None] // powers) % 4
+        self.donor_scores = scorer.score5_codes(codes.astype(np.uint8))
+        
+        self.acceptor_scores = OrderedDict()
+        self.cache = None
+        if cache:
+            self.cache = SpliceScoreCache(cache, scorer.checksum(), max_size)
+    
+    def score5(self, seqs):
+        codes, valid = encode(seqs, DONOR_LENGTH)
+        scores = self.donor_scores[hash_codes(codes)]
+        scores[~valid] = np.nan
+        return scores
+    
+    def score3(self, seqs):
+        seqs = [seq.upper() for seq in seqs]
+        
+        # In-memory cache
+        missing = set()
+        for seq in seqs:
+            if seq in self.acceptor_scores:
+                # Move to the end, as most recently used
+                self.acceptor_scores[seq] = self.acceptor_scores.pop(seq)
+            else:
+                missing.add(seq)
+        found = {}
+        
+        # On-disk cache
+        if missing and self.cache:
+            found = self.cache.get(missing)
+            missing = missing.difference(found)
+
+        # Score all sequences that have not been seen before
+        if missing:
+            missing = list(missing)
+            scores = self.scorer.score3(missing)
+            new = dict([(seq, score) for seq, score in zip(missing, scores)
+                if not np.isnan(score)])
+            if self.cache:
+                self.cache.put(new)
+            found.update(new)
+       
+        for seq, score in found.items():
+            self.acceptor_scores[seq] = score
+        while len(self.acceptor_scores) > self.max_size:
+            self.acceptor_scores.popitem(last=False)
+
+        return np.array([self.acceptor_scores.get(seq, found.get(seq, np.nan)) 
+            for seq in seqs])
+
+_scorers = {}
+
+def get_maxent_scorer(path=None, cache=None, max_size=1000000):
+    """
+    Return a CachedMaxEntScorer, models are only loaded once per process.
+    """
+    if (path, cache) not in _scorers:
+        scorer = MaxEntScorer(path)
+        _scorers[(path, cache)] = CachedMaxEntScorer(scorer, cache, max_size)
+    return _scorers[(path, cache)]
@@ -0,0 +1,662 @@
+import logging
+import yaml
+import numpy as np
+
+from pita.annotationdb import AnnotationDb, feature_orf_length
+from pita.db_backend import FeatureMixin, Feature, Evidence, ReadSource, \
+        FeatureReadCount, FeatureEvidence, LoadedSource
+from pita.io import exons_to_tabix_bed, tabix_overlap, count_reads
+from pita.util import read_statistics
+from pita.arrays import Column, Codes
+
+MEMORY_CONN = "memory"
+
+def is_memory_conn(conn):
+    """
+    Connection string of the in-memory backend. Use "memory", or
+    "memory+<conn>" to write the database to <conn> after loading.
+    """
+    return conn == MEMORY_CONN or conn.startswith(MEMORY_CONN + "+")
+
+def dump_conn(conn):
+    """ SQL connection string the in-memory database is written to """
+    if conn.startswith(MEMORY_CONN + "+"):
+        return conn[len(MEMORY_CONN) + 1:]
+    return None
+
+class MemoryRecord(object):
+    """ Evidence, read source or read count stored in MemoryAnnotationDb """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+class MemoryFeature(FeatureMixin):
+    """ Feature stored in MemoryAnnotationDb, with the same attributes
+    as pita.db_backend.Feature.
+    """
+    def __init__(self, db, feature_id):
+        self.db = db
+        self.id = feature_id
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryFeature) and \
+                self.db is other.db and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<MemoryFeature {} {}>".format(self.id, self.to_loc())
+
+    @property
+    def chrom(self):
+        return self.db._chroms.names[self.db._chrom.data[self.id - 1]]
+
+    @property
+    def start(self):
+        return int(self.db._start.data[self.id - 1])
+
+    @property
+    def end(self):
+        return int(self.db._end.data[self.id - 1])
+
+    @property
+    def strand(self):
+        return self.db._strands.names[self.db._strand.data[self.id - 1]]
+
+    @property
+    def ftype(self):
+        return self.db._ftypes.names[self.db._ftype.data[self.id - 1]]
+
+    @property
+    def seq(self):
+        return self.db._seq[self.id - 1]
+
+    @property
+    def flag(self):
+        return bool(self.db._flag.data[self.id - 1])
+
+    @property
+    def orf_length(self):
+        orf = self.db._orf_length.data[self.id - 1]
+        if orf < 0:
+            return None
+        return int(orf)
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+    @property
+    def evidences(self):
+        return [self.db._evidence[ev_id - 1] for ev_id in
+                self.db._feature_evidence.get(self.id, [])]
+
+    @property
+    def read_counts(self):
+        return [self.db._read_count_record(i) for i in
+                self.db._feature_read_counts.get(self.id, [])]
+
+class MemoryAnnotationDb(AnnotationDb):
+    """
+    AnnotationDb that keeps all data of a chromosome in memory. Features,
+    evidence links and read counts are stored in NumPy arrays, with
+    dictionaries to look them up. Nothing is written to a database,
+    unless write_sql() is called.
+    """
+    def __init__(self, index=None):
+        self.logger = logging.getLogger("pita")
+        self.session = None
+        self.bulk_load = False
+        self.target = None
+        self._init_index(index)
+        self.cache_splice_stats = {}
+        self.cache_feature_stats = {}
+
+        # features, the id is the position + 1
+        self._chroms = Codes()
+        self._strands = Codes()
+        self._ftypes = Codes()
+        self._chrom = Column(np.int32)
+        self._start = Column(np.int64)
+        self._end = Column(np.int64)
+        self._strand = Column(np.int8)
+        self._ftype = Column(np.int8)
+        self._flag = Column(np.bool_)
+        self._orf_length = Column(np.int64)
+        self._seq = []
+        self._feature_ids = {}
+        self._by_start = {}
+        self._by_end = {}
+
+        # evidence, and the links between features and evidence
+        self._evidence = []
+        self._evidence_ids = {}
+        self._feature_evidence = {}
+        self._n_evidence = Column(np.int64)
+
+        # read sources and read counts
+        self._read_sources = []
+        self._read_source_ids = {}
+        self._spans = Codes()
+        self._rc_source = Column(np.int64)
+        self._rc_feature = Column(np.int64)
+        self._rc_count = Column(np.float64)
+        self._rc_span = Column(np.int8)
+        self._rc_up = Column(np.int64)
+        self._rc_down = Column(np.int64)
+        self._read_count_ids = {}
+        self._feature_read_counts = {}
+        self._signal = {}
+
+        # loaded annotation and data
+        self._loaded = []
+
+    def close(self):
+        pass
+
+    def finish_load(self):
+        pass
+
+    def clear_stats_cache(self):
+        self.cache_feature_stats = {}
+        self.cache_splice_stats = {}
+        self._signal = {}
+
+    def _add_features(self, rows):
+        """ Add features as (chrom, start, end, strand, ftype, seq) tuples,
+        existing features are skipped. Returns the feature ids.
+        """
+        ids = []
+        new = []
+        n = len(self._seq)
+        for row in rows:
+            key = tuple(row[:5])
+            if key not in self._feature_ids:
+                n += 1
+                self._feature_ids[key] = n
+                chrom, start, end, strand, ftype = key
+                self._by_start.setdefault(
+                        (chrom, strand, ftype, start), []).append(n)
+                self._by_end.setdefault(
+                        (chrom, strand, ftype, end), []).append(n)
+                new.append(row)
+            ids.append(self._feature_ids[key])
+
+        if new:
+            self._chrom.extend([self._chroms.encode(r[0]) for r in new])
+            self._start.extend([r[1] for r in new])
+            self._end.extend([r[2] for r in new])
+            self._strand.extend([self._strands.encode(r[3]) for r in new])
+            self._ftype.extend([self._ftypes.encode(r[4]) for r in new])
+            self._flag.extend(np.zeros(len(new), dtype=np.bool_))
+            self._n_evidence.extend(np.zeros(len(new), dtype=np.int64))
+            self._seq += [r[5] or "" for r in new]
+            orfs = [feature_orf_length(r[4], r[5]) for r in new]
+            self._orf_length.extend([-1 if orf is None else orf 
+                for orf in orfs])
+            self._signal = {}
+        return ids
+
+    def _add_evidence(self, name, source):
+        key = (name, source)
+        if key not in self._evidence_ids:
+            ev_id = len(self._evidence) + 1
+            self._evidence.append(MemoryRecord(id=ev_id, name=name,
+                source=source))
+            self._evidence_ids[key] = ev_id
+        return self._evidence_ids[key]
+
+    def _link(self, feature_id, evidence_id):
+        ev_ids = self._feature_evidence.setdefault(feature_id, [])
+        if evidence_id not in ev_ids:
+            ev_ids.append(evidence_id)
+            self._n_evidence.data[feature_id - 1] += 1
+
+    def _get_read_source(self, name, source):
+        key = (name, source)
+        if key not in self._read_source_ids:
+            r = MemoryRecord(id=len(self._read_sources) + 1, name=name,
+                    source=source, nreads=0)
+            self._read_sources.append(r)
+            self._read_source_ids[key] = r.id
+        return self._read_sources[self._read_source_ids[key] - 1]
+
+    def _add_read_counts(self, rows):
+        """ Add read counts as (read_source_id, feature_id, count, span,
+        extend_up, extend_down) tuples. Counts of existing rows are
+        increased.
+        """
+        new = []
+        for row in rows:
+            key = (row[0], row[1]) + tuple(row[3:])
+            if key in self._read_count_ids:
+                self._rc_count.data[self._read_count_ids[key]] += row[2]
+            else:
+                i = len(self._rc_count) + len(new)
+                self._read_count_ids[key] = i
+                self._feature_read_counts.setdefault(row[1], []).append(i)
+                new.append(row)
+
+        if new:
+            self._rc_source.extend([r[0] for r in new])
+            self._rc_feature.extend([r[1] for r in new])
+            self._rc_count.extend([r[2] for r in new])
+            self._rc_span.extend([self._spans.encode(r[3]) for r in new])
+            self._rc_up.extend([r[4] for r in new])
+            self._rc_down.extend([r[5] for r in new])
+        self.clear_stats_cache()
+
+    def _read_count_record(self, i):
+        read_source = self._read_sources[self._rc_source.data[i] - 1]
+        return MemoryRecord(
+                read_source_id=read_source.id,
+                read_source=read_source,
+                feature_id=int(self._rc_feature.data[i]),
+                count=float(self._rc_count.data[i]),
+                span=self._spans.names[self._rc_span.data[i]],
+                extend_up=int(self._rc_up.data[i]),
+                extend_down=int(self._rc_down.data[i]),
+                )
+
+    def _store_transcripts(self, features, evidences, links, ids=None):
+        keys = sorted(features.keys())
+        ids = dict(zip(keys,
+            self._add_features([key + (features[key],) for key in keys])))
+        for key, ev in sorted(links):
+            self._link(ids[key], self._add_evidence(*ev))
+
+    def _features(self, mask):
+        """ Features selected by mask, ordered by location """
+        idx = np.nonzero(mask)[0]
+        order = np.lexsort((
+            self._strands.ranks()[self._strand.values[idx]],
+            self._end.values[idx],
+            self._start.values[idx],
+            self._chroms.ranks()[self._chrom.values[idx]],
+            ))
+        return [MemoryFeature(self, int(i) + 1) for i in idx[order]]
+
+    def _mask(self, ftype=None, chrom=None):
+        mask = ~self._flag.values
+        if chrom:
+            mask &= self._chrom.values == self._chroms.get(chrom)
+        if ftype:
+            mask &= self._ftype.values == self._ftypes.get(ftype)
+        return mask
+
+    def _read_sums(self):
+        """ Summed read count per feature, NaN without read counts """
+        n = len(self._seq) + 1
+        counts = np.bincount(self._rc_feature.values, minlength=n)
+        sums = np.bincount(self._rc_feature.values,
+                weights=self._rc_count.values, minlength=n)
+        sums[counts == 0] = np.nan
+        return sums[1:]
+
+    def get_features(self, ftype=None, chrom=None, eager=False,
+            min_length=None, max_length=None, evidence=0):
+
+        mask = self._mask(ftype, chrom)
+        length = self._end.values - self._start.values
+
+        # length filters, features with enough evidence are always kept;
+        # evidence=None keeps all features
+        if evidence is None:
+            enough_evidence = True
+        else:
+            enough_evidence = self._n_evidence.values >= evidence
+
+        if max_length:
+            mask &= (length <= max_length) | enough_evidence
+        if min_length:
+            mask &= (length >= min_length) | enough_evidence
+
+        return self._features(mask)
+
+    def get_features_by_id(self, ids):
+        return [MemoryFeature(self, int(i)) for i in sorted(set(ids))]
+
+    def get_splice_junctions(self, chrom=None, ev_count=None, read_count=None, max_reads=None, eager=False):
+
+        if not (ev_count and read_count) and not max_reads:
+            return self.get_features(ftype="splice_junction", chrom=chrom)
+
+        mask = self._mask("splice_junction", chrom)
+        n_evidence = self._n_evidence.values
+        n_reads = self._read_sums()
+        no_reads = np.isnan(n_reads)
+
+        if ev_count and read_count:
+            # Splices with enough reads, or with less (or no) reads
+            # but enough evidence sources
+            enough_reads = ~no_reads & (np.nan_to_num(n_reads) >= read_count)
+            enough_evidence = n_evidence >= ev_count
+            groups = [
+                    mask & enough_evidence & ~no_reads & ~enough_reads,
+                    mask & enough_evidence & no_reads,
+                    mask & enough_reads,
+                    ]
+        else:
+            # Splices with less than max_reads, that have evidence
+            few_reads = ~no_reads & (np.nan_to_num(n_reads) < max_reads)
+            groups = [
+                    mask & (n_evidence > 0) & no_reads,
+                    mask & (n_evidence > 0) & few_reads,
+                    ]
+
+        features = []
+        for group in groups:
+            features += sorted(self._features(group), key=lambda f: f.id)
+        return features
+
+    def get_longest_3prime_exon(self, chrom, start5, strand):
+        if strand == "+":
+            ids = self._by_start.get((chrom, strand, "exon", start5), [])
+            exons = [MemoryFeature(self, i) for i in ids
+                    if not self._flag.data[i - 1]]
+            return sorted(exons, key=lambda e: e.end)[-1]
+        else:
+            ids = self._by_end.get((chrom, strand, "exon", start5), [])
+            exons = [MemoryFeature(self, i) for i in ids]
+            return sorted(exons, key=lambda e: e.end)[0]
+
+    def get_long_exons(self, chrom, l, evidence):
+        mask = self._mask("exon", chrom)
+        mask &= (self._end.values - self._start.values) >= l
+        mask &= self._n_evidence.values <= evidence
+        return self._features(mask)
+
+    def filter_repeats(self, chrom, rep):
+        """ Flag all exons that overlap with a specified fraction
+        with a repeat track
+        """
+        self.logger.warn("Filtering repeats: %s with fraction %s",
+                rep["path"], rep["fraction"])
+
+        exons = self.get_features("exon", chrom)
+        if len(exons) == 0:
+            return
+        exon_tabix = exons_to_tabix_bed(exons)
+
+        overlap_it = tabix_overlap(exon_tabix, rep["tabix"], chrom, rep["fraction"])
+        exon_ids = [int(iv[3]) for iv in overlap_it]
+        self.logger.warn("Filtering %s", exon_ids)
+        self._flag.data[np.array(exon_ids, dtype=np.int64) - 1] = True
+
+    def filter_evidence(self, chrom, source, experimental):
+        self.logger.debug("Filtering %s", source)
+
+        # Flag features with support from only one transcript of source,
+        # that are not supported by any other source
+        for feature_id, ev_ids in self._feature_evidence.items():
+            if self._chroms.names[self._chrom.data[feature_id - 1]] != chrom:
+                continue
+            sources = [self._evidence[i - 1].source for i in ev_ids]
+            if sources == [source]:
+                self._flag.data[feature_id - 1] = True
+
+    def get_read_statistics(self, chrom, fnames, name, span="all", extend=(0,0), nreads=None, min_id=None):
+
+        if span not in ["all", "start", "end"]:
+            raise Exception("Incorrect span: {}".format(span))
+
+        exons =  self.get_exons(chrom)
+        if min_id:
+            exons = [exon for exon in exons if exon.id > min_id]
+        if len(exons) == 0:
+            return
+
+        estore = self._read_windows(exons, span, extend)
+
+        # Empty windows are skipped
+        windows = sorted([w for w in estore.keys() if w[1] > w[0]])
+        starts = [w[0] for w in windows]
+        ends = [w[1] for w in windows]
+
+        if type("") == type(fnames):
+            fnames = [fnames]
+
+        for i, fname in enumerate(fnames):
+            read_source = self._get_read_source(name, fname)
+            if fname.endswith("bam") and (not nreads or not nreads[i]) \
+                    and not read_source.nreads:
+                self.logger.debug("Counting reads in %s", fname)
+                read_source.nreads = read_statistics(fname)
+
+            self.logger.debug("Counting reads in %s windows from %s",
+                    len(windows), fname)
+            counts = count_reads(fname, chrom, starts, ends)
+
+            self._add_read_counts([
+                (read_source.id, exon_id, float(count), span, extend[0], extend[1])
+                for window, count in zip(windows, counts)
+                for exon_id in estore[window]])
+
+    def get_splice_statistics(self, chrom, fnames, name, tabix_files=None):
+        """
+        Load splice junction read counts for chrom. Files are either
+        tabix-indexed, or tab-separated with chrom, start, end, count
+        and strand in column 1, 2, 3, 4 and 6. If dict tabix_files has
+        an indexed version of a file, that one is read.
+        """
+        if type("") == type(fnames):
+            fnames = [fnames]
+        if tabix_files is None:
+            tabix_files = {}
+
+        for fname in fnames:
+            self.logger.debug("Getting splicing data from %s", fname)
+            read_source = self._get_read_source(name, fname)
+
+            counts = self._splice_counts(tabix_files.get(fname, fname), chrom)
+            keys = sorted(counts.keys())
+            ids = self._add_features([key + ("",) for key in keys])
+            self._add_read_counts([(read_source.id, feature_id, counts[key],
+                "all", 0, 0) for key, feature_id in zip(keys, ids)])
+
+    def get_junction_exons(self, junction):
+        left = self._by_end.get((junction.chrom, junction.strand, "exon",
+            junction.start), [])
+        right = self._by_start.get((junction.chrom, junction.strand, "exon",
+            junction.end), [])
+
+        exon_pairs = []
+        for i in left:
+            for j in right:
+                if not (self._flag.data[i - 1] or self._flag.data[j - 1]):
+                    exon_pairs.append((MemoryFeature(self, i),
+                        MemoryFeature(self, j)))
+        return exon_pairs
+
+    def get_junction_exon_triples(self, chrom, junctions=None):
+        """
+        Return (junction, left exon, right exon) for all splice junctions
+        on chrom (all chromosomes if chrom is None), or for the junctions
+        given.
+        """
+        if junctions is None:
+            junctions = self.get_splice_junctions(chrom)
+
+        triples = []
+        for junction in junctions:
+            for e1, e2 in self.get_junction_exons(junction):
+                triples.append((junction, e1, e2))
+        return triples
+
+    def feature_stats(self, feature, identifier):
+        if identifier not in self._signal:
+            # Summed counts of all sources with this name, per feature
+            source_ids = [r.id for r in self._read_sources
+                    if r.name == identifier]
+            select = np.in1d(self._rc_source.values, source_ids)
+            self._signal[identifier] = np.bincount(
+                    self._rc_feature.values[select],
+                    weights=self._rc_count.values[select],
+                    minlength=len(self._seq) + 1)
+        return self._signal[identifier][feature.id]
+
+    def _fetch_splice_junction(self, chrom, strand, start, end):
+        feature_id = self._feature_ids.get(
+                (chrom, start, end, strand, "splice_junction"))
+        if feature_id:
+            return MemoryFeature(self, feature_id)
+
+    def splice_stats(self, exon1, exon2, identifier):
+        splice = self._fetch_splice_junction(exon1.chrom, exon1.strand,
+                exon1.end, exon2.start)
+        return self.feature_stats(splice, identifier)
+
+    def intron_splice_stats(self, intron, identifier):
+        splice = self._fetch_splice_junction(intron.chrom, intron.strand,
+                intron.start, intron.end)
+        return self.feature_stats(splice, identifier)
+
+    def nreads(self, identifier):
+        return sum([s.nreads for s in self._read_sources
+            if s.name == identifier])
+
+    def get_splice_count(self, e1, e2):
+        count = 0
+        for strand in self._strands.names:
+            splice = self._fetch_splice_junction(e1.chrom, strand,
+                    e1.end, e2.start)
+            if splice:
+                count += sum([int(r.count) for r in splice.read_counts])
+        return count
+
+    def fetch_feature(self, f):
+        """ Feature as list """
+        chrom, start, end, strand, ftype, seq = f
+        feature_id = self._feature_ids.get((chrom, start, end, strand, ftype))
+        if feature_id and (not seq or self._seq[feature_id - 1] == seq):
+            return MemoryFeature(self, feature_id)
+
+    def fetch_evidence(self, f):
+        """ Feature as list """
+        ev_id = self._evidence_ids.get(tuple(f))
+        if ev_id:
+            return self._evidence[ev_id - 1]
+
+    def get_transcript_statistics(self, exons):
+        stats = []
+        for exon in exons:
+            counts = {}
+            for ftype in self._ftypes.names:
+                feature = self.fetch_feature(tuple(exon[:4]) + (ftype, None))
+                if feature:
+                    for r in feature.read_counts:
+                        name = r.read_source.name
+                        counts[name] = counts.get(name, 0) + r.count
+            stats.append(dict([(k, int(v)) for k,v in counts.items()]))
+        return stats
+
+    def _rows(self):
+        """ All data, as rows of the database tables """
+        features = [[i + 1, self._chroms.names[self._chrom.data[i]],
+                int(self._start.data[i]), int(self._end.data[i]),
+                self._strands.names[self._strand.data[i]],
+                self._ftypes.names[self._ftype.data[i]], self._seq[i],
+                bool(self._flag.data[i]), MemoryFeature(self, i + 1).orf_length]
+                for i in range(len(self._seq))]
+        read_sources = [[r.id, r.name, r.source, r.nreads] for r in
+                self._read_sources]
+        read_counts = [[int(self._rc_source.data[i]),
+                int(self._rc_feature.data[i]), float(self._rc_count.data[i]),
+                self._spans.names[self._rc_span.data[i]],
+                int(self._rc_up.data[i]), int(self._rc_down.data[i])]
+                for i in range(len(self._rc_count))]
+        evidence = [[r.id, r.name, r.source] for r in self._evidence]
+        feature_evidence = [[f_id, ev_id] for f_id in
+                sorted(self._feature_evidence.keys())
+                for ev_id in self._feature_evidence[f_id]]
+        return features, read_sources, read_counts, evidence, feature_evidence
+
+    def dump_yaml(self):
+        features, read_sources, read_counts, evidence, feature_evidence = \
+                self._rows()
+        dump_dict = {}
+        dump_dict['feature'] = [row[:7] for row in features]
+        dump_dict['read_source'] = read_sources
+        dump_dict['read_count'] = read_counts
+        dump_dict['evidence'] = evidence
+        dump_dict['feature_evidence'] = feature_evidence
+        return yaml.dump(dump_dict)
+
+    def load_yaml(self, fname):
+        data = yaml.load(open(fname))
+        if not data['feature']:
+            return
+
+        source_map = {}
+        for old_id,name,source,nreads in data['read_source']:
+            r = self._get_read_source(name, source)
+            r.nreads = nreads
+            source_map[old_id] = r.id
+
+        ids = self._add_features([row[1:] for row in data['feature']])
+        f_map = dict(zip([row[0] for row in data['feature']], ids))
+        self._add_read_counts([[source_map[row[0]], f_map[row[1]]] + row[2:]
+            for row in data['read_count']])
+
+        ev_map = {}
+        for old_id, name, source in data['evidence'] or []:
+            ev_map[old_id] = self._add_evidence(name, source)
+        for f_id, ev_id in data['feature_evidence'] or []:
+            self._link(f_map[f_id], ev_map[ev_id])
+
+    def is_loaded(self, chrom, kind, name, source, span=None, extend=(0, 0)):
+        return self._source_key(chrom, kind, name, source, span, extend) \
+                in self._loaded
+
+    def mark_loaded(self, chrom, kind, name, source, span=None, 
+            extend=(0, 0)):
+        self._loaded.append(
+                self._source_key(chrom, kind, name, source, span, extend))
+
+    def loaded_sources(self, chrom):
+        return [key for key in self._loaded if key["chrom"] == chrom]
+
+    def max_feature_id(self):
+        return len(self._seq)
+
+    def max_ids(self):
+        return [len(self._seq), len(self._evidence), len(self._read_sources)]
+
+    def get_model_run(self, chrom):
+        """ Models are not kept, there is no previous run in memory """
+        return None
+
+    def store_model_run(self, chrom, config, max_values, models):
+        pass
+
+    def write_sql(self, conn):
+        """ Write the database to a new SQL database """
+        self.logger.debug("Writing database to %s", conn)
+        features, read_sources, read_counts, evidence, feature_evidence = \
+                self._rows()
+
+        db = AnnotationDb(conn=conn, new=True, bulk_load=True)
+        for model, t, rows in [
+                (Feature, ["id", "chrom", "start", "end", "strand", "ftype",
+                    "seq", "flag", "orf_length"], features),
+                (ReadSource, ["id", "name", "source", "nreads"], read_sources),
+                (FeatureReadCount, ["read_source_id", "feature_id", "count",
+                    "span", "extend_up", "extend_down"], read_counts),
+                (Evidence, ["id", "name", "source"], evidence),
+                (FeatureEvidence, ["feature_id", "evidence_id"],
+                    feature_evidence),
+                (LoadedSource, None, self._loaded),
+                ]:
+            if rows:
+                if t:
+                    rows = [dict(zip(t, row)) for row in rows]
+                db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+        db.finish_load()
+        db.close()
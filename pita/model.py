@@ -1,20 +1,85 @@
 from pita.dbcollection import DbCollection
 from pita.annotationdb import AnnotationDb
+from pita.memorydb import MemoryAnnotationDb, is_memory_conn, dump_conn
 from pita.io import TabixIteratorAsFile, read_gff_transcripts, read_bed_transcripts
-from pita.util import get_overlapping_models
+from pita.util import get_overlapping_genes
+import os
 import logging
+import hashlib
+import yaml
 import pysam
+import numpy as np
 from pita.config import SEP
 
-def load_chrom_data(conn, new, chrom, anno_files, data, index=None):
+def _settings_key(*settings):
+    """ Hash of the settings of a run """
+    return hashlib.sha1(yaml.dump(list(settings))).hexdigest()
+
+def _repeat_settings(repeats):
+    """ Repeat settings without the tabix file, which is temporary """
+    return [dict([(k, v) for k, v in r.items() if k != "tabix"]) 
+            for r in repeats or []]
+
+def _source_files(db, chrom):
+    """ 
+    Annotation and data files loaded for chrom, with the size and 
+    modification time of every file
+    """
+    files = []
+    for source in db.loaded_sources(chrom):
+        for fname in source["source"].split(","):
+            try:
+                st = os.stat(fname)
+                stat = [st.st_size, st.st_mtime]
+            except OSError:
+                stat = None
+            files.append([sorted(source.items()), os.path.abspath(fname), 
+                stat])
+    return files
+
+def load_snapshot(fname, key, db, weight, chrom):
+    """
+    DbCollection of chrom from graph snapshot fname. Returns None if 
+    there is no snapshot, or if it was saved with another key.
+    """
+    logger = logging.getLogger("pita")
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname, allow_pickle=True) as npz:
+        saved_key = npz["key"][0]
+    if saved_key != key:
+        logger.info("Graph snapshot %s is outdated", fname)
+        return None
+    logger.info("Loading graph of %s from %s", chrom, fname)
+    mc, extra = DbCollection.load(fname, db, weight, chrom=chrom)
+    return mc
+
+def load_chrom_data(conn, new, chrom, anno_files, data, index=None, bulk_load=False, tabix_files=None):
+    """
+    Load annotation and data of chrom and return the database. With the
+    in-memory backend (see pita.memorydb) the database only exists in 
+    this process, so pass it on to get_chrom_models. Splice data is read
+    from the indexed files in dict tabix_files, if specified.
+
+    Annotation and data that are already in an existing database are 
+    skipped, only the read counts of new exons are added.
+    """
     logger = logging.getLogger("pita")
     
     try:
         # Read annotation files
-        db = AnnotationDb(index=index, conn=conn, new=new)
-        logger.debug("%s %s", chrom, id(db.session))
+        if is_memory_conn(conn):
+            db = MemoryAnnotationDb(index=index)
+        else:
+            db = AnnotationDb(index=index, conn=conn, new=new, 
+                bulk_load=bool(bulk_load), in_memory=(bulk_load == "memory"))
+        logger.debug("%s %s", chrom, id(db))
+        max_feature_id = db.max_feature_id()
         logger.info("Reading annotation for %s", chrom)
         for name, fname, tabix_file, ftype, min_exons in anno_files:
+            if db.is_loaded(chrom, "annotation", name, fname):
+                logger.info("Annotation from %s already loaded", fname)
+                continue
             logger.info("Reading annotation from %s", fname)
             tabixfile = pysam.Tabixfile(tabix_file)
             #tabixfile = fname
@@ -26,41 +91,120 @@ def load_chrom_data(conn, new, chrom, anno_files, data, index=None):
                 elif ftype in ["gff", "gtf", "gff3"]:
                     it = read_gff_transcripts(fobj, fname, 
                             min_exons=min_exons, merge=10)
-                for tname, source, exons in it:
-                    db.add_transcript(
-                            "{0}{1}{2}".format(name, SEP, tname), 
-                            source, exons)
+                db.add_transcripts(
+                        ["{0}{1}{2}".format(name, SEP, tname), source, exons] 
+                        for tname, source, exons in it)
                 del fobj    
             tabixfile.close()
             del tabixfile
+            db.mark_loaded(chrom, "annotation", name, fname)
         
         logger.info("Loading data for %s", chrom)
 
         for name, fname, span, extend in data:
+            if db.is_loaded(chrom, "data", name, fname, span, extend):
+                # Splice junctions are counted when the data is loaded
+                if span != "splice" and max_feature_id > 0 and \
+                        db.max_feature_id() > max_feature_id:
+                    logger.info("Reading BAM data %s for new exons", name)
+                    db.get_read_statistics(chrom, fname, name=name, 
+                            span=span, extend=extend, min_id=max_feature_id)
+                continue
             if span == "splice":
                 logger.info("Reading splice data %s from %s", name, fname)
-                db.get_splice_statistics(chrom, fname, name)
+                db.get_splice_statistics(chrom, fname, name, tabix_files)
             else:
                 logger.info("Reading BAM data %s from %s", name, fname)
                 db.get_read_statistics(chrom, fname, name=name, span=span, extend=extend, nreads=None)
+            db.mark_loaded(chrom, "data", name, fname, span, extend)
+        
+        db.finish_load()
+        if is_memory_conn(conn) and dump_conn(conn):
+            db.write_sql(dump_conn(conn))
+        
+        return db
  
     except:
         logger.exception("Error on %s", chrom)
         raise
 
-def get_chrom_models(conn, chrom, weight, repeats=None, prune=None, keep=None, filter_ev=None, experimental=None):
-    if keep is None:
-        keep = []
-    if filter_ev is None:
-        filter_ev = []
-    if experimental is None:
-        experimental = []
-
+def prune_overlap(models, fraction, weights, get_weight):
+    """
+    Genes to discard of the overlapping genes in dict models, with the 
+    exons of every gene. Of two genes that overlap by at least fraction
+    of one of them, the gene with the lowest score (as calculated by 
+    get_weight) is discarded. Without weights, or if neither score is 
+    positive, the gene of the last overlapping exon is discarded.
+    """
     logger = logging.getLogger("pita")
-    logger.debug(str(weight)) 
-    try:
-        db = AnnotationDb(conn=conn)
+    pairs = get_overlapping_genes(models)
+    if len(pairs) > 1:
+        logger.info("%s overlapping genes", len(pairs))
+   
+    # Score of every gene, calculated once
+    scores = {}
+    def score(gene):
+        if gene not in scores:
+            scores[gene] = -get_weight(models[gene])
+        return scores[gene]
+
+    discard = {}
+    for gene1, gene2 in pairs:
+        if gene1 in discard or gene2 in discard:
+            continue
+        loc1, loc2 = sorted([models[gene1], models[gene2]], 
+                key=lambda x: x[0].start)
+        l1 = float(loc1[-1].end - loc1[0].start)
+        l2 = float(loc2[-1].end - loc2[0].start)
+        if loc2[-1].end > loc1[-1].end:
+            overlap = float(loc1[-1].end - loc2[0].start)
+        else:
+            overlap = l2
+        
+        if overlap / l1 < fraction and overlap / l2 < fraction:
+            logger.debug("Not pruning because fraction of overlap is too small!")
+            continue
+        
+        # Scores are only compared if one of them is positive
+        w1, w2 = 0.0, 0.0
+        if weights:
+            w1, w2 = score(gene1), score(gene2)
+            if max(w1, w2) <= 0:
+                w1, w2 = 0.0, 0.0
         
+        if w1 >= w2:
+            logger.info("Discarding %s", gene2)
+            discard[gene2] = 1
+        else:
+            logger.info("Discarding %s", gene1)
+            discard[gene1] = 1
+    return discard
+
+def _chrom_db(conn, chrom, db=None):
+    """ Database with the data of chrom """
+    if db is None:
+        if is_memory_conn(conn):
+            if not dump_conn(conn):
+                raise ValueError("No data loaded for {}".format(chrom))
+            conn = dump_conn(conn)
+        db = AnnotationDb(conn=conn)
+    return db
+
+def _chrom_collection(db, chrom, weight, repeats, prune, filter_ev, 
+        experimental, snapshot=None):
+    """ 
+    DbCollection of chrom, loaded from snapshot if possible, see 
+    get_chrom_models()
+    """
+    logger = logging.getLogger("pita")
+    mc = None
+    if snapshot:
+        snapshot_key = _settings_key(prune, _repeat_settings(repeats), 
+                filter_ev, experimental, db.max_ids(), 
+                _source_files(db, chrom))
+        mc = load_snapshot(snapshot, snapshot_key, db, weight, chrom)
+    
+    if mc is None:
         # Filter repeats
         if repeats:
             for x in repeats:
@@ -70,94 +214,159 @@ def get_chrom_models(conn, chrom, weight, repeats=None, prune=None, keep=None, f
             db.filter_evidence(chrom, ev, experimental) 
         
         mc = DbCollection(db, weight, prune=prune, chrom=chrom)
-       
-        # Remove short introns
-        #mc.filter_short_introns()
-      
-        models = {}
-        exons = {}
-        logger.info("Calling transcripts for %s", chrom)
-        for model in mc.get_best_variants(weight):
-            genename = "{0}:{1}-{2}_".format(
-                                        model[0].chrom,
-                                        model[0].start,
-                                        model[-1].end,
-                                        )
-                   
-                
-            logger.info("Best model: %s with %s exons", 
-                    genename, len(model))
-            models[genename] = [genename, model]
+        if snapshot:
+            logger.info("Saving graph of %s to %s", chrom, snapshot)
+            mc.save(snapshot, key=np.array([snapshot_key]))
+    return mc
+
+def _call_models(mc, chrom, weight, prune, threads=1, previous=None):
+    """
+    Call the models of chrom in collection mc. Returns the models that
+    are not pruned as list of [genename, exons], and the exon ids of all
+    called models.
+    """
+    logger = logging.getLogger("pita")
+   
+    # Remove short introns
+    #mc.filter_short_introns()
+  
+    models = {}
+    logger.info("Calling transcripts for %s", chrom)
+    called = []
+    for model in mc.get_best_variants(weight, threads, 
+            previous=previous):
+        called.append([e.id for e in model])
+        genename = "{0}:{1}-{2}_".format(
+                                    model[0].chrom,
+                                    model[0].start,
+                                    model[-1].end,
+                                    )
+               
             
-            for exon in model:
-                exons[str(exon)] = [exon, genename]
-
-        discard = {}
-        if prune:
-            logger.debug("Prune: {0}".format(prune))
-            overlap = get_overlapping_models([x[0] for x in exons.values()])
-            if len(overlap) > 1:
-                logger.info("%s overlapping exons", len(overlap))
-#                logger.warn("Overlap: {0}".format(overlap))
-                
-            gene_count = {}
-            for e1, e2 in overlap:
-                gene1 = exons[str(e1)][1]
-                gene2 = exons[str(e2)][1]
-                gene_count[gene1] = gene_count.setdefault(gene1, 0) + 1
-                gene_count[gene2] = gene_count.setdefault(gene2, 0) + 1
-
-            for e1, e2 in overlap:
-                gene1 = exons[str(e1)][1]
-                gene2 = exons[str(e2)][1]
-                if not(gene1 in discard or gene2 in discard):
-                    m1 = models[gene1][1]
-                    m2 = models[gene2][1]
-                
-                    loc1,loc2 = sorted([m1, m2], cmp=lambda x,y: cmp(x[0].start, y[0].start))
-                    l1 = float(loc1[-1].end - loc1[0].start)
-                    l2 = float(loc2[-1].end - loc2[0].start)
-                    if loc2[-1].end > loc1[-1].end:
-                        overlap = float(loc1[-1].end - loc2[0].start)
-                    else:
-                        overlap = l2
-
-                    #logger.info("Pruning {} vs. {}".format(str(m1),str(m2)))
-                    #logger.info("1: {}, 2: {}, overlap: {}".format(
-                    #    l1, l2, overlap))
-                    #logger.info("Gene {} count {}, gene {} count {}".format(
-                    #    str(gene1), gene_count[gene1], str(gene2), gene_count[gene2]
-                    #    ))
-#                   
-                    prune_overlap = prune["overlap"]["fraction"]
-                    if overlap / l1 < prune_overlap and overlap / l2 < prune_overlap:
-                        logger.debug("Not pruning because fraction of overlap is too small!")
-                        continue
-                    
-                    w1 = 0.0
-                    w2 = 0.0
-                    for d in prune["overlap"]["weights"]:
-                        logger.debug("Pruning overlap: %s", d)
-                        tmp_w1 = -mc.get_weight(m1)
-                        tmp_w2 = -mc.get_weight(m2)
-                        m = max((tmp_w1, tmp_w2))
-                        if m > 0:
-                            w1 += tmp_w1 / max((tmp_w1, tmp_w2))
-                            w2 += tmp_w2 / max((tmp_w1, tmp_w2))
-
-                    if w1 >= w2:
-                        logger.info("Discarding %s", gene2)
-                        discard[gene2] = 1
-                    else:
-                        logger.info("Discarding %s", gene1)
-                        discard[gene1] = 1
+        logger.info("Best model: %s with %s exons", 
+                genename, len(model))
+        models[genename] = [genename, model]
+
+    discard = {}
+    if prune:
+        logger.debug("Prune: {0}".format(prune))
+        discard = prune_overlap(
+                dict([(name, m[1]) for name, m in models.items()]),
+                prune["overlap"]["fraction"], 
+                prune["overlap"]["weights"], mc.get_weight)
+    
+    logger.info("Done calling transcripts for %s", chrom)
+    result = [v for m,v in models.items() if not m in discard]
+    #print "VV", result
+    return [[name, [e.to_flat_exon() for e in exons]] 
+            for name, exons in result], called
+
+def get_chrom_models(conn, chrom, weight, repeats=None, prune=None, keep=None, filter_ev=None, experimental=None, db=None, threads=1, incremental=False, snapshot=None):
+    """
+    Call the transcripts of chrom. In incremental mode, the models of 
+    the previous run with the same settings are reused for all connected
+    components without new or changed features.
+
+    If snapshot is specified, the graph is saved to this file. The next 
+    time the graph is loaded from the snapshot if the annotation and data
+    files (path, size and modification time) and the filter settings 
+    didn't change, the scoring can differ.
+    """
+    if keep is None:
+        keep = []
+    if filter_ev is None:
+        filter_ev = []
+    if experimental is None:
+        experimental = []
+
+    logger = logging.getLogger("pita")
+    logger.debug(str(weight)) 
+    try:
+        db = _chrom_db(conn, chrom, db)
+        mc = _chrom_collection(db, chrom, weight, repeats, prune, filter_ev,
+                experimental, snapshot)
         
-        logger.info("Done calling transcripts for %s", chrom)
-        result = [v for m,v in models.items() if not m in discard]
-        #print "VV", result
-        return [[name, [e.to_flat_exon() for e in exons]] for name, exons in result]
+        previous = None
+        if incremental:
+            settings = _settings_key(weight, prune, 
+                    _repeat_settings(repeats), filter_ev, experimental, keep)
+            run = db.get_model_run(chrom)
+            if run and run["config"] == settings:
+                run["changed"] = db.get_changed_features(chrom, run)
+                previous = run
+            elif run:
+                logger.info("Settings changed, calling all models of %s", 
+                        chrom)
+       
+        result, called = _call_models(mc, chrom, weight, prune, threads, 
+                previous)
+        if incremental:
+            db.store_model_run(chrom, settings, mc.max_id_value, called)
+        return result
 
     except:
         logger.exception("Error on %s", chrom)
   
     return []
+
+def get_chrom_alternatives(conn, chrom, weight, k, repeats=None, prune=None, filter_ev=None, experimental=None, db=None, threads=1, snapshot=None):
+    """
+    The k best models of every connected component of chrom, as list of
+    [genename, score, exons]. The models of a component share the name 
+    of the best model with the rank added, the score is the negated 
+    weight of the model: higher is better. Models are not pruned.
+    """
+    if filter_ev is None:
+        filter_ev = []
+    if experimental is None:
+        experimental = []
+
+    logger = logging.getLogger("pita")
+    try:
+        db = _chrom_db(conn, chrom, db)
+        mc = _chrom_collection(db, chrom, weight, repeats, prune, filter_ev,
+                experimental, snapshot)
+        logger.info("Calling %s alternative transcripts for %s", k, chrom)
+        result = []
+        for models in mc.get_k_best_variants(weight, k, threads):
+            best = models[0][1]
+            locus = "{0}:{1}-{2}_".format(best[0].chrom, best[0].start, 
+                    best[-1].end)
+            for rank, (w, model) in enumerate(models):
+                result.append(["{0}{1}".format(locus, rank + 1), -w, 
+                    [e.to_flat_exon() for e in model]])
+        return result
+    
+    except:
+        logger.exception("Error on %s", chrom)
+  
+    return []
+
+def get_chrom_models_sweep(conn, chrom, weights, repeats=None, prune=None, keep=None, filter_ev=None, experimental=None, db=None, threads=1, snapshot=None):
+    """
+    Call the transcripts of chrom for every scoring configuration in 
+    weights, as get_chrom_models(). The graph is built once, only the 
+    scoring is repeated. Returns a list with the models of every 
+    configuration.
+    """
+    if filter_ev is None:
+        filter_ev = []
+    if experimental is None:
+        experimental = []
+
+    logger = logging.getLogger("pita")
+    try:
+        db = _chrom_db(conn, chrom, db)
+        mc = _chrom_collection(db, chrom, weights[0], repeats, prune, 
+                filter_ev, experimental, snapshot)
+        results = []
+        for i, weight in enumerate(weights):
+            logger.info("Scoring configuration %s of %s", i + 1, len(weights))
+            results.append(
+                    _call_models(mc, chrom, weight, prune, threads)[0])
+        return results
+    
+    except:
+        logger.exception("Error on %s", chrom)
+  
+    return [[] for weight in weights]
@@ -1,10 +1,9 @@
-from pita.config import SAMTOOLS
 from pita.config import config
-from subprocess import Popen, PIPE
+from pita.maxent import get_maxent_scorer
 from Bio.Seq import Seq
 from Bio.Alphabet import IUPAC
-import subprocess as sp
-from tempfile import NamedTemporaryFile
+import numpy as np
+import pysam
 import logging
 
 logger = logging.getLogger('pita')
@@ -19,24 +18,16 @@ def read_statistics(fname, rmrepeat=False, rmdup=False, mapped=False):
     if rmdup:
         pass
 
-    cmd = "{0} idxstats {1} | awk '{{total += $3 + $4}} END {{print total}}'"
-
-    p = Popen(
-             cmd.format(SAMTOOLS, fname), 
-             shell=True, 
-             stdout=PIPE, 
-             stderr=PIPE
-             )
-
-    stdout,_ = p.communicate()
-
-    n = int(stdout.strip())
+    # Same as the sum of mapped and unmapped reads from samtools idxstats
+    bam = pysam.AlignmentFile(fname, "rb")
+    n = sum([s.total for s in bam.get_index_statistics()]) + bam.nocoordinate
+    bam.close()
 
     return n
 
 def get_overlapping_models(exons):
     overlap = []
-    sorted_exons = sorted(exons, cmp=lambda x,y: cmp(x.start, y.start))
+    sorted_exons = sorted(exons, key=lambda x: x.start)
 
     for i, exon in enumerate(sorted_exons):
         j = i + 1
@@ -47,6 +38,50 @@ def get_overlapping_models(exons):
     
     return overlap
 
+def get_overlapping_genes(models):
+    """
+    Pairs of genes with overlapping exons on the same strand, as 
+    get_overlapping_models() but every pair of genes once. models is a
+    dict with the exons of every gene. The pairs are ordered by their 
+    first overlapping exons, sorted by start.
+    """
+    names = sorted(models.keys())
+    rows = [(e.start, e.end, e.strand, i) for i, name in enumerate(names) 
+            for e in models[name]]
+    if len(rows) == 0:
+        return []
+    start, end, strand, gene = zip(*rows)
+    start = np.array(start)
+    end = np.array(end)
+    strand = np.array(strand)
+    order = np.lexsort((end, start))
+    start, end, strand = start[order], end[order], strand[order]
+    gene = np.array(gene)[order]
+    
+    # Every exon overlaps the following exons on the same strand that
+    # start before its end
+    first, second = [], []
+    for s in np.unique(strand):
+        idx = np.nonzero(strand == s)[0]
+        last = np.searchsorted(start[idx], end[idx], "left")
+        n = np.maximum(last - np.arange(1, len(idx) + 1), 0)
+        i = np.repeat(np.arange(len(idx)), n)
+        j = i + 1 + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        first.append(idx[i])
+        second.append(idx[j])
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    pairs = np.lexsort((second, first))
+    gene1 = gene[first[pairs]]
+    gene2 = gene[second[pairs]]
+    other = gene1 != gene2
+    gene1, gene2 = gene1[other], gene2[other]
+    
+    # First occurrence of every pair of genes
+    key = np.minimum(gene1, gene2) * len(names) + np.maximum(gene1, gene2)
+    idx = np.sort(np.unique(key, return_index=True)[1])
+    return [(names[g1], names[g2]) for g1, g2 in zip(gene1[idx], gene2[idx])]
+
 def exons_to_seq(exons):
     seq = ""
     if exons[0].strand == "-":
@@ -92,6 +127,11 @@ def longest_orf(seq, do_prot=False):
     else:
         return sorted(orfs, cmp=lambda x,y: cmp(x[1] - x[0], y[1] - y[0]))[-1]
 
+def orf_length(seq):
+    """ Length of the longest ORF of a sequence, as stored in the database """
+    start, end = longest_orf(seq)
+    return end - start
+
 def find_genomic_pos(pos, exons):
     if exons[0].strand == "-":
         for e in exons[::-1]:
@@ -155,45 +195,47 @@ def model_to_bed(exons, genename=None):
 
 
 def get_splice_score(a, s_type=5):
+    """
+    Return the summed MaxEntScan score of a list of [name, sequence] 
+    splice sites, where s_type 5 indicates 9 bp splice donors and 3 
+    indicates 23 bp splice acceptors.
+    """
+    return get_splice_scores([a], s_type)[0]
+
+def get_splice_scores(sites, s_type=5):
+    """
+    Return the summed MaxEntScan score of every list of [name, sequence]
+    splice sites in sites, see get_splice_score(). The sequences of all 
+    lists are scored at once.
+    """
     if s_type not in [3,5]:
         raise Exception("Invalid splice type {}, should be 3 or 5".format(s_type))
     
-    valid_base = ["maxentscan_score", "score"]
-    maxent = config.maxentpath
-    maxent_base = None
-    for base in valid_base:
-        if not maxent:
-            exe = base
-        else:
-            exe = os.path.join(max_ent, base)
-        try:
-            sp.check_output("{}3.pl".format(exe), stderr=sp.STDOUT)
-        except sp.CalledProcessError:
-            maxent_base = exe
-        except:
-            pass
-    
-    if not maxent_base:
-        raise Exception("Please provide path to the score5.pl and score3.pl maxent scripts in config file")
+    seqs = [seq for a in sites for name, seq in a]
+    if len(seqs) == 0:
+        return [0] * len(sites)
 
-    tmp = NamedTemporaryFile()
-    for name,seq in a:
-        tmp.write(">{}\n{}\n".format(name,seq))
-    tmp.flush()
-    
-    cmd = "{}{}.pl {}".format(maxent_base, s_type, tmp.name)
-    p = sp.Popen(cmd, shell=True, stdout=sp.PIPE)
-    score = 0
-    for line in p.stdout.readlines():
-        vals = line.strip().split("\t")
-        if len(vals) > 1:
-            try:
-                score += float(vals[-1])
-            except ValueError:
-                logger.error("valueError, skipping: {}".format(vals))
-            except:
-                logger.error("Something unexpected happened")
-    return score
+    scorer = get_maxent_scorer(config.maxentpath, config.maxent_cache, 
+            config.maxent_cache_size)
+    if s_type == 5:
+        scores = scorer.score5(seqs)
+    else:
+        scores = scorer.score3(seqs)
+
+    result = []
+    i = 0
+    for a in sites:
+        score = 0
+        for name, seq in a:
+            site_score = scores[i]
+            i += 1
+            if np.isnan(site_score) or np.isinf(site_score):
+                logger.error("Invalid splice site, skipping: {} {}".format(name, seq))
+            else:
+                # score5.pl and score3.pl report scores with two decimals
+                score += float("{:.2f}".format(site_score))
+        result.append(score)
+    return result
 
 def bed2exonbed(inbed, outbed):
     with open(outbed, "w") as out:
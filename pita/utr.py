@@ -54,7 +54,7 @@ def call_utr(inbed, bamfiles, utr5=False, utr3=True):
     """
     
     # Load genes in BED file
-    transcripts = read_bed_transcripts(open(inbed))
+    transcripts = list(read_bed_transcripts(open(inbed)))
     
     # No genes
     if len(transcripts) == 0:
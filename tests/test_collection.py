@@ -186,3 +186,72 @@ def variant_track():
 #    assert ["chr1:100+200", "chr1:400+700", "chr1:800+900", "chr1:1000+1300", "chr1:1400+1500", "chr1:1600+1900", "chr1:2000+2100"] == s
 #
 #
+
+def test_best_variant(db, variant_track):
+    import networkx as nx
+    from pita.dbcollection import DbCollection
+    from pita.io import read_bed_transcripts
+
+    for tname, source, exons in read_bed_transcripts(open(variant_track)):
+         db.add_transcript("{0}{1}{2}".format("t1", "|", tname), source, exons)
+    weights = [{"weight":1,"type":"length","name":"length"}]
+    c = DbCollection(db, weights)
+
+    models = list(c.get_best_variants(weights))
+    assert 1 == len(models)
+    s = [str(e) for e in models[0]]
+    assert ["chr1:100+200", "chr1:400+700", "chr1:800+900", "chr1:1000+1300", "chr1:1400+1500", "chr1:1600+1900", "chr1:2000+2100"] == s
+
+    # Same path as Bellman-Ford
+    from pita.dbcollection import shortest_path_dag
+    source, sink, edges = c._component_problems()[0]
+    pred = shortest_path_dag(source, edges)
+    name = c.graph.node_name
+    ref, _ = nx.bellman_ford(c.graph.to_networkx(), name(source))
+    assert ref == dict([(name(k), v if v is None else name(v)) 
+        for k, v in pred.items()])
+
+def test_k_best_variants(db, variant_track):
+    import networkx as nx
+    from pita.dbcollection import DbCollection
+    from pita.io import read_bed_transcripts
+
+    for tname, source, exons in read_bed_transcripts(open(variant_track)):
+         db.add_transcript("{0}{1}{2}".format("t1", "|", tname), source, exons)
+    weights = [{"weight":1,"type":"length","name":"length"}]
+    c = DbCollection(db, weights)
+    
+    best = [[str(e) for e in model] for model in c.get_best_variants(weights)]
+    result = list(c.get_k_best_variants(weights, 5))
+    assert 1 == len(result)
+    assert 5 == len(result[0])
+    assert best[0] == [str(e) for e in result[0][0][1]]
+    
+    # Weights match the models, and all paths through the graph
+    weights = [w for w, model in result[0]]
+    for w, model in result[0]:
+        assert abs(c.get_weight(model) - w) < 1e-9
+    assert len(set([tuple(model) for w, model in result[0]])) == 5
+    graph = c.graph.to_networkx()
+    ref = sorted([sum([graph.edge[u][v]["weight"] for u, v in 
+        zip(path[:-2], path[1:-1])]) for path in 
+        nx.all_simple_paths(graph, "source_1", "sink_1")])
+    assert len(ref) > 5
+    assert all([abs(w1 - w2) < 1e-9 for w1, w2 in zip(weights, ref)])
+
+def test_best_variants_threads(db, two_transcripts, three_transcripts):
+    from pita.dbcollection import DbCollection
+    for name, source, exons in two_transcripts + three_transcripts:
+        db.add_transcript(name, source, exons)
+
+    result = []
+    for threads in [1, 2]:
+        c = DbCollection(db, [])
+        models = c.get_best_variants([], threads=threads)
+        result.append([[str(e) for e in model] for model in models])
+    
+    # Components are returned in genomic order
+    assert 2 == len(result[0])
+    assert "chr1:50+200" == result[0][0][0]
+    assert "chr1:700+900" == result[0][1][0]
+    assert result[0] == result[1]
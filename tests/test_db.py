@@ -103,6 +103,19 @@ def test_read_statistics(bam_file, db):
     assert [1,64,300] == sorted(counts)
     assert 5218 == db.nreads("test")
 
+def test_read_statistics_span(bam_file, db):
+    import pysam
+    bam = pysam.AlignmentFile(bam_file)
+    db.get_read_statistics("scaffold_1", bam_file, "test", 
+            span="start", extend=(500, 100))
+    for e in db.get_exons():
+        if e.strand == "+":
+            start, end = e.start - 500, e.start + 100
+        else:
+            start, end = e.end - 100, e.end + 500
+        n = len(list(bam.fetch("scaffold_1", max(start, 0), end)))
+        assert n == e.read_counts[0].count
+
 @pytest.fixture
 def splice_file():
     return "tests/data/splice_data.bed"
@@ -114,6 +127,62 @@ def test_splice_statistics(db, splice_file):
     assert 2 == len(splices)
     assert [4,20] == counts
 
+def test_splice_statistics_tabix(db, splice_file, tmpdir):
+    import pysam
+    fname = str(tmpdir.join("splice_data.bed"))
+    with open(fname, "w") as f:
+        for line in open(splice_file):
+            f.write(line)
+        # splice junction with multiple lines, and a new one
+        f.write("scaffold_1\t18200100\t18250000\t5\t0\t+\n")
+        f.write("scaffold_1\t18300000\t18400000\t3\t0\t+\n")
+        f.write("scaffold_2\t18080000\t18200000\t2\t0\t+\n")
+    tabix_fname = pysam.tabix_index(fname, preset="bed")
+    
+    db.get_splice_statistics("scaffold_1", tabix_fname, "test")
+    db.get_splice_statistics("scaffold_2", tabix_fname, "test")
+    
+    splices = db.get_splice_junctions("scaffold_1")
+    counts = [s.read_counts[0].count for s in splices]
+    assert [4,25,3] == counts
+    assert 1 == len(db.get_splice_junctions("scaffold_2"))
+    
+    # Counts are added when loading more data of the same source
+    db.get_splice_statistics("scaffold_1", tabix_fname, "test")
+    splices = db.get_splice_junctions("scaffold_1")
+    assert [8,50,6] == [s.read_counts[0].count for s in splices]
+
+def test_splice_junction_filters(db, splice_file, tmpdir):
+    fname = str(tmpdir.join("splice_data.bed"))
+    with open(fname, "w") as f:
+        for line in open(splice_file):
+            f.write(line)
+        # reads, but no evidence
+        f.write("scaffold_1\t18300000\t18400000\t3\t0\t+\n")
+    db.get_splice_statistics("scaffold_1", fname, "test")
+    # second evidence source, and a junction without reads
+    db.add_transcript("t2", "other", [
+                ["scaffold_1", 18000000, 18010000, "+"],
+                ["scaffold_1", 18020000, 18030000, "+"],
+                ["scaffold_1", 18070000, 18080000, "+"],
+                ["scaffold_1", 18200000, 18200100, "+"],
+                ])
+
+    def starts(splices):
+        return [s.start for s in splices]
+
+    splices = db.get_splice_junctions("scaffold_1", ev_count=2, read_count=10)
+    assert [18080000, 18200100] == starts(splices)
+    splices = db.get_splice_junctions("scaffold_1", ev_count=1, read_count=10)
+    assert [18080000, 18010000, 18030000, 18200100] == starts(splices)
+    splices = db.get_splice_junctions("scaffold_1", max_reads=10)
+    assert [18010000, 18030000, 18080000] == starts(splices)
+    
+    exons = db.get_exons("scaffold_1", min_length=20000, evidence=2)
+    assert [18070000, 18200000, 18250000] == starts(exons)
+    exons = db.get_exons("scaffold_1", max_length=20000, evidence=2)
+    assert [18000000, 18020000, 18070000, 18200000] == starts(exons)
+
 #def test_get_weight(db, bam_file, splice_file):
 #    db.get_read_statistics("scaffold_1", bam_file, "H3K4me3")
 #    db.get_splice_statistics("scaffold_1", splice_file, "RNAseq")
@@ -146,6 +215,94 @@ def test_splice_statistics(db, splice_file):
 #    w = c.get_weight(model, None, "evidence")
 #    assert 1 == w
 
+def test_upgrade_schema(tmpdir, transcripts):
+    from sqlalchemy import create_engine, inspect
+    from pita.annotationdb import AnnotationDb
+    from pita.db_backend import Base, SchemaVersion, SCHEMA_VERSION, \
+            get_schema_version
+    conn = "sqlite:///{}/pita_old.db".format(tmpdir)
+    with AnnotationDb(conn=conn, new=True) as d:
+        for name, source, exons in transcripts:
+            d.add_transcript(name, source, exons)
+    
+    # Unversioned database, without the indexes
+    engine = create_engine(conn)
+    engine.execute("DROP TABLE {}".format(SchemaVersion.__tablename__))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+    assert 0 == get_schema_version(engine)
+
+    with AnnotationDb(conn=conn) as d:
+        assert 3 == len(d.get_exons())
+    
+    assert SCHEMA_VERSION == get_schema_version(engine)
+    names = [ix["name"] for ix in inspect(engine).get_indexes("feature")]
+    assert "ix_feature_start" in names
+    assert "ix_feature_end" in names
+    assert engine.has_table("sqlite_stat1")
+    
+def test_orf_length_migration(tmpdir, transcripts):
+    from sqlalchemy import create_engine, inspect
+    from pita.annotationdb import AnnotationDb
+    from pita.dbcollection import DbCollection
+    from pita.db_backend import SCHEMA_VERSION, get_schema_version, \
+            _set_schema_version
+    conn = "sqlite:///{}/pita_old.db".format(tmpdir)
+    with AnnotationDb(conn=conn, new=True) as d:
+        for name, source, exons in transcripts:
+            d.add_transcript(name, source, exons)
+    
+    # Feature table of schema version 1
+    engine = create_engine(conn)
+    columns = [c["name"] for c in inspect(engine).get_columns("feature")
+            if c["name"] != "orf_length"]
+    engine.execute("ALTER TABLE feature RENAME TO feature_new")
+    engine.execute("CREATE TABLE feature AS SELECT {} FROM feature_new".format(
+        ", ".join(columns)))
+    engine.execute("DROP TABLE feature_new")
+    _set_schema_version(engine, 1)
+    
+    weights = [{"name":"orf", "weight":1, "type":"orf"}]
+    with AnnotationDb(conn=conn) as d:
+        exons = d.get_exons()
+        assert 3 == len(exons)
+        assert [None] * 3 == [e.orf_length for e in exons]
+        # Calculated from the sequence
+        c = DbCollection(d, weights)
+        assert 3 == c.max_id_value["orf"]
+    
+    assert SCHEMA_VERSION == get_schema_version(engine)
+    columns = [c["name"] for c in inspect(engine).get_columns("feature")]
+    assert "orf_length" in columns
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_bulk_load(tmpdir, transcripts, splice_file, in_memory):
+    from sqlalchemy import create_engine, inspect
+    from pita.annotationdb import AnnotationDb
+    from pita.db_backend import SCHEMA_VERSION, get_schema_version
+    conn = "sqlite:///{}/pita_bulk.db".format(tmpdir)
+    d = AnnotationDb(conn=conn, new=True, bulk_load=True, in_memory=in_memory)
+    for name, source, exons in transcripts:
+        d.add_transcript(name, source, exons)
+    d.get_splice_statistics("scaffold_1", splice_file, "test")
+    
+    engine = create_engine(conn)
+    names = [ix["name"] for ix in inspect(engine).get_indexes("feature")]
+    assert "ix_feature_start" not in names
+    
+    d.finish_load()
+    names = [ix["name"] for ix in inspect(engine).get_indexes("feature")]
+    assert "ix_feature_start" in names
+    assert SCHEMA_VERSION == get_schema_version(engine)
+    assert 3 == len(d.get_exons())
+    d.session.close()
+
+    with AnnotationDb(conn=conn) as d:
+        assert 3 == len(d.get_exons())
+        assert [4,20] == [s.read_counts[0].count 
+                for s in d.get_splice_junctions()]
+    
 def test_get_junction_exons(db):
     splices = db.get_splice_junctions()
     splice = [s for s in splices if s.start == 18080000][0]
@@ -158,6 +315,17 @@ def test_get_junction_exons(db):
     assert e2.start == 18200000
     assert e2.end == 18200100
 
+def test_get_junction_exon_triples(db):
+    db.add_transcript("t2", "other", [
+                ["scaffold_1", 18060000, 18080000, "+"],
+                ["scaffold_1", 18200000, 18200100, "+"],
+                ])
+    triples = db.get_junction_exon_triples("scaffold_1")
+    assert 3 == len(triples)
+    for splice, e1, e2 in triples:
+        assert (e1, e2) in db.get_junction_exons(splice)
+    assert [] == db.get_junction_exon_triples("scaffold_2")
+
 def test_db_collection(db):    
     from pita.dbcollection import DbCollection
     c = DbCollection(db, [])
@@ -188,3 +356,200 @@ def test_load_yaml(empty_db):
 
 
 
+def test_add_transcripts(empty_db, transcripts):
+    db = empty_db
+    more = [
+            ["t2", "annotation",
+                [
+                    ["scaffold_1", 18070000, 18080000, "+"],
+                    ["scaffold_1", 18200000, 18200200, "+"],
+                ]
+            ]
+            ]
+    db.add_transcripts(transcripts + more)
+    # adding the same transcripts again should not create duplicates
+    db.add_transcripts(transcripts)
+    
+    assert 4 == len(db.get_exons())
+    assert 2 == len(db.get_splice_junctions())
+    l = [len(e.evidences) for e in db.get_exons()]
+    assert [1,1,1,2] == sorted(l)
+
+def test_add_transcripts_malformed(empty_db):
+    db = empty_db
+    transcripts = [["t{}".format(i), "annotation", 
+        [["scaffold_1", start, start + 100, "+"], 
+            ["scaffold_1", start + 200, start + 300, "+"]]] 
+        for i, start in enumerate([1000, 2000, 3000])]
+    # Overlapping exons
+    transcripts[1][2][1][1] = 2050
+    with pytest.raises(ValueError):
+        db.add_transcripts(transcripts)
+    
+    # Stored up to the malformed transcript
+    assert [(1000, 1100), (1200, 1300)] == \
+            [(e.start, e.end) for e in db.get_exons()]
+
+class FakeIndex(object):
+    def get_sequence(self, chrom, start, end, strand):
+        return "A" * (end - start)
+
+def test_add_transcripts_splicing(empty_db, transcripts, monkeypatch):
+    import pita.annotationdb
+    db = empty_db
+    db.index = FakeIndex()
+    
+    monkeypatch.setattr(pita.annotationdb, "get_splice_scores", 
+            lambda sites, s_type: [-10] * len(sites))
+    db.add_transcripts(transcripts)
+    assert 0 == len(db.get_exons())
+    
+    monkeypatch.setattr(pita.annotationdb, "get_splice_scores", 
+            lambda sites, s_type: [10] * len(sites))
+    db.add_transcripts(transcripts)
+    assert 3 == len(db.get_exons())
+    assert 2 == len(db.get_splice_junctions())
+
+
+def test_incremental(tmpdir, caplog):
+    import logging
+    import pysam
+    from pita.model import load_chrom_data, get_chrom_models
+    lines = open("tests/data/cufflinks.bed").readlines()
+    fnames = []
+    for name, rows in (("old", [4, 6, 7, 8, 9]), ("new", [5])):
+        fname = os.path.join(str(tmpdir), "{}.bed".format(name))
+        with open(fname, "w") as f:
+            f.write("".join([lines[i - 1] for i in rows]))
+        fnames.append(fname)
+    anno = [[fname, fname, pysam.tabix_index(fname, preset="bed", 
+        keep_original=True), "bed", 1] for fname in fnames]
+    data = [["RNAPII", "tests/data/RNAPII.bam", "all", (0, 0)]]
+    weight = [
+            {"name":"RNAPII", "weight":1, "type":"all"},
+            {"name":"length", "weight":0.5, "type":"length"},
+            ]
+    chrom = "scaffold_6"
+
+    def models(conn, new, anno):
+        db = load_chrom_data(conn, new, chrom, anno, data)
+        return sorted([[str(e) for e in exons] for name, exons in
+            get_chrom_models(conn, chrom, weight, db=db, incremental=True)])
+
+    conn = "sqlite:///{}/pita_incremental.db".format(tmpdir)
+    assert 5 == len(models(conn, True, anno[:1]))
+    caplog.set_level(logging.INFO, logger="pita")
+    result = models(conn, False, anno)
+    assert "Annotation from {} already loaded".format(fnames[0]) in caplog.text
+    assert "Reusing the models of 4 of 5 components" in caplog.text
+
+    # Same models as without the previous run
+    full = "sqlite:///{}/pita_full.db".format(tmpdir)
+    assert result == models(full, True, anno)
+
+def test_snapshot_changed_data(tmpdir):
+    import shutil
+    import pysam
+    from pita.model import load_chrom_data, get_chrom_models
+    from pita.dbcollection import DbCollection
+    fname = os.path.join(str(tmpdir), "cufflinks.bed")
+    with open(fname, "w") as f:
+        f.write("".join(open("tests/data/cufflinks.bed").readlines()[1:]))
+    anno = [[fname, fname, pysam.tabix_index(fname, preset="bed", 
+        keep_original=True), "bed", 1]]
+    bam = os.path.join(str(tmpdir), "reads.bam")
+    data = [["RNA", bam, "all", (0, 0)]]
+    weight = [{"name":"RNA", "weight":1, "type":"all"}]
+    chrom = "scaffold_1"
+    conn = "sqlite:///{}/pita_snapshot.db".format(tmpdir)
+    snapshot = os.path.join(str(tmpdir), "scaffold_1.npz")
+    
+    reads = []
+    for source in ["RNAPII", "H3K4me3"]:
+        # Same name and path, other data
+        for ext in ["bam", "bam.bai"]:
+            shutil.copy("tests/data/{}.{}".format(source, ext), 
+                    "{}.{}".format(bam[:-4], ext))
+        db = load_chrom_data(conn, True, chrom, anno, data)
+        get_chrom_models(conn, chrom, weight, db=db, snapshot=snapshot)
+        c, extra = DbCollection.load(snapshot, db, weight, chrom=chrom)
+        reads.append(sum(c.graph.value("reads:RNA")))
+    
+    ref = DbCollection(db, weight, chrom=chrom)
+    assert reads[0] != reads[1]
+    assert reads[1] == sum(ref.graph.value("reads:RNA"))
+
+def test_incremental_splice(tmpdir, caplog):
+    import re
+    import logging
+    from pita.db_backend import ReadSource
+    import pysam
+    from pita.io import _create_tabix
+    from pita.model import load_chrom_data, get_chrom_models
+    fname = os.path.join(str(tmpdir), "cufflinks.bed")
+    with open(fname, "w") as f:
+        f.write("".join(open("tests/data/cufflinks.bed").readlines()[1:]))
+    anno = [[fname, fname, pysam.tabix_index(fname, preset="bed", 
+        keep_original=True), "bed", 1]]
+    splice = "tests/data/splice_data.bed"
+    data = [["splice", [splice], "splice", (0, 0)]]
+    weight = [{"name":"splice", "weight":1, "type":"splice"}]
+    chrom = "scaffold_1"
+    conn = "sqlite:///{}/pita_incremental.db".format(tmpdir)
+    
+    caplog.set_level(logging.INFO, logger="pita")
+    counts = []
+    for new in [True, False]:
+        # Every run indexes the splice file to a new temporary file
+        tabix_files = {splice:_create_tabix(splice, "bed")}
+        db = load_chrom_data(conn, new, chrom, anno, data, 
+                tabix_files=tabix_files)
+        models = get_chrom_models(conn, chrom, weight, db=db, 
+                incremental=True)
+        counts.append(sorted([(str(f), [r.count for r in f.read_counts]) 
+            for f in db.get_splice_junctions(chrom)]))
+        assert [splice] == [r.source for r in 
+                db.session.query(ReadSource)]
+        os.unlink(tabix_files[splice])
+        os.unlink(tabix_files[splice] + ".tbi")
+    
+    assert counts[0] == counts[1]
+    assert re.search(r"Reusing the models of (\d+) of \1 components", 
+            caplog.text)
+
+def test_incremental_config(tmpdir):
+    import yaml
+    from pita.config import PitaConfig
+    from pita.model import load_chrom_data
+    fname = os.path.join(str(tmpdir), "pita.yaml")
+    with open(fname, "w") as f:
+        yaml.dump({
+            "data_path":os.path.abspath("tests/data"),
+            "annotation":[{"name":"cufflinks", "path":"cufflinks.bed", 
+                "type":"bed", "min_exons":1}],
+            "data":[
+                {"name":"RNAPII", "path":"RNAPII.bam", "feature":"all"},
+                {"name":"splice", "path":"splice_data.bed", 
+                    "feature":"splice"},
+                ],
+            }, f)
+    conn = "sqlite:///{}/pita_incremental.db".format(tmpdir)
+    
+    # The same configuration twice
+    counts = []
+    for new in [True, False]:
+        config = PitaConfig()
+        config.load(fname)
+        db = load_chrom_data(conn, new, "scaffold_1", config.anno_files, 
+                config.data, tabix_files=config.tabix_files)
+        counts.append(sorted([(str(f), sorted([(r.read_source.name, 
+            r.count) for r in f.read_counts])) for f in 
+            db.get_exons("scaffold_1") + 
+            db.get_splice_junctions("scaffold_1")]))
+        db.session.close()
+        for tabix_file in [row[2] for row in config.anno_files] + \
+                config.tabix_files.values():
+            os.unlink(tabix_file)
+            os.unlink(tabix_file + ".tbi")
+    assert counts[0] == counts[1]
+    assert any([c for f, c in counts[0]])
@@ -1,9 +1,9 @@
 import pytest
 
 @pytest.fixture
-def index_dir():
+def index_dir(tmpdir):
     from gimmemotifs.genome_index import GenomeIndex
-    test_index_dir = 'tests/data/index/'
+    test_index_dir = str(tmpdir.join("index"))
     g = GenomeIndex()
     g.create_index('tests/data/genome/', test_index_dir)
 
@@ -61,3 +61,94 @@ def test_get_transcript_sequence(collection, seqs):
     
     
 
+
+@pytest.fixture
+def genome_store(index_dir, tmpdir, monkeypatch):
+    import os
+    import pita.genome
+    from pita.genome import get_genome_store
+    monkeypatch.setattr(pita.genome, "CACHE_DIR", str(tmpdir.join("cache")))
+    files = os.listdir(index_dir)
+    path = get_genome_store(index_dir)
+    assert path.startswith(pita.genome.CACHE_DIR)
+    assert files == os.listdir(index_dir)
+    return path
+
+def test_genome_store(index_dir, genome_store):
+    from gimmemotifs.genome_index import GenomeIndex
+    from pita.genome import GenomeStore
+    g = GenomeIndex(index_dir)
+    store = GenomeStore(genome_store)
+    
+    intervals = [(0, 100), (141483, 141492), (300000, 300500), (512000, 512581)]
+    for strand in ["+", "-"]:
+        ref = [g.get_sequence("scaffold_54", start, end, strand) for start, end in intervals]
+        assert ref == store.get_sequences("scaffold_54", intervals, [strand] * 4)
+
+    result = store.get_flanked_sequences("scaffold_54", 
+            [(10, 100), (1000, 1100), (512500, 512581)], ["+", "-", "+"], 20)
+    assert result[0] == ("", g.get_sequence("scaffold_54", 10, 100, "+"))
+    assert result[1] == (g.get_sequence("scaffold_54", 980, 1120, "-"),
+                g.get_sequence("scaffold_54", 1000, 1100, "-"))
+    assert result[2][0] == ""
+
+def test_genome_store_fasta(tmpdir):
+    from pita.genome import GenomeStore
+    fa = str(tmpdir.join("test.fa"))
+    with open(fa, "w") as f:
+        f.write(">chr1 description\nACGTnnNNacgtRYac\ngTTTTaaaa\n>chr2\nNNNN\n")
+    store = GenomeStore.create(fa, str(tmpdir.join("store")))
+    
+    assert "ACGTnnNNacgtRYacgTTTTaaaa" == store.get_sequence("chr1", 0, 25)
+    assert "AcgtRYacgtNNnnA" == store.get_sequence("chr1", 3, 18, "-")
+    assert "NNNN" == store.get_sequence("chr2", 0, 4)
+    with pytest.raises(ValueError):
+        store.get_sequence("chr2", 0, 5)
+
+def test_genome_store_iupac(tmpdir):
+    from pita.genome import GenomeStore
+    fa = str(tmpdir.join("test.fa"))
+    with open(fa, "w") as f:
+        f.write(">chr1\nACGTRYKMSWBVDHNacgtrykmswbvdhn\n")
+    store = GenomeStore.create(fa, str(tmpdir.join("store")))
+    
+    assert "ndhbvwskmryacgtNDHBVWSKMRYACGT" == store.get_sequence(
+            "chr1", 0, 30, "-")
+
+def test_get_transcript_sequence_store(genome_store, tmpdir, seqs):
+    from pita.annotationdb import AnnotationDb
+    from pita.dbcollection import DbCollection
+    from pita.genome import GenomeStore
+    from pita.io import read_bed_transcripts
+    from pita.util import exons_to_seq
+    
+    conn = "sqlite:///{}/pita_test_database.db".format(tmpdir)
+    db = AnnotationDb(conn=conn, new=True, index=genome_store)
+    assert isinstance(db.index, GenomeStore)
+
+    bed = "tests/data/scaffold_54_genes.bed"
+    db.add_transcripts(["{0}{1}{2}".format("test", ":::", tname), source, exons]
+            for tname, source, exons in read_bed_transcripts(open(bed), "test", 0))
+    
+    model = [m for m in DbCollection(db, []).get_best_variants([])][0]
+    seq = sorted(seqs, cmp=lambda x,y: cmp(len(x), len(y)))[-1]
+    assert seq.upper() == exons_to_seq(model).upper()
+
+def test_orf_length(genome_store, tmpdir):
+    from pita.annotationdb import AnnotationDb
+    from pita.io import read_bed_transcripts
+    from pita.util import longest_orf
+    
+    conn = "sqlite:///{}/pita_test_database.db".format(tmpdir)
+    db = AnnotationDb(conn=conn, new=True, index=genome_store)
+    bed = "tests/data/scaffold_54_genes.bed"
+    db.add_transcripts(["{0}{1}{2}".format("test", ":::", tname), source, exons]
+            for tname, source, exons in read_bed_transcripts(open(bed), "test", 0))
+    
+    exons = db.get_exons()
+    assert len(exons) > 0
+    for exon in exons:
+        start, end = longest_orf(exon.seq)
+        assert end - start == exon.orf_length
+    for junction in db.get_splice_junctions():
+        assert junction.orf_length is None
@@ -9,9 +9,9 @@ def linkfile():
     return "tests/data/test_linkage.bed"
 
 @pytest.fixture
-def db():
+def db(tmpdir):
     from pita.annotationdb import AnnotationDb
-    db = AnnotationDb(conn="sqlite:///pita_test_database.db",
+    db = AnnotationDb(conn="sqlite:///{}/pita_test_database.db".format(tmpdir),
             new=True)
     return db
 
@@ -38,3 +38,33 @@ def test_get_overlapping_models(db, bedfile):
 #    mc.prune()
 #    
 #    assert 5 == len([x for x in mc.get_connected_models()])
+
+def test_get_overlapping_genes():
+    from pita.exon import Exon
+    from pita.util import get_overlapping_genes
+    models = {
+            "a":[Exon("chr1", 100, 200, "+"), Exon("chr1", 300, 400, "+")],
+            "b":[Exon("chr1", 150, 250, "+"), Exon("chr1", 350, 450, "+")],
+            "c":[Exon("chr1", 200, 300, "+")],
+            "d":[Exon("chr1", 120, 500, "-")],
+            }
+    assert [("a", "b"), ("b", "c")] == get_overlapping_genes(models)
+    assert [] == get_overlapping_genes({})
+
+def test_prune_overlap():
+    from pita.exon import Exon
+    from pita.model import prune_overlap
+    models = {
+            "a":[Exon("chr1", 100, 200, "+"), Exon("chr1", 300, 400, "+")],
+            "b":[Exon("chr1", 150, 250, "+"), Exon("chr1", 350, 450, "+")],
+            "c":[Exon("chr1", 200, 300, "+")],
+            }
+    weights = {"a":-1, "b":-3, "c":-2}
+    calls = []
+    def get_weight(model):
+        name = [k for k, v in models.items() if v == model][0]
+        calls.append(name)
+        return weights[name]
+    assert {"a":1, "c":1} == prune_overlap(models, 0.1, [1, 1], get_weight)
+    assert ["a", "b", "c"] == sorted(calls)
+    assert {"b":1} == prune_overlap(models, 0.1, [], get_weight)
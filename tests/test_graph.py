@@ -0,0 +1,71 @@
+import pytest
+
+@pytest.fixture
+def graph():
+    from pita.graph import FeatureGraph, IN, OUT
+    g = FeatureGraph()
+    # Two components, the second one with two paths
+    for chrom, start, end, strand in [
+            ("chr1", 100, 200, "+"),
+            ("chr1", 300, 400, "+"),
+            ("chr2", 100, 200, "-"),
+            ("chr2", 300, 400, "-"),
+            ("chr2", 500, 600, "-"),
+            ]:
+        n1 = g.add_node(chrom, start, strand, IN, "exon_in")
+        n2 = g.add_node(chrom, end, strand, OUT, "exon_out")
+        g.add_edge(n1, n2, "exon")
+    g.add_edge(1, 2, "splice_junction")
+    g.add_edge(5, 7, "splice_junction")
+    g.add_edge(5, 9, "splice_junction")
+    return g
+
+def test_nodes(graph):
+    from pita.graph import IN, OUT
+    assert 10 == graph.n_nodes
+    assert 0 == graph.add_node("chr1", 100, "+", IN)
+    assert -1 == graph.find_node("chr1", 100, "-", IN)
+    assert "chr1:100+_exon_in" == graph.node_name(0)
+    assert ("chr2", 200, "-") == graph.node_loc(5)
+
+def test_adjacency(graph):
+    assert [7, 9] == list(graph.successors(5))
+    assert [8, 5] == list(graph.predecessors(9))
+    assert [1, 1, 1, 0, 1, 2, 1, 0, 1, 0] == list(graph.out_degree())
+
+    graph.remove_edge(5, 7)
+    assert [9] == list(graph.successors(5))
+    assert -1 == graph.edge(5, 7)
+    with pytest.raises(ValueError):
+        graph.remove_edge(5, 7)
+
+def test_components(graph):
+    assert [0, 0, 0, 0, 1, 1, 1, 1, 1, 1] == list(graph.component_labels())
+    graph.remove_edge(1, 2)
+    assert [0, 0, 1, 1, 2, 2, 2, 2, 2, 2] == list(graph.component_labels())
+
+def test_attrs(graph):
+    graph.set_attr(3, "RNAPII", 10)
+    edge = graph.add_edge(5, 8, "splice_junction")
+    assert [0, 0, 0, 10, 0, 0, 0, 0, 0] == list(graph.attr("RNAPII"))
+    assert 0 == graph.edge_attrs(edge)["RNAPII"]
+
+    nx_graph = graph.to_networkx()
+    assert 10 == nx_graph.number_of_nodes()
+    assert 9 == nx_graph.number_of_edges()
+    assert "exon_in" == nx_graph.node["chr1:300+_exon_in"]["ftype"]
+
+def test_save_load(graph, tmpdir):
+    from pita.graph import FeatureGraph
+    graph.values.set(3, "length", 100)
+    graph.remove_edge(1, 2)
+    fname = str(tmpdir.join("graph.npz"))
+    graph.save(fname, extra=[1, 2])
+    g, extra = FeatureGraph.load(fname)
+    assert [1, 2] == list(extra["extra"])
+    assert 10 == g.n_nodes
+    assert 5 == g.find_node("chr2", 200, "-", 1)
+    assert [7, 9] == list(g.successors(5))
+    assert -1 == g.edge(1, 2)
+    assert 100 == g.value("length")[3]
+    assert list(graph.component_labels()) == list(g.component_labels())
@@ -0,0 +1,113 @@
+import os
+import pytest
+
+def test_tabix_cache(tmpdir):
+    from pita.io import TabixCache
+    import pysam
+    fname = str(tmpdir.join("annotation.bed"))
+    with open("tests/data/annotation1.bed") as f:
+        data = f.read()
+    with open(fname, "w") as f:
+        f.write(data)
+    
+    path = str(tmpdir.join("cache"))
+    tabix_file = TabixCache(path).tabix(fname, "bed")
+    assert tabix_file.startswith(path)
+    assert ["chr1"] == list(pysam.Tabixfile(tabix_file).contigs)
+    
+    # Reused by a new cache, and for a copy of the file
+    assert tabix_file == TabixCache(path).tabix(fname, "bed")
+    copy = str(tmpdir.join("copy.bed"))
+    with open(copy, "w") as f:
+        f.write(data)
+    assert tabix_file == TabixCache(path).tabix(copy, "bed")
+    
+    # Changed files get a new entry, the old one is removed
+    os.unlink(copy)
+    with open(fname, "a") as f:
+        f.write(data.splitlines(True)[-1])
+    new_file = TabixCache(path).tabix(fname, "bed")
+    assert new_file != tabix_file
+    assert not os.path.exists(tabix_file)
+    assert 2 == len(os.listdir(path)) - 1
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_create_tabix(tmpdir, threads, monkeypatch):
+    import random
+    import pysam
+    import pita.io
+    from pita.io import _create_tabix
+    batches = []
+    sort_chunks = pita.io._sort_chunks
+    def sort(pool, chunks, *args):
+        batches.append(len(chunks))
+        return sort_chunks(pool, chunks, *args)
+    monkeypatch.setattr(pita.io, "_sort_chunks", sort)
+    random.seed(threads)
+    lines = ["chr{}\t{}\t{}\tf{}\n".format(chrom, start, start + 10, i) 
+            for i, (chrom, start) in enumerate(
+                [(random.choice("123"), random.randint(0, 10000)) 
+                    for i in range(1000)])]
+    fname = str(tmpdir.join("unsorted.bed"))
+    with open(fname, "w") as f:
+        f.write('track name="test"\n# comment\n\n')
+        f.writelines(lines)
+    
+    # Sorted in chunks of about 20 lines
+    tabix_file = _create_tabix(fname, "bed", threads, buffer_size=500)
+    assert len(batches) > 1
+    assert threads == max(batches)
+    tabix = pysam.Tabixfile(tabix_file)
+    assert ["chr1", "chr2", "chr3"] == sorted(tabix.contigs)
+    result = []
+    for chrom in sorted(tabix.contigs):
+        result += ["{}\n".format(line) for line in tabix.fetch(chrom)]
+    assert sorted(lines, key=lambda l: (l.split("\t")[0], 
+        int(l.split("\t")[1]), l)) == result
+    os.unlink(tabix_file)
+    os.unlink(tabix_file + ".tbi")
+
+def test_create_tabix_gff(tmpdir):
+    import pysam
+    from pita.io import _create_tabix
+    tabix_file = _create_tabix("tests/data/xenbase_annotation.gff3", "gff3")
+    tabix = pysam.Tabixfile(tabix_file)
+    n = len([line for line in open("tests/data/xenbase_annotation.gff3") 
+        if line.strip() and not line.startswith("#")])
+    assert n == sum([len(list(tabix.fetch(c))) for c in tabix.contigs])
+    os.unlink(tabix_file)
+    os.unlink(tabix_file + ".tbi")
+
+def test_read_bed_transcripts():
+    import types
+    from pita.io import read_bed_transcripts
+    lines = [
+            'track name="test"\n',
+            "chr1\t100\t500\tt1\t0\t+\t100\t500\t0\t3\t100,50,100,\t0,105,300,\n",
+            "chr1\t100\t500\tt1\t0\t+\t100\t500\t0\t1\t400,\t0,\n",
+            ]
+    it = read_bed_transcripts(iter(lines), "test.bed", min_exons=1, merge=5)
+    assert isinstance(it, types.GeneratorType)
+    assert [
+            ["chr1|t1|1", "test.bed", 
+                [["chr1", 100, 255, "+"], ["chr1", 400, 500, "+"]]],
+            ["chr1|t1|2", "test.bed", [["chr1", 100, 500, "+"]]],
+            ] == list(it)
+    assert 1 == len(list(read_bed_transcripts(iter(lines), min_exons=2)))
+
+def test_read_positions():
+    import pysam
+    import numpy as np
+    from pita.io import read_positions
+    bam = "tests/data/RNAPII.bam"
+    starts, ends = read_positions(bam, "scaffold_1")
+    reads = list(pysam.AlignmentFile(bam).fetch("scaffold_1"))
+    assert np.int64 == starts.dtype == ends.dtype
+    assert sorted([r.reference_start for r in reads]) == starts.tolist()
+    assert sorted([r.reference_end or r.reference_start + 1 
+        for r in reads]) == ends.tolist()
+    
+    for chrom in ["scaffold_10", "unknown"]:
+        starts, ends = read_positions(bam, chrom)
+        assert 0 == len(starts) == len(ends)
+        assert np.int64 == starts.dtype
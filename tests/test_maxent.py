@@ -0,0 +1,213 @@
+import os
+import math
+import random
+import subprocess as sp
+import pytest
+
+BASES = "ACGT"
+
+def kmers(k):
+    if k == 0:
+        return [""]
+    return [b + s for b in BASES for s in kmers(k - 1)]
+
+@pytest.fixture
+def models(tmpdir):
+    """ Random MaxEntScan models, with the same layout as the real ones
+    """
+    random.seed(42)
+    d = tmpdir.mkdir("maxent")
+    d.mkdir("splicemodels")
+
+    # shuffle to check the mapping of splice5sequences to me2x5
+    seqs = kmers(7)
+    random.shuffle(seqs)
+    with open(str(d.join("splicemodels", "splice5sequences")), "w") as f:
+        for seq in seqs:
+            f.write("{}\n".format(seq))
+    with open(str(d.join("me2x5")), "w") as f:
+        for seq in seqs:
+            f.write("{}\n".format(random.uniform(0.001, 10)))
+
+    for i, k in enumerate([7,7,7,7,7,3,4,3,4]):
+        with open(str(d.join("splicemodels", "me2x3acc{}".format(i + 1))), "w") as f:
+            for n in range(4 ** k):
+                f.write("{}\n".format(random.uniform(0.001, 10)))
+
+    return str(d)
+
+def hashseq(seq):
+    return sum([BASES.index(b) * 4 ** (len(seq) - i - 1) for i,b in enumerate(seq)])
+
+def reference_score5(path, seq):
+    """ Port of score5.pl """
+    seqs = [l.strip() for l in open(os.path.join(path, "splicemodels", "splice5sequences"))]
+    me2x5 = [float(l) for l in open(os.path.join(path, "me2x5"))]
+    seq_map = dict([(s, i) for i, s in enumerate(seqs)])
+
+    bgd = {'A':0.27, 'C':0.23, 'G':0.23, 'T':0.27}
+    cons1 = {'A':0.004, 'C':0.0032, 'G':0.9896, 'T':0.0032}
+    cons2 = {'A':0.0034, 'C':0.0039, 'G':0.0042, 'T':0.9884}
+    seq = seq.upper()
+    score = cons1[seq[3]] * cons2[seq[4]] / (bgd[seq[3]] * bgd[seq[4]])
+    rest = seq[:3] + seq[5:]
+    return math.log(score * me2x5[seq_map[rest]], 2)
+
+def reference_score3(path, seq):
+    """ Port of score3.pl """
+    tables = []
+    for i in range(9):
+        fname = os.path.join(path, "splicemodels", "me2x3acc{}".format(i + 1))
+        tables.append([float(l) for l in open(fname)])
+
+    bgd = {'A':0.27, 'C':0.23, 'G':0.23, 'T':0.27}
+    cons1 = {'A':0.9903, 'C':0.0032, 'G':0.0034, 'T':0.0030}
+    cons2 = {'A':0.0027, 'C':0.0037, 'G':0.9905, 'T':0.0030}
+    seq = seq.upper()
+    cons = cons1[seq[18]] * cons2[seq[19]] / (bgd[seq[18]] * bgd[seq[19]])
+    rest = seq[:18] + seq[20:23]
+    parts = [(0,7), (7,7), (14,7), (4,7), (11,7), (4,3), (7,4), (11,3), (14,4)]
+    sc = [tables[i][hashseq(rest[s:s + l])] for i, (s,l) in enumerate(parts)]
+    me = sc[0] * sc[1] * sc[2] * sc[3] * sc[4] / (sc[5] * sc[6] * sc[7] * sc[8])
+    return math.log(me, 2) + math.log(cons, 2)
+
+def random_seqs(n, l):
+    random.seed(1)
+    return ["".join([random.choice(BASES) for _ in range(l)]) for _ in range(n)]
+
+def test_score5(models):
+    from pita.maxent import MaxEntScorer
+    scorer = MaxEntScorer(models)
+
+    seqs = random_seqs(100, 9) + ["cagGTAAGT"]
+    scores = scorer.score5(seqs)
+    for seq, score in zip(seqs, scores):
+        assert abs(reference_score5(models, seq) - score) < 1e-6
+
+def test_score3(models):
+    from pita.maxent import MaxEntScorer
+    scorer = MaxEntScorer(models)
+
+    seqs = random_seqs(100, 23) + ["ttccaaacgaacttttgtagGGA"]
+    scores = scorer.score3(seqs)
+    for seq, score in zip(seqs, scores):
+        assert abs(reference_score3(models, seq) - score) < 1e-6
+
+def test_invalid_sequences(models):
+    import numpy as np
+    from pita.maxent import MaxEntScorer
+    scorer = MaxEntScorer(models)
+
+    scores = scorer.score5(["CAGGTNAGT", "CAGGTAAG", "CAGGTAAGT"])
+    assert np.isnan(scores[0])
+    assert np.isnan(scores[1])
+    assert not np.isnan(scores[2])
+
+@pytest.fixture
+def splice_sites():
+    donors = ["cagGTAAGT", "gagGTAAGT", "taaATAAGT"]
+    acceptors = [
+            "ttccaaacgaacttttgtagGGA",
+            "tgtctttttctgtgtggcagTGG",
+            "ttctctcttcagacttatagCAA",
+            ]
+    return donors, acceptors
+
+def perl_scores(path, script, seqs, tmpdir):
+    fname = str(tmpdir.join("seqs.fa"))
+    with open(fname, "w") as f:
+        for i, seq in enumerate(seqs):
+            f.write(">{}\n{}\n".format(i, seq))
+    out = sp.check_output(["perl", script, fname], cwd=path)
+    return [float(line.split("\t")[-1]) for line in out.splitlines() if "\t" in line]
+
+@pytest.mark.skipif("MAXENT" not in os.environ,
+        reason="set MAXENT to the MaxEntScan directory")
+def test_compare_to_perl(splice_sites, tmpdir):
+    from pita.maxent import MaxEntScorer
+    path = os.environ["MAXENT"]
+    scorer = MaxEntScorer(path)
+
+    donors, acceptors = splice_sites
+    for script, seqs, scores in [
+            ("score5.pl", donors, scorer.score5(donors)),
+            ("score3.pl", acceptors, scorer.score3(acceptors)),
+            ]:
+        ref = perl_scores(path, script, seqs, tmpdir)
+        assert ref == [float("{:.2f}".format(x)) for x in scores]
+
+def test_cached_scorer(models, tmpdir):
+    import numpy as np
+    from pita.maxent import MaxEntScorer, CachedMaxEntScorer
+    scorer = MaxEntScorer(models)
+    cache = str(tmpdir.join("splice_cache.db"))
+    cached = CachedMaxEntScorer(scorer, cache=cache, max_size=150)
+
+    donors = random_seqs(100, 9) + ["CAGGTNAGT"]
+    assert np.allclose(scorer.score5(donors), cached.score5(donors), 
+            equal_nan=True)
+
+    acceptors = random_seqs(100, 23)
+    ref = scorer.score3(acceptors)
+    assert np.allclose(ref, cached.score3(acceptors))
+    # Second time from cache
+    assert np.allclose(ref, cached.score3(acceptors))
+    
+    # A new process uses the on-disk cache
+    other = CachedMaxEntScorer(scorer, cache=cache, max_size=150)
+    assert 100 == len(other.cache.get(acceptors))
+    assert np.allclose(ref, other.score3(acceptors))
+    
+    # Least recently used sequences are evicted, to 90% of max_size
+    more = ["".join(reversed(seq)) for seq in random_seqs(100, 23)]
+    assert np.allclose(scorer.score3(more), other.score3(more))
+    assert 35 == len(other.cache.get(acceptors))
+    assert 100 == len(other.cache.get(more))
+    
+    # Sequences are only counted when the cache may be full
+    cache = other.cache
+    new = dict([("{:023d}".format(i), 1.0) for i in range(25)])
+    assert (135, 0) == (cache.size, cache.added)
+    cache.put(dict(new.items()[:5]))
+    assert (135, 5) == (cache.size, cache.added)
+    cache.put(dict(new.items()[5:]))
+    assert (135, 0) == (cache.size, cache.added)
+
+class RandomIndex(object):
+    def get_sequence(self, chrom, start, end, strand):
+        random.seed(start * 1000 + end)
+        return "".join([random.choice(BASES) for _ in range(end - start)])
+
+def test_add_transcripts_scores_batch(models, tmpdir, monkeypatch):
+    import pita.maxent
+    from pita.config import config
+    from pita.maxent import SpliceScoreCache
+    from pita.annotationdb import AnnotationDb
+    from pita.util import get_splice_score, get_splice_scores
+    monkeypatch.setattr(config, "maxentpath", models)
+    monkeypatch.setattr(config, "maxent_cache", 
+            str(tmpdir.join("splice_cache.db")))
+    monkeypatch.setattr(pita.maxent, "_scorers", {})
+    
+    calls = []
+    for method in ["get", "put"]:
+        monkeypatch.setattr(SpliceScoreCache, method, 
+                lambda self, arg, f=getattr(SpliceScoreCache, method): 
+                calls.append(1) or f(self, arg))
+    
+    transcripts = [["t{}".format(i), "test", [["chr1", s, s + 100, "+"] 
+        for s in range(1000 * i + 100, 1000 * i + 1000, 300)]] 
+        for i in range(20)]
+    db = AnnotationDb(conn="sqlite:///{}/pita_test.db".format(tmpdir), 
+            new=True)
+    db.index = RandomIndex()
+    db.add_transcripts(transcripts)
+    # The on-disk cache is used once for the whole batch
+    assert 0 < len(calls) <= 2
+    assert len(db.get_exons()) > 0
+    
+    sites = [db._get_splice_sites(name, "+", [db.index.get_sequence(
+        *(e[:1] + [e[1] - 20, e[2] + 20] + e[3:])) for e in exons], 
+        len(exons) - 1)[1] for name, source, exons in transcripts]
+    assert get_splice_scores(sites, 3) == \
+            [get_splice_score(a, 3) for a in sites]
@@ -0,0 +1,249 @@
+import pytest
+
+def load_db(backend, tmpdir, **kwargs):
+    from pita.annotationdb import AnnotationDb
+    from pita.memorydb import MemoryAnnotationDb
+    from pita.io import read_bed_transcripts
+    if backend == "sql":
+        conn = "sqlite:///{}/pita_test{}.db".format(tmpdir, len(kwargs))
+        db = AnnotationDb(conn=conn, new=True)
+    else:
+        db = MemoryAnnotationDb()
+
+    for fname in ["tests/data/cufflinks.bed", "tests/data/annotation1.bed"]:
+        db.add_transcripts((["{0}:::{1}".format(fname, tname), source, exons]
+                for tname, source, exons in
+                read_bed_transcripts(open(fname), fname, 1)), **kwargs)
+
+    db.get_read_statistics("scaffold_1", "tests/data/H3K4me3.bam", "H3K4me3",
+            span="start", extend=(500, 100))
+    db.get_read_statistics("scaffold_1", "tests/data/RNAPII.bam", "RNAPII")
+    db.get_splice_statistics("scaffold_1", "tests/data/splice_data.bed",
+            "splice")
+    return db
+
+@pytest.fixture
+def dbs(tmpdir):
+    return load_db("sql", tmpdir), load_db("memory", tmpdir)
+
+@pytest.fixture
+def weight():
+    return [
+            {"name":"H3K4me3", "weight":1, "type":"first"},
+            {"name":"RNAPII", "weight":1, "type":"all"},
+            {"name":"splice", "weight":1, "type":"splice"},
+            {"name":"evidence", "weight":1, "type":"evidence"},
+            {"name":"length", "weight":0.5, "type":"length"},
+            ]
+
+def features(fs):
+    return [(str(f), f.ftype, len(f.evidences),
+        sorted([(r.read_source.name, r.count, r.span) for r in f.read_counts]))
+        for f in fs]
+
+def test_features(dbs):
+    sql, memory = dbs
+    for chrom in [None, "scaffold_1", "scaffold_6", "scaffold_2"]:
+        assert features(sql.get_exons(chrom)) == \
+                features(memory.get_exons(chrom))
+        for kwargs in [{"min_length":200, "evidence":2},
+                {"max_length":200, "evidence":2},
+                {"min_length":200, "evidence":None},
+                {"max_length":200, "evidence":None}]:
+            assert features(sql.get_exons(chrom, **kwargs)) == \
+                    features(memory.get_exons(chrom, **kwargs))
+
+        assert features(sql.get_splice_junctions(chrom)) == \
+                features(memory.get_splice_junctions(chrom))
+        for kwargs in [{"ev_count":2, "read_count":5}, {"max_reads":10}]:
+            assert features(sql.get_splice_junctions(chrom, **kwargs)) == \
+                    features(memory.get_splice_junctions(chrom, **kwargs))
+
+    assert features(sql.get_long_exons("scaffold_6", 200, 1)) == \
+            features(memory.get_long_exons("scaffold_6", 200, 1))
+
+def test_features_no_evidence(dbs):
+    for db in dbs:
+        n = len(db.get_exons("scaffold_1"))
+        for kwargs in [{"min_length":200}, {"max_length":200}]:
+            assert len(db.get_exons("scaffold_1", evidence=None, 
+                **kwargs)) == n
+
+def test_add_transcripts_batches(dbs, tmpdir, monkeypatch):
+    from pita.annotationdb import AnnotationDb
+    batches = []
+    collect = AnnotationDb._collect_transcripts
+    def count(self, transcripts):
+        batches.append(len(transcripts))
+        return collect(self, transcripts)
+    monkeypatch.setattr(AnnotationDb, "_collect_transcripts", count)
+    for db, backend in zip(dbs, ["sql", "memory"]):
+        del batches[:]
+        batch_db = load_db(backend, tmpdir, batch_size=2)
+        assert max(batches) == 2
+        assert features(db.get_exons()) == features(batch_db.get_exons())
+        assert features(db.get_splice_junctions()) == \
+                features(batch_db.get_splice_junctions())
+
+def test_stats(dbs):
+    sql, memory = dbs
+    for name in ["H3K4me3", "RNAPII", "splice"]:
+        assert sql.nreads(name) == memory.nreads(name)
+        for e1, e2 in zip(sql.get_exons(), memory.get_exons()):
+            assert sql.feature_stats(e1, name) == memory.feature_stats(e2, name)
+
+    for splice1, splice2 in zip(sql.get_splice_junctions(),
+            memory.get_splice_junctions()):
+        assert features([e for pair in sql.get_junction_exons(splice1)
+            for e in pair]) == features([e for pair in
+                memory.get_junction_exons(splice2) for e in pair])
+        assert sql.intron_splice_stats(splice1, "splice") == \
+                memory.intron_splice_stats(splice2, "splice")
+
+def test_get_chrom_models(dbs, weight):
+    from pita.model import get_chrom_models
+    sql, memory = dbs
+    prune = {
+            "overlap": {"fraction":0.1, "weights":[]},
+            "introns": {"evidence":1, "min_reads":2},
+            }
+    for chrom in ["scaffold_1", "scaffold_6"]:
+        result = []
+        for db in dbs:
+            models = get_chrom_models(None, chrom, weight, prune=prune, db=db)
+            result.append(sorted([[name, [str(e) for e in exons]]
+                for name, exons in models]))
+        assert len(result[0]) > 0
+        assert result[0] == result[1]
+
+def test_write_sql(tmpdir):
+    from pita.annotationdb import AnnotationDb
+    memory = load_db("memory", tmpdir)
+    conn = "sqlite:///{}/pita_dump.db".format(tmpdir)
+    memory.write_sql(conn)
+    with AnnotationDb(conn=conn) as sql:
+        assert features(sql.get_exons()) == features(memory.get_exons())
+        assert features(sql.get_splice_junctions()) == \
+                features(memory.get_splice_junctions())
+
+def test_no_feature_queries(dbs, weight, monkeypatch):
+    from pita.dbcollection import DbCollection
+    for db in dbs:
+        c = DbCollection(db, weight, chrom="scaffold_1")
+        def fail(*args):
+            raise AssertionError("database query")
+        monkeypatch.setattr(db, "fetch_feature", fail)
+        monkeypatch.setattr(db, "feature_stats", fail)
+        models = list(c.get_best_variants(weight))
+        assert len(models) > 0
+        for model in models:
+            assert c.get_weight(model) < 0
+
+def test_graph_queries(dbs, weight):
+    from sqlalchemy import event
+    from pita.dbcollection import DbCollection
+    sql, memory = dbs
+    queries = []
+    def count(*args):
+        queries.append(1)
+    event.listen(sql.engine, "before_cursor_execute", count)
+    c = DbCollection(sql, weight, chrom="scaffold_1")
+    # No queries per feature
+    assert len(c.features) > 40
+    assert len(queries) < 20
+    ref = DbCollection(memory, weight, chrom="scaffold_1")
+    assert sorted(c.graph.value("evidence")) == \
+            sorted(ref.graph.value("evidence"))
+
+def test_rpkm_nreads(dbs, monkeypatch):
+    from pita.dbcollection import DbCollection
+    weight = [{"name":"RNAPII", "weight":1, "type":"rpkm"}]
+    sql, memory = dbs
+    calls = []
+    nreads = sql.nreads
+    def count_nreads(name):
+        calls.append(name)
+        return nreads(name)
+    monkeypatch.setattr(sql, "nreads", count_nreads)
+    c = DbCollection(sql, weight, chrom="scaffold_1")
+    assert ["RNAPII"] == calls
+    assert c.max_id_value["RNAPII"] > 0
+    
+    # Same weights from the in-memory database
+    ref = DbCollection(memory, weight, chrom="scaffold_1")
+    assert sorted(c.graph.attr("RNAPII")) == sorted(ref.graph.attr("RNAPII"))
+
+def test_snapshot(dbs, weight, tmpdir):
+    from pita.dbcollection import DbCollection
+    other = [
+            {"name":"RNAPII", "weight":2, "type":"rpkm"},
+            {"name":"length", "weight":1, "type":"orf"},
+            {"name":"evidence", "weight":0.5, "type":"evidence"},
+            ]
+    for db in dbs:
+        fname = str(tmpdir.join("scaffold_1.npz"))
+        DbCollection(db, weight, chrom="scaffold_1").save(fname)
+        for w in [other, weight]:
+            c, extra = DbCollection.load(fname, db, w, chrom="scaffold_1")
+            ref = DbCollection(db, w, chrom="scaffold_1")
+            assert ref.max_id_value == c.max_id_value
+            assert [[str(e) for e in m] for m in ref.get_best_variants(w)] \
+                    == [[str(e) for e in m] for m in c.get_best_variants(w)]
+
+def test_get_chrom_models_snapshot(tmpdir, weight, monkeypatch):
+    from pita.model import get_chrom_models
+    from pita.dbcollection import DbCollection
+    db = load_db("sql", tmpdir)
+    fname = str(tmpdir.join("scaffold_6.npz"))
+    other = [dict(w, weight=1) for w in weight]
+    ref = get_chrom_models(None, "scaffold_6", other, db=db)
+    get_chrom_models(None, "scaffold_6", weight, db=db, snapshot=fname)
+    
+    def fail(*args, **kwargs):
+        raise AssertionError("graph built from database")
+    monkeypatch.setattr(DbCollection, "_load_exons", fail)
+    result = get_chrom_models(None, "scaffold_6", other, db=db, 
+            snapshot=fname)
+    assert len(ref) > 0
+    assert sorted([[str(e) for e in m] for name, m in ref]) == \
+            sorted([[str(e) for e in m] for name, m in result])
+
+def test_get_chrom_models_sweep(tmpdir, weight, monkeypatch):
+    from pita.model import get_chrom_models, get_chrom_models_sweep
+    from pita.dbcollection import DbCollection
+    db = load_db("memory", tmpdir)
+    weights = [weight, [dict(w, weight=1) for w in weight], weight[1:3]]
+    prune = {"overlap": {"fraction":0.1, "weights":[1]}}
+    ref = [get_chrom_models(None, "scaffold_6", w, prune=prune, db=db) 
+            for w in weights]
+    
+    built = []
+    load_exons = DbCollection._load_exons
+    def count(self, *args, **kwargs):
+        built.append(1)
+        return load_exons(self, *args, **kwargs)
+    monkeypatch.setattr(DbCollection, "_load_exons", count)
+    results = get_chrom_models_sweep(None, "scaffold_6", weights, 
+            prune=prune, db=db)
+    assert 1 == len(built)
+    def names(models):
+        return sorted([[name, [str(e) for e in exons]] 
+            for name, exons in models])
+    assert [names(r) for r in ref] == [names(r) for r in results]
+
+def test_get_chrom_alternatives(tmpdir, weight):
+    from pita.model import get_chrom_models, get_chrom_alternatives
+    db = load_db("memory", tmpdir)
+    ref = get_chrom_models(None, "scaffold_6", weight, db=db)
+    best = get_chrom_alternatives(None, "scaffold_6", weight, 1, db=db)
+    assert sorted([[str(e) for e in m] for name, m in ref]) == \
+            sorted([[str(e) for e in m] for name, score, m in best])
+    
+    result = get_chrom_alternatives(None, "scaffold_6", weight, 3, db=db)
+    assert len(result) > len(best)
+    for name, score, exons in best:
+        alternatives = [r for r in result if r[0][:-1] == name[:-1]]
+        assert 1 < len(alternatives) <= 3
+        assert [name, score] == alternatives[0][:2]
+        scores = [s for n, s, m in alternatives]
+        assert scores == sorted(scores, reverse=True)
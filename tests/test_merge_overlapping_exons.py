@@ -41,3 +41,10 @@ def test_retrieve_transcripts(data):
     for starts, sizes, new_starts, new_sizes in data:
         assert new_starts, new_sizes == merge_exons(starts, sizes)
      
+
+def test_merge_exons(data):
+    from pita.io import merge_exons
+
+    for starts, sizes, new_starts, new_sizes in data:
+        assert (new_starts, new_sizes) == merge_exons(starts, sizes)
+    assert ([0], [250]) == merge_exons([0, 200], [100, 50], l=100)